@@ -1,39 +1,39 @@
+from datetime import date, timedelta
 from flask import Flask, request, jsonify
-import psycopg2
-from psycopg2.extras import RealDictCursor
-import os
-import logging
+from common.log import configure_logging, get_logger
+from common.db import get_db_connection
+from common.metrics import init_metrics
+from common.tracing import init_tracing
+from common.profiling import init_profiling
+from common.codec import init_codec
+from common.slow_queries import init_slow_query_log
+from common.idempotency import (init_idempotency, create_idempotency_table, claim_idempotency_key,
+                                remember_response, start_idempotency_cleanup)
+from common.references import init_references, unknown_references
+from common.change_feed import init_change_feed, start_change_feed_pruning
+from common.group_commit import GroupCommitter
+from common.partitioning import PARTITIONING_ENABLED, ensure_partitions, start_partition_maintenance
+from events import init_events
+from schedules import schedule_summary
+from schema import create_appointments_table, create_appointment_triggers
 
 app = Flask(__name__)
+init_metrics(app, 'appointment_service')
+init_tracing(app, 'appointment_service')
+init_profiling(app, 'appointment_service')
+init_codec(app)
+init_slow_query_log(app)
+init_idempotency(app)
+init_references(app, patient_id='patient_service', doctor_id='doctor_service')
+init_change_feed(app, 'appointments', get_db_connection)
+init_events(app)
 
 # Configure logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
-
-# Function to get database configuration from environment variables
-def get_db_config():
-    return {
-        'user': os.getenv('DB_USER'),
-        'password': os.getenv('DB_PASSWORD'),
-        'host': os.getenv('DB_HOST'),
-        'database': os.getenv('DB_NAME')
-    }
-
-# Function to establish a connection to the database
-def get_db_connection():
-    config = get_db_config()
-    try:
-        conn = psycopg2.connect(
-            host=config['host'],
-            database=config['database'],
-            user=config['user'],
-            password=config['password'],
-            cursor_factory=RealDictCursor
-        )
-        return conn
-    except Exception as e:
-        logger.error(f"Error connecting to the database: {e}")
-        return None
+configure_logging('appointment_service')
+logger = get_logger(__name__)
+
+# Bookings, committed in groups when WRITE_BATCHING is on (see common/group_commit.py)
+bookings = GroupCommitter(get_db_connection, 'appointments')
 
 # Function to initialize the database and create the 'appointments' table
 def initialize_database():
@@ -45,40 +45,72 @@ def initialize_database():
     try:
         cursor = conn.cursor()
         logger.info("Creating 'appointments' table if it doesn't exist...")
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS appointments (
-                id SERIAL PRIMARY KEY,
-                patient_id INTEGER NOT NULL,
-                doctor_id INTEGER NOT NULL,
-                appointment_date TIMESTAMP NOT NULL,
-                status VARCHAR(50) DEFAULT 'Scheduled'
-            );
-        """)
+        create_appointments_table(cursor)
+        if PARTITIONING_ENABLED:
+            ensure_partitions(cursor, 'appointments', 'appointment_date')
+        # Change feed, reminders, schedule rollups and events (see schema.py)
+        create_appointment_triggers(cursor)
+        # Responses of create requests sent with an Idempotency-Key
+        create_idempotency_table(cursor)
         conn.commit()
         logger.info("Database initialized successfully.")
     except Exception as e:
-        logger.error(f"Error initializing database: {e}")
+        logger.error("Error initializing database", error=e)
     finally:
         cursor.close()
         conn.close()
 
 # Initialize the database when the service starts
 initialize_database()
+start_idempotency_cleanup(get_db_connection)
+start_change_feed_pruning(get_db_connection, 'appointments')
+if PARTITIONING_ENABLED:
+    start_partition_maintenance(get_db_connection, [('appointments', 'appointment_date')])
 
-# Route to get all appointments
+# Route to get all appointments, optionally only those with
+# from <= appointment_date < to (lets Postgres prune partitions) and the
+# given status (any case; repeat it for several). With after_id and/or limit the list is paged in id order: pass the
+# last id of one page as after_id to get the next.
 @app.route('/appointments', methods=['GET'])
 def get_appointments():
+    start = request.args.get('from')
+    end = request.args.get('to')
+    statuses = tuple(status.lower() for status in request.args.getlist('status') if status)
+    after_id = request.args.get('after_id', type=int)
+    limit = request.args.get('limit', type=int)
+
     conn = get_db_connection()
     if not conn:
         return jsonify({"error": "Database connection failed"}), 500
 
     try:
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM appointments;")
+        query = "SELECT * FROM appointments"
+        conditions, params = [], []
+        if start:
+            conditions.append("appointment_date >= %s")
+            params.append(start)
+        if end:
+            conditions.append("appointment_date < %s")
+            params.append(end)
+        if statuses:
+            conditions.append("lower(status) IN %s")
+            params.append(statuses)
+        if after_id is not None:
+            conditions.append("id > %s")
+            params.append(after_id)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        if after_id is not None or limit:
+            query += " ORDER BY id"
+        if limit:
+            query += " LIMIT %s"
+            params.append(limit)
+        cursor.execute(query + ";", params)
         appointments = cursor.fetchall()
         return jsonify(appointments), 200
     except Exception as e:
-        logger.error(f"Error fetching appointments: {e}")
+        logger.error("Error fetching appointments", error=e)
         return jsonify({"error": "Failed to fetch appointments"}), 500
     finally:
         cursor.close()
@@ -95,26 +127,34 @@ def book_appointment():
     if not patient_id or not doctor_id or not appointment_date:
         return jsonify({"error": "Patient ID, Doctor ID, and Appointment Date are required"}), 400
 
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({"error": "Database connection failed"}), 500
+    # Checked against local copies of the other services' ids, no request to them
+    unknown = unknown_references(patient_id=patient_id, doctor_id=doctor_id)
+    if unknown:
+        return jsonify({"error": f"Unknown {' and '.join(unknown)}"}), 400
 
-    try:
-        cursor = conn.cursor()
+    # Returns (replayed response, None) for a retry with a known
+    # Idempotency-Key, else (None, response body) for the new appointment
+    def insert(cursor):
+        replay = claim_idempotency_key(cursor)
+        if replay is not None:
+            return replay, None
         cursor.execute(
             "INSERT INTO appointments (patient_id, doctor_id, appointment_date) VALUES (%s, %s, %s) RETURNING id;",
             (patient_id, doctor_id, appointment_date)
         )
-        appointment_id = cursor.fetchone()['id']
-        conn.commit()
-        logger.info(f"Appointment {appointment_id} added: patient_id = {patient_id}, doctor_id = {doctor_id}, appointment_date = {appointment_date}")
-        return jsonify({"id": appointment_id, "message": "Appointment booked successfully"}), 201
+        response = {"id": cursor.fetchone()['id'], "message": "Appointment booked successfully"}
+        remember_response(cursor, response, 201)
+        return None, response
+
+    try:
+        replay, response = bookings.run(insert)
+        if replay is not None:
+            return replay
+        logger.info("Appointment added", appointment_id=response['id'], patient_id=patient_id, doctor_id=doctor_id, appointment_date=appointment_date)
+        return jsonify(response), 201
     except Exception as e:
-        logger.error(f"Error booking appointment: {e}")
+        logger.error("Error booking appointment", error=e)
         return jsonify({"error": "Failed to book appointment"}), 500
-    finally:
-        cursor.close()
-        conn.close()
 
 # Route to cancel an appointment
 @app.route('/appointments/<int:appointment_id>', methods=['DELETE'])
@@ -127,10 +167,10 @@ def cancel_appointment(appointment_id):
         cursor = conn.cursor()
         cursor.execute("DELETE FROM appointments WHERE id = %s;", (appointment_id,))
         conn.commit()
-        logger.info(f"Appointment {appointment_id} deleted")
+        logger.info("Appointment deleted", appointment_id=appointment_id)
         return jsonify({"message": "Appointment canceled successfully"}), 200
     except Exception as e:
-        logger.error(f"Error canceling appointment: {e}")
+        logger.error("Error canceling appointment", error=e)
         return jsonify({"error": "Failed to cancel appointment"}), 500
     finally:
         cursor.close()
@@ -156,14 +196,111 @@ def update_appointment_status(appointment_id):
             (status, appointment_id)
         )
         conn.commit()
-        logger.info(f"Appointment {appointment_id} updated: status = {status}")
+        logger.info("Appointment updated", appointment_id=appointment_id, status=status)
         return jsonify({"message": "Appointment status updated successfully"}), 200
     except Exception as e:
-        logger.error(f"Error updating appointment status: {e}")
+        logger.error("Error updating appointment status", error=e)
         return jsonify({"error": "Failed to update appointment status"}), 500
     finally:
         cursor.close()
         conn.close()
 
+# Day given as ?<name>=YYYY-MM-DD, 'default' when absent, None when malformed
+def day_arg(name, default):
+    value = request.args.get(name)
+    if not value:
+        return default
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        return None
+
+# Route to get a doctor's day (?date=, default today): the counts from the
+# daily rollup and that day's appointments in time order
+@app.route('/doctors/<int:doctor_id>/schedule', methods=['GET'])
+def get_doctor_schedule(doctor_id):
+    day = day_arg('date', date.today())
+    if day is None:
+        return jsonify({"error": "date must be YYYY-MM-DD"}), 400
+
+    conn = get_db_connection()
+    if not conn:
+        return jsonify({"error": "Database connection failed"}), 500
+
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM doctor_daily_schedule WHERE doctor_id = %s AND day = %s;", (doctor_id, day))
+        schedule = schedule_summary(cursor.fetchone(), doctor_id, day)
+        cursor.execute("""
+            SELECT * FROM appointments
+            WHERE doctor_id = %s AND appointment_date >= %s AND appointment_date < %s
+            ORDER BY appointment_date, id;
+        """, (doctor_id, day, day + timedelta(days=1)))
+        schedule['appointments'] = cursor.fetchall()
+        return jsonify(schedule), 200
+    except Exception as e:
+        logger.error("Error fetching doctor schedule", doctor_id=doctor_id, error=e)
+        return jsonify({"error": "Failed to fetch doctor schedule"}), 500
+    finally:
+        cursor.close()
+        conn.close()
+
+# Route to get a doctor's counts for each day with from <= day < to (default
+# the 7 days from today), at most MAX_WORKLOAD_DAYS days; days with nothing
+# booked are included with zeros
+MAX_WORKLOAD_DAYS = 366
+
+@app.route('/doctors/<int:doctor_id>/workload', methods=['GET'])
+def get_doctor_workload(doctor_id):
+    start = day_arg('from', date.today())
+    end = day_arg('to', start + timedelta(days=7) if start else None)
+    if start is None or end is None:
+        return jsonify({"error": "from and to must be YYYY-MM-DD"}), 400
+    if not 0 < (end - start).days <= MAX_WORKLOAD_DAYS:
+        return jsonify({"error": f"to must be after from, by at most {MAX_WORKLOAD_DAYS} days"}), 400
+
+    conn = get_db_connection()
+    if not conn:
+        return jsonify({"error": "Database connection failed"}), 500
+
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT * FROM doctor_daily_schedule WHERE doctor_id = %s AND day >= %s AND day < %s;",
+            (doctor_id, start, end)
+        )
+        rows = {row['day']: row for row in cursor.fetchall()}
+        days = (start + timedelta(days=offset) for offset in range((end - start).days))
+        return jsonify([schedule_summary(rows.get(day), doctor_id, day) for day in days]), 200
+    except Exception as e:
+        logger.error("Error fetching doctor workload", doctor_id=doctor_id, error=e)
+        return jsonify({"error": "Failed to fetch doctor workload"}), 500
+    finally:
+        cursor.close()
+        conn.close()
+
+# Route to get the counts of every doctor with appointments on a day
+# (?date=, default today)
+@app.route('/doctors/workload', methods=['GET'])
+def get_workload_for_day():
+    day = day_arg('date', date.today())
+    if day is None:
+        return jsonify({"error": "date must be YYYY-MM-DD"}), 400
+
+    conn = get_db_connection()
+    if not conn:
+        return jsonify({"error": "Database connection failed"}), 500
+
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM doctor_daily_schedule WHERE day = %s ORDER BY doctor_id;", (day,))
+        return jsonify([schedule_summary(row, row['doctor_id'], day) for row in cursor.fetchall()]), 200
+    except Exception as e:
+        logger.error("Error fetching workload", day=day.isoformat(), error=e)
+        return jsonify({"error": "Failed to fetch workload"}), 500
+    finally:
+        cursor.close()
+        conn.close()
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=7000)
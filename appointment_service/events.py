@@ -0,0 +1,113 @@
+import os
+import json
+import time
+import select
+import logging
+import threading
+import psycopg2
+from flask import request
+from common import db
+from common.events import EventHub, sse_response
+
+logger = logging.getLogger(__name__)
+
+# Appointment changes pushed to subscribers instead of polled for. A row
+# trigger NOTIFYs every insert, update and delete on 'appointments' (made
+# through the service or not) with the row and an increasing event id; each
+# service process LISTENs on one connection of its own and streams the
+# events from GET /appointments/events. The gateway keeps one such stream
+# open and fans it out to its clients (see gateway_service/events.py).
+EVENT_CHANNEL = 'appointment_events'
+EVENT_RECONNECT_DELAY = float(os.getenv('EVENT_RECONNECT_DELAY', '1.0'))
+
+
+def create_event_trigger(cursor):
+    cursor.execute(f"""
+        CREATE SEQUENCE IF NOT EXISTS appointment_event_seq;
+        CREATE OR REPLACE FUNCTION appointments_notify() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            -- Rows moved between partitions by partition maintenance haven't changed
+            IF current_setting('app.moving_rows', true) = 'on' THEN
+                RETURN NULL;
+            END IF;
+            PERFORM pg_notify('{EVENT_CHANNEL}', json_build_object(
+                'id', nextval('appointment_event_seq'),
+                'op', lower(TG_OP),
+                'appointment', CASE WHEN TG_OP = 'DELETE' THEN row_to_json(OLD) ELSE row_to_json(NEW) END,
+                'previous_status', CASE WHEN TG_OP = 'UPDATE' THEN OLD.status END
+            )::text);
+            RETURN NULL;
+        END
+        $$;
+        CREATE OR REPLACE TRIGGER appointments_notify_insert_delete AFTER INSERT OR DELETE ON appointments
+            FOR EACH ROW EXECUTE FUNCTION appointments_notify();
+        CREATE OR REPLACE TRIGGER appointments_notify_update AFTER UPDATE ON appointments
+            FOR EACH ROW WHEN (OLD.* IS DISTINCT FROM NEW.*) EXECUTE FUNCTION appointments_notify();
+    """)
+
+
+# Follows the NOTIFY channel into an EventHub on a dedicated connection
+class AppointmentListener:
+    def __init__(self, hub):
+        self.hub = hub
+        self.pid = None
+        self.lock = threading.Lock()
+
+    # Start listening; called for every subscriber, and starts a new
+    # listener in a forked worker, which doesn't inherit the thread
+    def ensure_started(self):
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            threading.Thread(target=self.run, name="appointment-events", daemon=True).start()
+
+    def connect(self):
+        config = db.get_db_config()
+        conn = psycopg2.connect(host=config['host'], database=config['database'],
+                                user=config['user'], password=config['password'])
+        conn.autocommit = True
+        conn.cursor().execute(f"LISTEN {EVENT_CHANNEL};")
+        return conn
+
+    def listen(self):
+        conn = self.connect()
+        try:
+            while True:
+                if not select.select([conn], [], [], 60)[0]:
+                    # Quiet for a minute; make sure the connection is still alive
+                    conn.cursor().execute("SELECT 1;")
+                    continue
+                conn.poll()
+                for notification in conn.notifies:
+                    event = json.loads(notification.payload)
+                    self.hub.publish('change', event, event['id'])
+                conn.notifies.clear()
+        finally:
+            conn.close()
+
+    def run(self):
+        while True:
+            try:
+                self.listen()
+            except Exception as e:
+                logger.warning(f"Lost the {EVENT_CHANNEL} listener: {e}")
+            # Notifications sent while we weren't listening are gone
+            self.hub.reset()
+            time.sleep(EVENT_RECONNECT_DELAY)
+
+
+hub = EventHub()
+listener = AppointmentListener(hub)
+
+
+# Register GET /appointments/events: a text/event-stream of every
+# appointment change (clients filter through the gateway)
+def init_events(app):
+    def appointment_events():
+        listener.ensure_started()
+        return sse_response(hub.stream(request.headers.get('Last-Event-ID')))
+
+    app.add_url_rule('/appointments/events', 'appointment_events', appointment_events, methods=['GET'])
@@ -0,0 +1,56 @@
+import sys
+import logging
+import argparse
+from datetime import date
+from common.db import get_db_connection
+from schema import create_appointments_table, create_appointment_triggers
+from common.partitioning import ensure_partitions, convert_to_partitioned, archive_partitions, is_partitioned
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def create_partitioned_appointments(cursor):
+    create_appointments_table(cursor, partitioned=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the monthly partitions of the appointments table.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('ensure', help="create the default and upcoming monthly partitions")
+    commands.add_parser('convert', help="turn an existing plain appointments table into a partitioned one")
+    archive = commands.add_parser('archive', help="move whole months before a date to cold storage files")
+    archive.add_argument('--before', required=True, help="first month to keep, as YYYY-MM")
+    archive.add_argument('--dir', required=True, help="directory for the archived .csv.gz files")
+    args = parser.parse_args()
+
+    conn = get_db_connection()
+    if not conn:
+        logger.error("Failed to connect to the database.")
+        return 2
+
+    try:
+        cursor = conn.cursor()
+        if args.command == 'convert':
+            if is_partitioned(cursor, 'appointments'):
+                logger.info("The appointments table is already partitioned.")
+                return 0
+            convert_to_partitioned(cursor, 'appointments', 'appointment_date', create_partitioned_appointments,
+                                   create_appointment_triggers)
+        elif args.command == 'ensure':
+            created = ensure_partitions(cursor, 'appointments', 'appointment_date')
+            logger.info(f"Created {created} partitions.")
+        else:
+            year, month = (int(part) for part in args.before.split('-'))
+            archived = archive_partitions(conn, 'appointments', date(year, month, 1), args.dir)
+            logger.info(f"Archived {len(archived)} partitions.")
+        conn.commit()
+        return 0
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Partition maintenance failed: {e}")
+        return 1
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    sys.exit(main())
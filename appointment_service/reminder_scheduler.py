@@ -0,0 +1,173 @@
+import os
+import time
+import random
+import psycopg2
+import requests
+from common.log import configure_logging, get_logger
+from common.db import get_db_connection
+from common import tracing
+
+# Configure logging
+configure_logging('reminder_scheduler')
+logger = get_logger(__name__)
+
+# Sends a reminder REMINDER_LEAD_HOURS before each appointment, from the
+# queue the appointment service keeps in appointment_reminders (see
+# reminders.py). Due reminders are claimed in batches with SKIP LOCKED, so
+# several schedulers can run side by side without sending one twice, and
+# each carries a key the notification service deduplicates on in case a
+# batch is retried after a crash.
+NOTIFICATION_SERVICE_URL = os.getenv('NOTIFICATION_SERVICE_URL', 'http://notification_service:8001')
+REMINDER_LEAD_HOURS = float(os.getenv('REMINDER_LEAD_HOURS', '24'))
+BATCH_SIZE = int(os.getenv('REMINDER_BATCH_SIZE', '500'))
+POLL_INTERVAL = float(os.getenv('REMINDER_POLL_INTERVAL', '10.0'))
+REQUEST_TIMEOUT = float(os.getenv('REMINDER_REQUEST_TIMEOUT', '5.0'))
+MAX_ATTEMPTS = int(os.getenv('REMINDER_MAX_ATTEMPTS', '10'))
+BASE_BACKOFF = float(os.getenv('REMINDER_BASE_BACKOFF', '2.0'))
+MAX_BACKOFF = float(os.getenv('REMINDER_MAX_BACKOFF', '600.0'))
+RETENTION_DAYS = int(os.getenv('REMINDER_RETENTION_DAYS', '7'))
+
+# Exponential backoff with jitter, capped at MAX_BACKOFF seconds
+def backoff_seconds(attempts):
+    delay = min(MAX_BACKOFF, BASE_BACKOFF * (2 ** (attempts - 1)))
+    return delay * random.uniform(0.5, 1.0)
+
+# Deliver a batch of reminders in one request to the notification service,
+# returning a dict of appointment id -> error message for the failures
+def deliver_batch(session, reminders):
+    url = NOTIFICATION_SERVICE_URL + "/send-notifications"
+    payload = {
+        "notifications": [
+            {
+                "type": "appointment_reminder",
+                "appointment_id": reminder['appointment_id'],
+                "patient_id": reminder['patient_id'],
+                "doctor_id": reminder['doctor_id'],
+                "appointment_date": reminder['appointment_date'].isoformat(),
+                "key": f"reminder:{reminder['appointment_id']}:{reminder['appointment_date'].isoformat()}"
+            }
+            for reminder in reminders
+        ]
+    }
+    try:
+        with tracing.start_span("POST notification_service", "client", **{"http.url": url, "batch.size": len(reminders)}):
+            response = session.post(url, json=payload, timeout=REQUEST_TIMEOUT, headers=tracing.outbound_headers())
+    except requests.exceptions.RequestException as e:
+        return {reminder['appointment_id']: str(e) for reminder in reminders}
+    if response.status_code != 202:
+        error = f"Status code: {response.status_code}, Response: {response.text[:200]}"
+        return {reminder['appointment_id']: error for reminder in reminders}
+
+    failures = {}
+    for rejection in response.json().get('rejected', []):
+        failures[reminders[rejection['index']]['appointment_id']] = rejection['error']
+    return failures
+
+# Claim one batch of due reminders, deliver them and record the outcome
+def dispatch_batch(conn, session):
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            SELECT appointment_id, patient_id, doctor_id, appointment_date, attempts
+            FROM appointment_reminders
+            WHERE status = 'pending'
+              AND appointment_date <= NOW() + %s * INTERVAL '1 hour'
+              AND appointment_date > NOW()
+              AND next_attempt_at <= NOW()
+            ORDER BY appointment_date
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED;
+        """, (REMINDER_LEAD_HOURS, BATCH_SIZE))
+        reminders = cursor.fetchall()
+        if not reminders:
+            conn.commit()
+            return 0
+
+        with tracing.start_span("reminders.dispatch", **{"batch.size": len(reminders)}):
+            failures = deliver_batch(session, reminders)
+            sent_ids = []
+            for reminder in reminders:
+                error = failures.get(reminder['appointment_id'])
+                if error is None:
+                    sent_ids.append(reminder['appointment_id'])
+                    continue
+
+                attempts = reminder['attempts'] + 1
+                if attempts >= MAX_ATTEMPTS:
+                    logger.error("Giving up on reminder", appointment_id=reminder['appointment_id'], attempts=attempts, error=error)
+                    cursor.execute(
+                        "UPDATE appointment_reminders SET status = 'failed', attempts = %s, last_error = %s WHERE appointment_id = %s;",
+                        (attempts, error, reminder['appointment_id'])
+                    )
+                else:
+                    delay = backoff_seconds(attempts)
+                    logger.warning("Reminder failed, will retry", appointment_id=reminder['appointment_id'], attempts=attempts, retry_in=round(delay, 1), error=error)
+                    cursor.execute(
+                        """UPDATE appointment_reminders
+                           SET attempts = %s, last_error = %s, next_attempt_at = NOW() + %s * INTERVAL '1 second'
+                           WHERE appointment_id = %s;""",
+                        (attempts, error, delay, reminder['appointment_id'])
+                    )
+
+            if sent_ids:
+                cursor.execute(
+                    "UPDATE appointment_reminders SET status = 'sent', attempts = attempts + 1, sent_at = NOW(), last_error = NULL WHERE appointment_id = ANY(%s);",
+                    (sent_ids,)
+                )
+            conn.commit()
+        logger.info("Dispatched reminders", sent=len(sent_ids), batch=len(reminders))
+        return len(reminders)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+# Reminders for appointments that have passed are no use any more: expire
+# the ones never sent (e.g. while no scheduler was running) and delete the
+# rest after the retention period
+def purge_past(conn):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            "UPDATE appointment_reminders SET status = 'expired' WHERE status = 'pending' AND appointment_date <= NOW();"
+        )
+        cursor.execute(
+            "DELETE FROM appointment_reminders WHERE status <> 'pending' AND appointment_date < NOW() - %s * INTERVAL '1 day';",
+            (RETENTION_DAYS,)
+        )
+        conn.commit()
+    finally:
+        cursor.close()
+
+def run():
+    tracing.configure('reminder_scheduler')
+    session = requests.Session()
+    conn = None
+    last_purge = 0.0
+    while True:
+        try:
+            if conn is None or conn.closed:
+                conn = get_db_connection()
+                if not conn:
+                    time.sleep(POLL_INTERVAL)
+                    continue
+
+            processed = dispatch_batch(conn, session)
+            if processed == BATCH_SIZE:
+                # A full batch means more reminders are probably due
+                continue
+
+            if time.time() - last_purge > 3600:
+                purge_past(conn)
+                last_purge = time.time()
+            time.sleep(POLL_INTERVAL)
+        except psycopg2.Error as e:
+            logger.error(f"Database error in reminder scheduler: {e}")
+            if conn is not None:
+                conn.close()
+            conn = None
+            time.sleep(POLL_INTERVAL)
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,77 @@
+from common.appointment_statuses import CLOSED_STATUSES, sql_list
+
+# Reminder queue for appointments. A row trigger keeps appointment_reminders
+# in step with appointments: a booking queues a reminder, a new date
+# re-arms it, and a cancellation (delete, or a status in CLOSED_STATUSES,
+# see common/appointment_statuses.py) drops it, however the change is made.
+# Pending reminders are indexed by appointment date, so
+# reminder_scheduler.py finds the due ones with an index range scan instead
+# of scanning appointments, whatever the number of future appointments.
+
+
+def create_reminder_queue(cursor):
+    cursor.execute("SELECT to_regclass('appointment_reminders') IS NULL AS missing;")
+    missing = cursor.fetchone()['missing']
+    closed = sql_list(CLOSED_STATUSES)
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS appointment_reminders (
+            appointment_id INTEGER PRIMARY KEY,
+            patient_id INTEGER NOT NULL,
+            doctor_id INTEGER NOT NULL,
+            appointment_date TIMESTAMP NOT NULL,
+            status VARCHAR(20) NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            last_error TEXT,
+            sent_at TIMESTAMP
+        );
+        CREATE INDEX IF NOT EXISTS appointment_reminders_pending_idx
+            ON appointment_reminders (appointment_date) WHERE status = 'pending';
+
+        CREATE OR REPLACE FUNCTION appointments_schedule_reminder() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            -- Rows moved between partitions by partition maintenance haven't changed
+            IF current_setting('app.moving_rows', true) = 'on' THEN
+                RETURN NULL;
+            END IF;
+            IF TG_OP = 'DELETE' OR lower(NEW.status) IN ({closed}) THEN
+                DELETE FROM appointment_reminders WHERE appointment_id = OLD.id;
+                RETURN NULL;
+            END IF;
+            INSERT INTO appointment_reminders (appointment_id, patient_id, doctor_id, appointment_date)
+            VALUES (NEW.id, NEW.patient_id, NEW.doctor_id, NEW.appointment_date)
+            ON CONFLICT (appointment_id) DO UPDATE SET
+                patient_id = EXCLUDED.patient_id,
+                doctor_id = EXCLUDED.doctor_id,
+                appointment_date = EXCLUDED.appointment_date,
+                -- A moved appointment gets a fresh reminder
+                status = CASE WHEN appointment_reminders.appointment_date = EXCLUDED.appointment_date
+                              THEN appointment_reminders.status ELSE 'pending' END,
+                attempts = CASE WHEN appointment_reminders.appointment_date = EXCLUDED.appointment_date
+                                THEN appointment_reminders.attempts ELSE 0 END,
+                next_attempt_at = CASE WHEN appointment_reminders.appointment_date = EXCLUDED.appointment_date
+                                       THEN appointment_reminders.next_attempt_at ELSE CURRENT_TIMESTAMP END;
+            RETURN NULL;
+        END
+        $$;
+        CREATE OR REPLACE TRIGGER appointments_schedule_reminder_insert_delete AFTER INSERT OR DELETE ON appointments
+            FOR EACH ROW EXECUTE FUNCTION appointments_schedule_reminder();
+        CREATE OR REPLACE TRIGGER appointments_schedule_reminder_update
+            AFTER UPDATE OF patient_id, doctor_id, appointment_date, status ON appointments
+            FOR EACH ROW WHEN (OLD.* IS DISTINCT FROM NEW.*) EXECUTE FUNCTION appointments_schedule_reminder();
+    """)
+    if missing:
+        # First start: queue reminders for the appointments already booked
+        cursor.execute(f"""
+            INSERT INTO appointment_reminders (appointment_id, patient_id, doctor_id, appointment_date)
+            SELECT id, patient_id, doctor_id, appointment_date FROM appointments
+            WHERE appointment_date > NOW() AND lower(COALESCE(status, '')) NOT IN ({closed})
+            ON CONFLICT DO NOTHING;
+        """)
+    else:
+        # Drop reminders still pending for appointments closed under a status
+        # name the trigger didn't know at the time
+        cursor.execute(f"""
+            DELETE FROM appointment_reminders r USING appointments a
+            WHERE a.id = r.appointment_id AND r.status = 'pending' AND lower(a.status) IN ({closed});
+        """)
@@ -0,0 +1,115 @@
+from common.appointment_statuses import CANCELLED_STATUSES, COMPLETED_STATUSES, NO_SHOW_STATUSES, sql_list
+
+# Per-doctor, per-day rollups of appointments, so a doctor's day or a
+# week's workload is read from one row per day instead of counted from
+# 'appointments'. A row trigger keeps doctor_daily_schedule in step with
+# every booking, status change, move and cancellation, however the change
+# is made: the old row's contribution is taken off and the new one's added,
+# in the same transaction as the change. Cancelling through the API
+# (DELETE /appointments/<id>) deletes the row, so a deleted appointment that
+# was still scheduled moves to the cancelled count; a deleted completed or
+# no-show one is taken off, and a deleted cancelled one stays counted.
+#
+# Appointments count towards one of scheduled (booked and not yet
+# completed, e.g. 'Scheduled' or 'Confirmed'), completed, cancelled or
+# no_show, by status (see common/appointment_statuses.py).
+SCHEDULE_COLUMNS = ('scheduled', 'completed', 'cancelled', 'no_show')
+
+
+def status_column(status):
+    return f"""
+        CASE WHEN lower({status}) IN ({sql_list(CANCELLED_STATUSES)}) THEN 'cancelled'
+             WHEN lower({status}) IN ({sql_list(COMPLETED_STATUSES)}) THEN 'completed'
+             WHEN lower({status}) IN ({sql_list(NO_SHOW_STATUSES)}) THEN 'no_show'
+             ELSE 'scheduled' END
+    """
+
+
+def create_schedule_rollups(cursor):
+    cursor.execute("SELECT to_regclass('doctor_daily_schedule') IS NULL AS missing;")
+    missing = cursor.fetchone()['missing']
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS doctor_daily_schedule (
+            doctor_id INTEGER NOT NULL,
+            day DATE NOT NULL,
+            scheduled INTEGER NOT NULL DEFAULT 0,
+            completed INTEGER NOT NULL DEFAULT 0,
+            cancelled INTEGER NOT NULL DEFAULT 0,
+            no_show INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (doctor_id, day)
+        );
+        CREATE INDEX IF NOT EXISTS doctor_daily_schedule_day_idx ON doctor_daily_schedule (day);
+
+        CREATE OR REPLACE FUNCTION doctor_schedule_add(for_doctor INTEGER, on_day DATE, appointment_status TEXT, delta INTEGER)
+        RETURNS void LANGUAGE plpgsql AS $$
+        DECLARE
+            kind TEXT := {status_column('appointment_status')};
+        BEGIN
+            INSERT INTO doctor_daily_schedule AS schedule (doctor_id, day, scheduled, completed, cancelled, no_show)
+            VALUES (for_doctor, on_day,
+                    CASE WHEN kind = 'scheduled' THEN delta ELSE 0 END,
+                    CASE WHEN kind = 'completed' THEN delta ELSE 0 END,
+                    CASE WHEN kind = 'cancelled' THEN delta ELSE 0 END,
+                    CASE WHEN kind = 'no_show' THEN delta ELSE 0 END)
+            ON CONFLICT (doctor_id, day) DO UPDATE SET
+                scheduled = schedule.scheduled + EXCLUDED.scheduled,
+                completed = schedule.completed + EXCLUDED.completed,
+                cancelled = schedule.cancelled + EXCLUDED.cancelled,
+                no_show = schedule.no_show + EXCLUDED.no_show;
+        END
+        $$;
+
+        CREATE OR REPLACE FUNCTION appointments_roll_up_schedule() RETURNS trigger LANGUAGE plpgsql AS $$
+        DECLARE
+            deleted_kind TEXT;
+        BEGIN
+            -- Rows moved between partitions by partition maintenance haven't changed
+            IF current_setting('app.moving_rows', true) = 'on' THEN
+                RETURN NULL;
+            END IF;
+            IF TG_OP = 'DELETE' THEN
+                deleted_kind := {status_column('OLD.status')};
+                IF deleted_kind <> 'cancelled' THEN
+                    PERFORM doctor_schedule_add(OLD.doctor_id, OLD.appointment_date::date, OLD.status, -1);
+                END IF;
+                IF deleted_kind = 'scheduled' THEN
+                    PERFORM doctor_schedule_add(OLD.doctor_id, OLD.appointment_date::date, 'cancelled', 1);
+                END IF;
+                RETURN NULL;
+            END IF;
+            IF TG_OP = 'UPDATE' THEN
+                PERFORM doctor_schedule_add(OLD.doctor_id, OLD.appointment_date::date, OLD.status, -1);
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                PERFORM doctor_schedule_add(NEW.doctor_id, NEW.appointment_date::date, NEW.status, 1);
+            END IF;
+            RETURN NULL;
+        END
+        $$;
+        CREATE OR REPLACE TRIGGER appointments_roll_up_schedule_insert_delete AFTER INSERT OR DELETE ON appointments
+            FOR EACH ROW EXECUTE FUNCTION appointments_roll_up_schedule();
+        CREATE OR REPLACE TRIGGER appointments_roll_up_schedule_update
+            AFTER UPDATE OF doctor_id, appointment_date, status ON appointments
+            FOR EACH ROW WHEN (OLD.doctor_id IS DISTINCT FROM NEW.doctor_id
+                               OR OLD.appointment_date::date IS DISTINCT FROM NEW.appointment_date::date
+                               OR OLD.status IS DISTINCT FROM NEW.status)
+            EXECUTE FUNCTION appointments_roll_up_schedule();
+    """)
+    if missing:
+        # First start: roll up the appointments already booked, with writes
+        # held off so none is missed or counted twice
+        cursor.execute("LOCK TABLE appointments IN SHARE MODE;")
+        cursor.execute(f"""
+            INSERT INTO doctor_daily_schedule (doctor_id, day, {', '.join(SCHEDULE_COLUMNS)})
+            SELECT doctor_id, appointment_date::date,
+                   {', '.join(f"COUNT(*) FILTER (WHERE {status_column('status')} = '{column}')" for column in SCHEDULE_COLUMNS)}
+            FROM appointments
+            GROUP BY doctor_id, appointment_date::date;
+        """)
+
+
+# A doctor's rollup for 'day' as returned by the API, zeros when nothing is booked
+def schedule_summary(row, doctor_id, day):
+    counts = {column: row[column] if row else 0 for column in SCHEDULE_COLUMNS}
+    counts['booked'] = counts['scheduled'] + counts['completed'] + counts['no_show']
+    return dict(doctor_id=doctor_id, date=day.isoformat(), **counts)
@@ -0,0 +1,52 @@
+from common.partitioning import PARTITIONING_ENABLED
+from common.change_feed import create_change_feed
+from events import create_event_trigger
+from reminders import create_reminder_queue
+from schedules import create_schedule_rollups
+
+# Schema of the appointment service, importable without starting the
+# service (e.g. by manage_partitions.py)
+
+# Create the 'appointments' table, range-partitioned by month on
+# appointment_date when TABLE_PARTITIONING is enabled
+def create_appointments_table(cursor, partitioned=PARTITIONING_ENABLED):
+    if partitioned:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS appointments (
+                id SERIAL,
+                patient_id INTEGER NOT NULL,
+                doctor_id INTEGER NOT NULL,
+                appointment_date TIMESTAMP NOT NULL,
+                status VARCHAR(50) DEFAULT 'Scheduled',
+                PRIMARY KEY (id, appointment_date)
+            ) PARTITION BY RANGE (appointment_date);
+        """)
+    else:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS appointments (
+                id SERIAL PRIMARY KEY,
+                patient_id INTEGER NOT NULL,
+                doctor_id INTEGER NOT NULL,
+                appointment_date TIMESTAMP NOT NULL,
+                status VARCHAR(50) DEFAULT 'Scheduled'
+            );
+        """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS appointments_date_idx ON appointments (appointment_date);")
+    # Pages of appointments in one status, e.g. completed ones for billing
+    # (statuses are matched in lower case)
+    cursor.execute("DROP INDEX IF EXISTS appointments_status_idx;")
+    cursor.execute("CREATE INDEX IF NOT EXISTS appointments_status_lower_idx ON appointments (lower(status), id);")
+    # A doctor's appointments on one day (GET /doctors/<id>/schedule)
+    cursor.execute("CREATE INDEX IF NOT EXISTS appointments_doctor_date_idx ON appointments (doctor_id, appointment_date);")
+
+# The change feed, reminder queue, schedule rollups and event trigger kept
+# in step with 'appointments' by triggers on it; safe to run on every start
+def create_appointment_triggers(cursor):
+    # Other services follow this table's ids through GET /changes
+    create_change_feed(cursor, 'appointments')
+    # Reminders are queued and re-armed by a trigger, sent by reminder_scheduler.py
+    create_reminder_queue(cursor)
+    # Per-doctor daily counts, kept up to date by a trigger (see schedules.py)
+    create_schedule_rollups(cursor)
+    # Every change is pushed to GET /appointments/events subscribers
+    create_event_trigger(cursor)
@@ -0,0 +1,196 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import logging
+from datetime import date, datetime, timedelta
+import requests
+from psycopg2.extras import execute_values
+
+from harness import REPO_ROOT, RESULTS_DIR, SERVICES, git_revision, start_process
+from seed import SPECIALTIES, connect, seed
+
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.join(REPO_ROOT, 'billing_service'))
+from aggregates import rebuild_aggregates
+from bill_generation import ServiceClient, create_bill_generation_tables, generate_bills
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+logger = logging.getLogger(__name__)
+
+# Month-end bill generation: books --appointments completed appointments in
+# one month, then bills them with generate_bills.py's pipeline at each
+# --chunk-sizes, against the patient, doctor and appointment services on a
+# local Postgres database, e.g.
+#
+#   python bill_generation.py --appointments 100000 --chunk-sizes 250 1000 5000
+#
+# --baseline N also creates N bills one at a time through POST /bills, the
+# way they were made by hand, for comparison. Bills made by a step are
+# removed before the next, so only point it at a scratch database.
+
+PRICES = {specialty: 100 + 20 * index for index, specialty in enumerate(SPECIALTIES)}
+BENCH_SERVICES = ("patient_service", "doctor_service", "appointment_service", "billing_service")
+
+def last_month():
+    first = date.today().replace(day=1)
+    return (first - timedelta(days=1)).replace(day=1), first
+
+def id_range(cursor, table):
+    cursor.execute(f"SELECT MIN(id) AS low, MAX(id) AS high FROM {table};")
+    row = cursor.fetchone()
+    return row['low'], row['high']
+
+# Completed appointments spread over the month, on top of whatever is there
+def book_month(db_config, scale, count, start, end):
+    conn = connect(db_config)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) AS patients FROM patients;")
+        if cursor.fetchone()['patients'] == 0:
+            conn.close()
+            seed(db_config, scale)
+            conn = connect(db_config)
+            cursor = conn.cursor()
+        patients, doctors = id_range(cursor, 'patients'), id_range(cursor, 'doctors')
+        seconds = (end - start).total_seconds()
+        execute_values(cursor, "INSERT INTO appointments (patient_id, doctor_id, appointment_date, status) VALUES %s", [
+            (random.randint(*patients), random.randint(*doctors),
+             datetime.combine(start, datetime.min.time()) + timedelta(seconds=random.uniform(0, seconds)), "Completed")
+            for _ in range(count)
+        ], page_size=5000)
+        create_bill_generation_tables(cursor)
+        execute_values(cursor, """
+            INSERT INTO specialty_prices (specialty, amount) VALUES %s
+            ON CONFLICT (specialty) DO UPDATE SET amount = EXCLUDED.amount;
+        """, list(PRICES.items()))
+        conn.commit()
+    finally:
+        conn.close()
+
+# Remove the bills (and their notifications) made for the month's completed
+# appointments and the month's checkpoint, so the next step starts clean
+def clear_month(db_config, start, end, since_bill_id):
+    conn = connect(db_config)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM notification_outbox WHERE bill_id > %s;", (since_bill_id,))
+        cursor.execute("DELETE FROM bills WHERE id > %s;", (since_bill_id,))
+        cursor.execute("DELETE FROM bill_generation_runs WHERE period_start = %s AND period_end = %s;", (start, end))
+        rebuild_aggregates(cursor)
+        conn.commit()
+    finally:
+        conn.close()
+
+def last_bill_id(db_config):
+    conn = connect(db_config)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COALESCE(MAX(id), 0) AS id FROM bills;")
+        return cursor.fetchone()['id']
+    finally:
+        conn.close()
+
+def run_pipeline(db_config, start, end, chunk_size):
+    conn = connect(db_config)
+    try:
+        began = time.perf_counter()
+        run = generate_bills(conn, ServiceClient(), start, end, chunk_size)
+        seconds = time.perf_counter() - began
+    finally:
+        conn.close()
+    return {"mode": "pipeline", "chunk_size": chunk_size, "appointments": run['appointments_seen'],
+            "bills": run['bills_created'], "seconds": round(seconds, 3),
+            "bills_per_second": round(run['bills_created'] / seconds, 1) if seconds else None}
+
+# Bills created one request at a time, for the appointments the pipeline would bill
+def run_baseline(db_config, start, end, count):
+    conn = connect(db_config)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT a.id, a.patient_id FROM appointments a
+            WHERE lower(a.status) = 'completed' AND a.appointment_date >= %s AND a.appointment_date < %s
+            ORDER BY a.id LIMIT %s;
+        """, (start, end, count))
+        appointments = cursor.fetchall()
+    finally:
+        conn.close()
+    session = requests.Session()
+    began = time.perf_counter()
+    for appointment in appointments:
+        session.post("http://127.0.0.1:8000/bills", json={
+            "patient_id": appointment['patient_id'], "appointment_id": appointment['id'],
+            "amount": 100, "email": f"patient{appointment['patient_id']}@example.com"
+        }).raise_for_status()
+    seconds = time.perf_counter() - began
+    return {"mode": "one by one", "chunk_size": 1, "appointments": len(appointments), "bills": len(appointments),
+            "seconds": round(seconds, 3), "bills_per_second": round(len(appointments) / seconds, 1) if seconds else None}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark month-end bill generation.")
+    parser.add_argument("--appointments", type=int, default=50000, help="completed appointments to book in the month")
+    parser.add_argument("--chunk-sizes", type=int, nargs="+", default=[250, 1000, 5000])
+    parser.add_argument("--baseline", type=int, default=0, help="also create this many bills one request at a time")
+    parser.add_argument("--scale", type=int, default=5000, help="patients to seed if the database is empty")
+    parser.add_argument("--no-seed", action="store_true", help="bill the completed appointments already there")
+    parser.add_argument("--server", choices=["dev", "gunicorn"], default="gunicorn")
+    parser.add_argument("--db-host", default=os.getenv("DB_HOST", "127.0.0.1"))
+    parser.add_argument("--db-name", default=os.getenv("DB_NAME", "medical_bench"))
+    parser.add_argument("--db-user", default=os.getenv("DB_USER", "postgres"))
+    parser.add_argument("--db-password", default=os.getenv("DB_PASSWORD", ""))
+    parser.add_argument("--log-dir", help="write service logs here")
+    parser.add_argument("--output", help="results file (default: benchmarks/results/bill-generation-<revision>-<time>.json)")
+    args = parser.parse_args()
+
+    start, end = last_month()
+    db_config = {"host": args.db_host, "dbname": args.db_name, "user": args.db_user, "password": args.db_password}
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT, DB_HOST=args.db_host, DB_NAME=args.db_name,
+               DB_USER=args.db_user, DB_PASSWORD=args.db_password, REFERENCE_VALIDATION="false")
+    for name, _, _, port in SERVICES:
+        os.environ[f"{name.upper()}_URL"] = env[f"{name.upper()}_URL"] = f"http://127.0.0.1:{port}"
+    if args.log_dir:
+        os.makedirs(args.log_dir, exist_ok=True)
+
+    processes = []
+    steps = []
+    try:
+        for spec in SERVICES:
+            if spec[0] in BENCH_SERVICES:
+                processes.append(start_process(spec, env, args.log_dir, args.server))
+        if not args.no_seed:
+            logger.info(f"Booking {args.appointments} completed appointments from {start} to {end}...")
+            book_month(db_config, args.scale, args.appointments, start, end)
+
+        before = last_bill_id(db_config)
+        if args.baseline:
+            steps.append(run_baseline(db_config, start, end, args.baseline))
+            clear_month(db_config, start, end, before)
+        for chunk_size in args.chunk_sizes:
+            steps.append(run_pipeline(db_config, start, end, chunk_size))
+            clear_month(db_config, start, end, before)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+    print(f"\nBills for completed appointments from {start} to {end}")
+    print(f"{'mode':<12}{'chunk':>8}{'appointments':>14}{'bills':>9}{'seconds':>10}{'bills/s':>10}")
+    for step in steps:
+        print(f"{step['mode']:<12}{step['chunk_size']:>8}{step['appointments']:>14}{step['bills']:>9}"
+              f"{step['seconds']:>10.2f}{step['bills_per_second'] or 0:>10.1f}")
+
+    revision = git_revision()
+    output = args.output or os.path.join(RESULTS_DIR, f"bill-generation-{revision}-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as results_file:
+        json.dump({"revision": revision, "timestamp": datetime.now().isoformat(timespec="seconds"),
+                   "period": [start.isoformat(), end.isoformat()], "server": args.server, "steps": steps},
+                  results_file, indent=2)
+    logger.info(f"Results written to {output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+import sys
+import json
+import argparse
+
+# Compare two harness result files route by route. Exits with status 1 when a
+# route's p95 latency grew, or its throughput dropped, by more than the threshold.
+
+def change(old, new):
+    if not old:
+        return 0.0
+    return (new - old) / old * 100
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files.")
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--threshold", type=float, default=10.0, help="allowed regression in percent")
+    args = parser.parse_args()
+
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    with open(args.candidate) as candidate_file:
+        candidate = json.load(candidate_file)
+
+    for key in ("workload", "mode", "scale", "concurrency"):
+        if baseline.get(key) != candidate.get(key):
+            print(f"warning: {key} differs ({baseline.get(key)} vs {candidate.get(key)})")
+
+    print(f"{baseline['revision']} -> {candidate['revision']}")
+    print(f"{'route':<34}{'rps':>18}{'p50 ms':>20}{'p95 ms':>20}{'p99 ms':>20}")
+    regressions = []
+    for label in sorted(set(baseline['routes']) | set(candidate['routes'])):
+        old = baseline['routes'].get(label)
+        new = candidate['routes'].get(label)
+        if old is None or new is None:
+            print(f"{label:<34}  only in {'candidate' if old is None else 'baseline'}")
+            continue
+
+        cells = []
+        for metric in ("rps", "p50_ms", "p95_ms", "p99_ms"):
+            cells.append(f"{new[metric]:>10.2f} ({change(old[metric], new[metric]):+5.1f}%)")
+        print(f"{label:<34}" + "".join(f"{cell:>20}" for cell in cells))
+
+        if change(old['p95_ms'], new['p95_ms']) > args.threshold:
+            regressions.append(f"{label}: p95 {old['p95_ms']} -> {new['p95_ms']} ms")
+        if change(old['rps'], new['rps']) < -args.threshold:
+            regressions.append(f"{label}: rps {old['rps']} -> {new['rps']}")
+
+    if regressions:
+        print("\nRegressions over threshold:")
+        for regression in regressions:
+            print(f"  {regression}")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,107 @@
+import os
+import json
+import logging
+import argparse
+from datetime import datetime
+
+from harness import REPO_ROOT, RESULTS_DIR, SERVICES, git_revision, start_process, run_load, summarize
+from seed import connect
+from workloads import book_appointment, add_medical_record
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+logger = logging.getLogger(__name__)
+
+# Throughput against latency of appointment and medical record inserts, one
+# commit per request against group commit (WRITE_BATCHING), at several
+# numbers of concurrent clients, e.g.
+#
+#   python group_commit.py --concurrency 1 8 32 128 --max-delays 1 5
+#
+# Clients post straight to the appointment and medical record services
+# under gunicorn. Each request inserts a row, so only point it at a scratch
+# database.
+
+ROUTES = [
+    ("appointment_service", "POST /appointments", book_appointment),
+    ("medical_record_service", "POST /medical_records", add_medical_record),
+]
+
+def id_ranges(db_config):
+    conn = connect(db_config)
+    try:
+        cursor = conn.cursor()
+        ranges = {}
+        for table in ('patients', 'doctors'):
+            cursor.execute(f"SELECT COALESCE(MIN(id), 1) AS low, COALESCE(MAX(id), 1) AS high FROM {table};")
+            row = cursor.fetchone()
+            ranges[table] = (row['low'], row['high'])
+        return ranges
+    finally:
+        conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark group commit of appointment and medical record inserts.")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32, 128])
+    parser.add_argument("--max-delays", type=float, nargs="+", default=[0.0, 1.0],
+                        help="WRITE_BATCH_MAX_DELAY_MS values to try with batching on")
+    parser.add_argument("--duration", type=float, default=15.0, help="measured seconds per step")
+    parser.add_argument("--warmup", type=float, default=3.0)
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn worker processes per service")
+    parser.add_argument("--pool-size", type=int, default=20, help="database connections per worker (DB_POOL_SIZE)")
+    parser.add_argument("--db-host", default=os.getenv("DB_HOST", "127.0.0.1"))
+    parser.add_argument("--db-name", default=os.getenv("DB_NAME", "medical_bench"))
+    parser.add_argument("--db-user", default=os.getenv("DB_USER", "postgres"))
+    parser.add_argument("--db-password", default=os.getenv("DB_PASSWORD", ""))
+    parser.add_argument("--log-dir", help="write service logs here")
+    parser.add_argument("--output", help="results file (default: benchmarks/results/group-commit-<revision>-<time>.json)")
+    args = parser.parse_args()
+
+    db_config = {"host": args.db_host, "dbname": args.db_name, "user": args.db_user, "password": args.db_password}
+    ctx = {"ids": id_ranges(db_config)}
+    # Enough threads that every client's request is in flight at once
+    threads = max(4, -(-max(args.concurrency) // args.workers))
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT, DB_HOST=args.db_host, DB_NAME=args.db_name,
+               DB_USER=args.db_user, DB_PASSWORD=args.db_password, REFERENCE_VALIDATION="false",
+               WEB_WORKERS=str(args.workers), WEB_THREADS=str(threads), DB_POOL_SIZE=str(args.pool_size))
+    if args.log_dir:
+        os.makedirs(args.log_dir, exist_ok=True)
+
+    modes = [("per request", {"WRITE_BATCHING": "false"})]
+    modes += [(f"batched {delay:g}ms", {"WRITE_BATCHING": "true", "WRITE_BATCH_MAX_DELAY_MS": str(delay)})
+              for delay in args.max_delays]
+    specs = {spec[0]: spec for spec in SERVICES}
+    steps = []
+    for mode, settings in modes:
+        processes = []
+        try:
+            for service, _, _ in ROUTES:
+                processes.append(start_process(specs[service], dict(env, **settings), args.log_dir, "gunicorn"))
+            for service, label, operation in ROUTES:
+                base_url = f"http://127.0.0.1:{specs[service][3]}"
+                for concurrency in args.concurrency:
+                    logger.info(f"{mode}: {label} with {concurrency} clients...")
+                    samples = run_load(base_url, [(1, label, operation)], ctx, concurrency, args.warmup, args.duration)
+                    steps.append(dict(summarize(samples, args.duration)[label], mode=mode, route=label,
+                                      concurrency=concurrency))
+        finally:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.wait()
+
+    print(f"\n{'route':<24}{'mode':<16}{'clients':>8}{'rps':>10}{'err':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for step in sorted(steps, key=lambda step: (step['route'], step['concurrency'])):
+        print(f"{step['route']:<24}{step['mode']:<16}{step['concurrency']:>8}{step['rps']:>10.1f}{step['errors']:>6}"
+              f"{step['p50_ms']:>10.2f}{step['p95_ms']:>10.2f}{step['p99_ms']:>10.2f}")
+
+    revision = git_revision()
+    output = args.output or os.path.join(RESULTS_DIR, f"group-commit-{revision}-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as results_file:
+        json.dump({"revision": revision, "timestamp": datetime.now().isoformat(timespec="seconds"),
+                   "workers": args.workers, "threads": threads, "duration": args.duration, "steps": steps},
+                  results_file, indent=2)
+    logger.info(f"Results written to {output}")
+
+if __name__ == "__main__":
+    main()
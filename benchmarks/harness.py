@@ -0,0 +1,240 @@
+import os
+import sys
+import json
+import time
+import socket
+import random
+import logging
+import argparse
+import threading
+import subprocess
+from datetime import datetime
+from collections import defaultdict
+import requests
+
+from workloads import workloads
+from seed import reset, seed, row_counts
+from stubs import start_stubs
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+logger = logging.getLogger(__name__)
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(REPO_ROOT, "benchmarks", "results")
+
+# Service processes started by the harness: (name, directory, script, port)
+SERVICES = [
+    ("patient_service", "patient_service", "patient_service.py", 4000),
+    ("doctor_service", "doctor_service", "doctor_service.py", 5000),
+    ("medical_record_service", "medical_record_service", "medical_record_service.py", 6000),
+    ("appointment_service", "appointment_service", "appointment_service.py", 7000),
+    ("billing_service", "billing_service", "billing_service.py", 8000),
+    ("notification_service", "notification_service", "notification_service.py", 8001),
+]
+GATEWAY = ("gateway_service", "gateway_service", "gateway_service.py", 8080)
+DISPATCHER = ("outbox_dispatcher", "billing_service", "outbox_dispatcher.py", None)
+
+
+def wait_for_port(port, timeout=30.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with socket.socket() as sock:
+            if sock.connect_ex(("127.0.0.1", port)) == 0:
+                return
+        time.sleep(0.1)
+    raise RuntimeError(f"Nothing listening on port {port} after {timeout}s")
+
+# Start a service with Flask's development server ('dev') or under gunicorn
+# with the shared production settings ('gunicorn'); scripts without a port
+# (the dispatcher) always run directly
+def start_process(spec, env, log_dir, server="dev"):
+    name, directory, script, port = spec
+    log = open(os.path.join(log_dir, f"{name}.log"), "w") if log_dir else subprocess.DEVNULL
+    if server == "gunicorn" and port is not None:
+        if name == "notification_service":
+            # Its dedup cache and delivery queue live in one process
+            env = dict(env, WEB_WORKERS="1")
+        command = [sys.executable, "-m", "gunicorn", "-c", os.path.join(REPO_ROOT, "common", "gunicorn_conf.py"),
+                   "--bind", f"127.0.0.1:{port}", f"{script[:-3]}:app"]
+    else:
+        command = [sys.executable, script]
+    process = subprocess.Popen(
+        command, cwd=os.path.join(REPO_ROOT, directory),
+        env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+    if port is not None:
+        wait_for_port(port)
+    return process
+
+def git_revision():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=REPO_ROOT,
+                               capture_output=True, text=True, check=True).stdout.strip()
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+# Nearest-rank percentile of an already sorted list
+def percentile(values, fraction):
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))
+    return values[index]
+
+# Closed-loop load: each worker thread picks weighted operations until the
+# deadline. Samples taken before 'measure_from' are warm-up and discarded.
+def run_load(base_url, operations, ctx, concurrency, warmup, duration):
+    weights = [weight for weight, _, _ in operations]
+    measure_from = time.perf_counter() + warmup
+    deadline = measure_from + duration
+    samples = []
+
+    def worker():
+        session = requests.Session()
+        local = []
+        while True:
+            _, label, operation = random.choices(operations, weights)[0]
+            start = time.perf_counter()
+            if start >= deadline:
+                break
+            try:
+                status = operation(session, base_url, ctx).status_code
+            except requests.exceptions.RequestException:
+                status = 0
+            end = time.perf_counter()
+            if start >= measure_from:
+                local.append((label, end - start, status))
+        samples.extend(local)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples
+
+def summarize(samples, duration):
+    by_route = defaultdict(list)
+    for label, latency, status in samples:
+        by_route[label].append((latency, status))
+    by_route["ALL"] = [(latency, status) for _, latency, status in samples]
+
+    routes = {}
+    for label, entries in sorted(by_route.items()):
+        latencies = sorted(latency * 1000 for latency, _ in entries)
+        errors = sum(1 for _, status in entries if status == 0 or status >= 500)
+        routes[label] = {
+            "count": len(entries),
+            "rps": round(len(entries) / duration, 2),
+            "errors": errors,
+            "p50_ms": round(percentile(latencies, 0.50), 3),
+            "p95_ms": round(percentile(latencies, 0.95), 3),
+            "p99_ms": round(percentile(latencies, 0.99), 3),
+            "max_ms": round(latencies[-1], 3),
+        }
+    return routes
+
+def print_report(routes):
+    print(f"{'route':<34}{'count':>8}{'rps':>10}{'err':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for label, stats in routes.items():
+        print(f"{label:<34}{stats['count']:>8}{stats['rps']:>10.1f}{stats['errors']:>6}"
+              f"{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}{stats['p99_ms']:>10.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a scripted workload against the gateway and report per-route latency.")
+    parser.add_argument("--workload", choices=sorted(workloads), default="list-heavy")
+    parser.add_argument("--scale", type=int, default=1000, help="number of seeded patients; other tables scale with it")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=30.0, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=5.0, help="seconds of load before measuring")
+    parser.add_argument("--stub", action="store_true", help="use in-process stand-ins instead of the real services")
+    parser.add_argument("--reset", action="store_true", help="empty the service tables before seeding (use a scratch database)")
+    parser.add_argument("--no-seed", action="store_true", help="keep the data already in the database")
+    parser.add_argument("--db-host", default=os.getenv("DB_HOST", "127.0.0.1"))
+    parser.add_argument("--db-name", default=os.getenv("DB_NAME", "medical_bench"))
+    parser.add_argument("--db-user", default=os.getenv("DB_USER", "postgres"))
+    parser.add_argument("--db-password", default=os.getenv("DB_PASSWORD", ""))
+    parser.add_argument("--server", choices=["dev", "gunicorn"], default="dev", help="how to serve the services and the gateway")
+    parser.add_argument("--workers", type=int, help="gunicorn worker processes per service (default: one per core)")
+    parser.add_argument("--threads", type=int, help="gunicorn threads per worker")
+    parser.add_argument("--log-dir", help="write service logs here")
+    parser.add_argument("--output", help="results file (default: benchmarks/results/<workload>-<revision>-<time>.json)")
+    parser.add_argument("--label", default="", help="free-form note stored with the results")
+    args = parser.parse_args()
+
+    db_config = {"host": args.db_host, "dbname": args.db_name, "user": args.db_user, "password": args.db_password}
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT, DB_HOST=args.db_host, DB_NAME=args.db_name,
+               DB_USER=args.db_user, DB_PASSWORD=args.db_password,
+               NOTIFICATION_SERVICE_URL="http://127.0.0.1:8001")
+    # Every benchmark request comes from one client; don't rate limit it
+    env.setdefault("RATE_LIMITING", "false")
+    for name, _, _, port in SERVICES:
+        env[f"{name.upper()}_URLS"] = f"http://127.0.0.1:{port}"
+        env[f"{name.upper()}_URL"] = f"http://127.0.0.1:{port}"
+    if args.workers:
+        env["WEB_WORKERS"] = str(args.workers)
+    if args.threads:
+        env["WEB_THREADS"] = str(args.threads)
+    if args.log_dir:
+        os.makedirs(args.log_dir, exist_ok=True)
+
+    processes = []
+    servers = []
+    try:
+        if args.stub:
+            servers = start_stubs([port for _, _, _, port in SERVICES], args.scale)
+            ctx = {"ids": {table: (1, count) for table, count in row_counts(args.scale).items()}}
+        else:
+            for spec in SERVICES:
+                processes.append(start_process(spec, env, args.log_dir, args.server))
+            processes.append(start_process(DISPATCHER, env, args.log_dir))
+            if args.reset:
+                reset(db_config)
+            if args.no_seed:
+                ctx = {"ids": {table: (1, count) for table, count in row_counts(args.scale).items()}}
+            else:
+                logger.info(f"Seeding scale {args.scale}...")
+                ctx = seed(db_config, args.scale)
+        processes.append(start_process(GATEWAY, env, args.log_dir, args.server))
+
+        logger.info(f"Running {args.workload} with {args.concurrency} clients for {args.warmup}s warm-up + {args.duration}s...")
+        samples = run_load("http://127.0.0.1:8080", workloads[args.workload], ctx,
+                           args.concurrency, args.warmup, args.duration)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+        for server in servers:
+            server.shutdown()
+
+    routes = summarize(samples, args.duration)
+    print_report(routes)
+
+    revision = git_revision()
+    result = {
+        "revision": revision,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "workload": args.workload,
+        "mode": "stub" if args.stub else "postgres",
+        "scale": args.scale,
+        "concurrency": args.concurrency,
+        "server": args.server,
+        "workers": env.get("WEB_WORKERS") if args.server == "gunicorn" else None,
+        "threads": env.get("WEB_THREADS") if args.server == "gunicorn" else None,
+        "duration": args.duration,
+        "label": args.label,
+        "routes": routes,
+    }
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"{args.workload}-{revision}-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as results_file:
+        json.dump(result, results_file, indent=2)
+    logger.info(f"Results written to {output}")
+
+if __name__ == "__main__":
+    main()
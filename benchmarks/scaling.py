@@ -0,0 +1,69 @@
+import os
+import sys
+import json
+import argparse
+import subprocess
+import multiprocessing
+from datetime import datetime
+
+from harness import REPO_ROOT, RESULTS_DIR, git_revision
+
+# Run one workload under gunicorn with an increasing number of worker
+# processes per service and report how throughput scales, e.g.
+#
+#   python scaling.py --workload list-heavy --workers 1 2 4 8 --concurrency 32
+#
+# Each step is a full harness run (see harness.py); extra arguments after
+# '--' are passed through to it.
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure throughput as gunicorn workers are added.")
+    parser.add_argument("--workload", default="list-heavy")
+    parser.add_argument("--workers", type=int, nargs="+",
+                        help="worker counts to try (default: powers of two up to the core count)")
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=20.0)
+    parser.add_argument("--warmup", type=float, default=5.0)
+    parser.add_argument("--scale", type=int, default=1000)
+    parser.add_argument("harness_args", nargs=argparse.REMAINDER, help="extra harness arguments after '--'")
+    args = parser.parse_args()
+
+    cores = multiprocessing.cpu_count()
+    worker_counts = args.workers or [2 ** power for power in range(cores.bit_length()) if 2 ** power <= cores]
+    extra = [arg for arg in args.harness_args if arg != "--"]
+    revision = git_revision()
+    stamp = f"{datetime.now():%Y%m%d-%H%M%S}"
+
+    steps = []
+    for index, workers in enumerate(worker_counts):
+        output = os.path.join(RESULTS_DIR, f"scaling-{args.workload}-{revision}-{stamp}-w{workers}.json")
+        command = [
+            sys.executable, "harness.py", "--server", "gunicorn", "--workload", args.workload,
+            "--workers", str(workers), "--threads", str(args.threads), "--concurrency", str(args.concurrency),
+            "--duration", str(args.duration), "--warmup", str(args.warmup), "--scale", str(args.scale),
+            "--output", output, "--label", f"scaling w{workers}",
+        ]
+        # Seed once, on the first step; later steps reuse the same data
+        command += extra if index == 0 else extra + ["--no-seed"]
+        print(f"== {workers} worker(s) per service")
+        subprocess.run(command, cwd=os.path.join(REPO_ROOT, "benchmarks"), check=True)
+        with open(output) as results_file:
+            overall = json.load(results_file)["routes"]["ALL"]
+        steps.append({"workers": workers, **overall})
+
+    baseline = steps[0]["rps"] or 1.0
+    print(f"\n{args.workload} on {cores} cores, {args.threads} threads per worker, {args.concurrency} clients")
+    print(f"{'workers':>8}{'rps':>10}{'speedup':>10}{'p50 ms':>10}{'p95 ms':>10}{'errors':>8}")
+    for step in steps:
+        print(f"{step['workers']:>8}{step['rps']:>10.1f}{step['rps'] / baseline:>9.2f}x"
+              f"{step['p50_ms']:>10.2f}{step['p95_ms']:>10.2f}{step['errors']:>8}")
+
+    summary = os.path.join(RESULTS_DIR, f"scaling-{args.workload}-{revision}-{stamp}.json")
+    with open(summary, "w") as summary_file:
+        json.dump({"revision": revision, "workload": args.workload, "cores": cores,
+                   "threads": args.threads, "concurrency": args.concurrency, "steps": steps}, summary_file, indent=2)
+    print(f"\nSummary written to {summary}")
+
+if __name__ == "__main__":
+    main()
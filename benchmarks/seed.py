@@ -0,0 +1,116 @@
+import os
+import sys
+import random
+import logging
+from datetime import datetime, timedelta
+import psycopg2
+from psycopg2.extras import RealDictCursor, execute_values
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'billing_service'))
+from aggregates import rebuild_aggregates
+
+logger = logging.getLogger(__name__)
+
+# Tables owned by the services, emptied by --reset before seeding
+SERVICE_TABLES = [
+    "patients", "doctors", "medical_records", "appointments", "bills",
+    "notification_outbox", "patient_balances", "daily_billing_summary",
+    "archived_patient_balances", "archived_daily_billing_summary",
+]
+
+SPECIALTIES = ["Cardiology", "Dermatology", "Neurology", "Pediatrics", "Orthopedics", "General Practice"]
+STATUSES = ["Scheduled", "Confirmed", "Completed", "Cancelled"]
+
+# Number of rows per table for a given scale (number of patients)
+def row_counts(scale):
+    return {
+        'patients': scale,
+        'doctors': max(10, scale // 50),
+        'appointments': scale * 5,
+        'medical_records': scale * 3,
+        'bills': scale * 2,
+    }
+
+def connect(db_config):
+    return psycopg2.connect(cursor_factory=RealDictCursor, **db_config)
+
+def reset(db_config):
+    conn = connect(db_config)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT tablename FROM pg_tables WHERE tablename = ANY(%s);", (SERVICE_TABLES,))
+        tables = [row['tablename'] for row in cursor.fetchall()]
+        if tables:
+            cursor.execute(f"TRUNCATE {', '.join(tables)} RESTART IDENTITY;")
+        conn.commit()
+    finally:
+        conn.close()
+
+def random_timestamp(days_back, days_ahead):
+    return datetime.now() + timedelta(days=random.uniform(-days_back, days_ahead))
+
+# Fill every service table with synthetic rows and return the id range of each
+# table, which the workloads use to pick existing rows
+def seed(db_config, scale, seed_value=42):
+    random.seed(seed_value)
+    counts = row_counts(scale)
+    conn = connect(db_config)
+    try:
+        cursor = conn.cursor()
+        execute_values(cursor, "INSERT INTO patients (name, age, contract_info) VALUES %s", [
+            (f"Patient {i}", random.randint(1, 95), f"patient{i}@example.com")
+            for i in range(counts['patients'])
+        ], page_size=5000)
+        execute_values(cursor, "INSERT INTO doctors (name, specialty, experience_years) VALUES %s", [
+            (f"Doctor {i}", random.choice(SPECIALTIES), random.randint(1, 40))
+            for i in range(counts['doctors'])
+        ], page_size=5000)
+        ids = {}
+        for table in ('patients', 'doctors'):
+            cursor.execute(f"SELECT MIN(id) AS low, MAX(id) AS high FROM {table};")
+            row = cursor.fetchone()
+            ids[table] = (row['low'], row['high'])
+
+        def patient():
+            return random.randint(*ids['patients'])
+
+        def doctor():
+            return random.randint(*ids['doctors'])
+
+        execute_values(cursor, "INSERT INTO appointments (patient_id, doctor_id, appointment_date, status) VALUES %s", [
+            (patient(), doctor(), random_timestamp(365, 60), random.choice(STATUSES))
+            for _ in range(counts['appointments'])
+        ], page_size=5000)
+        execute_values(cursor, "INSERT INTO medical_records (patient_id, doctor_id, diagnosis, treatment, record_date) VALUES %s", [
+            (patient(), doctor(), "Seasonal influenza", "Rest and fluids", random_timestamp(365, 0))
+            for _ in range(counts['medical_records'])
+        ], page_size=5000)
+        cursor.execute("SELECT MIN(id) AS low, MAX(id) AS high FROM appointments;")
+        row = cursor.fetchone()
+        ids['appointments'] = (row['low'], row['high'])
+
+        bills = []
+        for _ in range(counts['bills']):
+            patient_id = patient()
+            issued = random_timestamp(365, 0)
+            paid = random.random() < 0.6
+            bills.append((
+                patient_id, random.randint(*ids['appointments']), round(random.uniform(20, 400), 2),
+                f"patient{patient_id}@example.com", "Paid" if paid else "Pending",
+                issued, issued + timedelta(days=random.randint(0, 30)) if paid else None
+            ))
+        execute_values(cursor, "INSERT INTO bills (patient_id, appointment_id, amount, email, status, issued_date, paid_date) VALUES %s", bills, page_size=5000)
+
+        for table in ('medical_records', 'bills'):
+            cursor.execute(f"SELECT MIN(id) AS low, MAX(id) AS high FROM {table};")
+            row = cursor.fetchone()
+            ids[table] = (row['low'], row['high'])
+
+        # Bills were inserted behind the billing service's back, so rebuild its summaries
+        rebuild_aggregates(cursor)
+        conn.commit()
+    finally:
+        conn.close()
+
+    logger.info(f"Seeded {counts}")
+    return {'ids': ids, 'counts': counts}
@@ -0,0 +1,77 @@
+import os
+import sys
+import json
+import timeit
+import argparse
+from datetime import datetime
+
+from harness import REPO_ROOT, RESULTS_DIR, git_revision
+from stubs import canned_rows
+
+sys.path.insert(0, REPO_ROOT)
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+from common import codec
+
+# Encode/decode CPU time and payload size of the internal codecs for the
+# list responses the gateway fetches most, e.g.
+#
+#   python serialization.py --scale 5000 --lists /patients /medical_records /bills
+#
+# 'json' is what jsonify() produces and requests' response.json() parses;
+# 'msgpack' is common/codec.py. Times are the best of --repeat runs.
+
+def codecs():
+    provider = DefaultJSONProvider(Flask("codecs"))
+    available = {"json": (lambda data: provider.dumps(data).encode(), json.loads)}
+    if codec.msgpack is not None:
+        available["msgpack"] = (codec.encode, codec.decode)
+    return available
+
+def best_ms(function, repeat):
+    number = 1
+    while timeit.timeit(function, number=number) < 0.05 and number < 10 ** 6:
+        number *= 4
+    return min(timeit.repeat(function, number=number, repeat=repeat)) / number * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare internal codecs on typical list responses.")
+    parser.add_argument("--scale", type=int, default=1000)
+    parser.add_argument("--lists", nargs="+", default=["/patients", "/medical_records", "/bills"])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="results file (default: benchmarks/results/serialization-<revision>-<time>.json)")
+    args = parser.parse_args()
+
+    rows = canned_rows(args.scale)
+    available = codecs()
+    if "msgpack" not in available:
+        print("msgpack is not installed; only measuring json")
+
+    results = []
+    print(f"{'list':<18}{'rows':>8}{'codec':>9}{'bytes':>12}{'size':>8}{'encode ms':>12}{'decode ms':>12}")
+    for path in args.lists:
+        data = rows[path]
+        baseline = None
+        for name, (encode, decode) in available.items():
+            body = encode(data)
+            if decode(body) != json.loads(json.dumps(data)):
+                raise SystemExit(f"{name} does not round-trip {path}")
+            result = {
+                "list": path, "rows": len(data), "codec": name, "bytes": len(body),
+                "encode_ms": best_ms(lambda: encode(data), args.repeat),
+                "decode_ms": best_ms(lambda: decode(body), args.repeat),
+            }
+            baseline = baseline or result
+            results.append(result)
+            print(f"{path:<18}{len(data):>8}{name:>9}{len(body):>12}{len(body) / baseline['bytes']:>7.0%}"
+                  f"{result['encode_ms']:>12.3f}{result['decode_ms']:>12.3f}")
+
+    revision = git_revision()
+    output = args.output or os.path.join(RESULTS_DIR, f"serialization-{revision}-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as results_file:
+        json.dump({"revision": revision, "scale": args.scale, "results": results}, results_file, indent=2)
+    print(f"\nResults written to {output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+import json
+import random
+import threading
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from seed import row_counts, SPECIALTIES, STATUSES
+
+# In-process stand-ins for the five data services and the notification
+# service. They answer every route the gateway calls with canned JSON of the
+# seeded size, so the gateway can be measured without Postgres or the real
+# services behind it. Like the real services, they answer in MessagePack
+# when asked for 'application/msgpack' (see common/codec.py).
+
+def http_date(value):
+    return value.strftime("%a, %d %b %Y %H:%M:%S GMT")
+
+# Rows of each list, shaped like the services' JSON
+def canned_rows(scale):
+    random.seed(42)
+    counts = row_counts(scale)
+    now = datetime.now()
+    rows = {
+        '/patients': [
+            {"id": i, "name": f"Patient {i}", "age": random.randint(1, 95), "contract_info": f"patient{i}@example.com"}
+            for i in range(1, counts['patients'] + 1)
+        ],
+        '/doctors': [
+            {"id": i, "name": f"Doctor {i}", "specialty": random.choice(SPECIALTIES), "experience_years": random.randint(1, 40)}
+            for i in range(1, counts['doctors'] + 1)
+        ],
+        '/appointments': [
+            {"id": i, "patient_id": random.randint(1, counts['patients']), "doctor_id": random.randint(1, counts['doctors']),
+             "appointment_date": http_date(now + timedelta(days=random.uniform(-365, 60))), "status": random.choice(STATUSES)}
+            for i in range(1, counts['appointments'] + 1)
+        ],
+        '/medical_records': [
+            {"id": i, "patient_id": random.randint(1, counts['patients']), "doctor_id": random.randint(1, counts['doctors']),
+             "diagnosis": "Seasonal influenza", "treatment": "Rest and fluids", "record_date": http_date(now)}
+            for i in range(1, counts['medical_records'] + 1)
+        ],
+        '/bills': [
+            {"id": i, "patient_id": random.randint(1, counts['patients']), "appointment_id": i, "amount": "120.00",
+             "email": "patient@example.com", "status": "Pending", "issued_date": http_date(now), "paid_date": None}
+            for i in range(1, counts['bills'] + 1)
+        ],
+    }
+    return rows
+
+def canned_lists(scale):
+    rows = canned_rows(scale)
+    lists = {path: {"application/json": json.dumps(body).encode()} for path, body in rows.items()}
+    if msgpack is not None:
+        for path, body in rows.items():
+            lists[path]["application/msgpack"] = msgpack.packb(body)
+    return lists
+
+def make_handler(lists):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def reply(self, status, body, content_type="application/json"):
+            if not isinstance(body, bytes):
+                body = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # Canned lists come pre-encoded in each content type
+        def reply_list(self, encodings):
+            content_type = "application/json"
+            if "application/msgpack" in encodings and "application/msgpack" in self.headers.get("Accept", ""):
+                content_type = "application/msgpack"
+            self.reply(200, encodings[content_type], content_type)
+
+        def read_body(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            return self.rfile.read(length) if length else b""
+
+        def do_GET(self):
+            path = self.path.split("?", 1)[0]
+            if path in lists:
+                self.reply_list(lists[path])
+            elif path.endswith("/balance"):
+                self.reply(200, {"patient_id": 1, "bill_count": 2, "billed_amount": "240.00", "paid_amount": "120.00", "outstanding_amount": "120.00"})
+            elif path == "/bills/summary":
+                self.reply(200, [{"period": "2026-01-01", "issued_count": 10, "issued_amount": "1200.00", "paid_count": 5, "paid_amount": "600.00"}])
+            else:
+                self.reply(404, {"error": "Not found"})
+
+        def do_POST(self):
+            self.read_body()
+            if self.path.startswith("/send-notification"):
+                self.reply(202 if self.path == "/send-notifications" else 200, {"message": "Notifications queued", "rejected": []})
+            else:
+                self.reply(201, {"id": random.randint(1, 10 ** 6), "message": "Created successfully"})
+
+        def do_PUT(self):
+            self.read_body()
+            self.reply(200, {"message": "Updated successfully", "updated": 1, "missing": []})
+
+        def do_DELETE(self):
+            self.reply(200, {"message": "Deleted successfully"})
+
+    return StubHandler
+
+# Start one stand-in server per port in background threads; returns the servers
+def start_stubs(ports, scale):
+    handler = make_handler(canned_lists(scale))
+    servers = []
+    for port in ports:
+        server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    return servers
@@ -0,0 +1,123 @@
+import sys
+import json
+import argparse
+import threading
+from collections import defaultdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Local stand-in for a trace collector, and a report that breaks the slowest
+# traces down by component.
+#
+#   python traces.py collect --port 4318 --output spans.jsonl
+#   python traces.py report spans.jsonl --top 5
+#
+# Services send spans here when started with
+# TRACE_COLLECTOR_URL=http://127.0.0.1:4318/spans, or write the same JSON
+# lines themselves with TRACE_FILE=spans.jsonl.
+
+def collect(port, output):
+    lock = threading.Lock()
+
+    class CollectorHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            spans = json.loads(self.rfile.read(length) or b"{}").get("spans", [])
+            with lock, open(output, "a") as spans_file:
+                spans_file.write("".join(json.dumps(span) + "\n" for span in spans))
+            self.send_response(204)
+            self.end_headers()
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), CollectorHandler)
+    print(f"Collecting spans on http://127.0.0.1:{port}/spans into {output}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+def load_traces(path):
+    traces = defaultdict(list)
+    with open(path) as spans_file:
+        for line in spans_file:
+            if line.strip():
+                span = json.loads(line)
+                traces[span["trace_id"]].append(span)
+    return traces
+
+def print_tree(spans):
+    children = defaultdict(list)
+    ids = {span["span_id"] for span in spans}
+    for span in spans:
+        children[span["parent_id"] if span["parent_id"] in ids else None].append(span)
+
+    def walk(parent_id, depth):
+        for span in sorted(children[parent_id], key=lambda span: span["start"]):
+            offset = (span["start"] - spans_start) * 1000
+            detail = span["attributes"].get("statement") or span["attributes"].get("http.url") or ""
+            print(f"  {offset:>9.2f} {span['duration_ms']:>9.2f}  {'  ' * depth}{span['service']}: {span['name']}"
+                  f"{'  [' + span['status'] + ']' if span['status'] != 'ok' else ''}  {detail[:80]}")
+            walk(span["span_id"], depth + 1)
+
+    spans_start = min(span["start"] for span in spans)
+    print(f"  {'start ms':>9} {'dur ms':>9}  span")
+    walk(None, 0)
+
+# Time spent per service and span kind in each trace, excluding time spent in
+# child spans, so that the components add up to the whole request
+def self_times(spans):
+    child_time = defaultdict(float)
+    for span in spans:
+        if span["parent_id"]:
+            child_time[span["parent_id"]] += span["duration_ms"]
+    totals = defaultdict(float)
+    for span in spans:
+        totals[f"{span['service']} {span['kind']}"] += max(0.0, span["duration_ms"] - child_time[span["span_id"]])
+    return totals
+
+def report(path, top, name):
+    traces = load_traces(path)
+    roots = []
+    for spans in traces.values():
+        for span in spans:
+            if span["parent_id"] is None and (name is None or span["name"] == name):
+                roots.append((span, spans))
+    roots.sort(key=lambda entry: entry[0]["duration_ms"], reverse=True)
+    if not roots:
+        print("No matching traces")
+        return 1
+
+    components = defaultdict(float)
+    for _, spans in roots:
+        for component, duration in self_times(spans).items():
+            components[component] += duration
+    total = sum(components.values()) or 1.0
+    print(f"{len(roots)} traces; time by component (self time):")
+    for component, duration in sorted(components.items(), key=lambda item: -item[1]):
+        print(f"  {component:<40}{duration / len(roots):>10.2f} ms avg {duration / total * 100:>6.1f}%")
+
+    for root, spans in roots[:top]:
+        print(f"\n{root['service']}: {root['name']}  {root['duration_ms']:.2f} ms  request {root.get('request_id')}  trace {root['trace_id']}")
+        print_tree(spans)
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Collect spans and report on the slowest traces.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    collect_parser = commands.add_parser("collect", help="run a local span collector")
+    collect_parser.add_argument("--port", type=int, default=4318)
+    collect_parser.add_argument("--output", default="spans.jsonl")
+    report_parser = commands.add_parser("report", help="break the slowest traces down by component")
+    report_parser.add_argument("spans")
+    report_parser.add_argument("--top", type=int, default=5, help="number of slowest traces to print in full")
+    report_parser.add_argument("--name", help="only traces whose root span has this name, e.g. 'POST /bills'")
+    args = parser.parse_args()
+
+    if args.command == "collect":
+        collect(args.port, args.output)
+        return 0
+    return report(args.spans, args.top, args.name)
+
+if __name__ == "__main__":
+    sys.exit(main())
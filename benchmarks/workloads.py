@@ -0,0 +1,113 @@
+import random
+from datetime import datetime, timedelta
+
+# Scripted workloads for the load harness. Each workload is a list of
+# (weight, route label, operation); an operation takes the HTTP session, the
+# gateway base URL and the seeded data context and returns the response.
+# Route labels use the templated path so results group per route.
+
+def random_id(ctx, table):
+    low, high = ctx['ids'][table]
+    return random.randint(low, high)
+
+def random_day(days_back=365, days_ahead=60):
+    day = datetime.now() + timedelta(days=random.randint(-days_back, days_ahead))
+    return day.replace(hour=random.randint(8, 17), minute=random.choice((0, 15, 30, 45)), second=0, microsecond=0)
+
+def list_patients(session, base, ctx):
+    return session.get(f"{base}/patients")
+
+def list_doctors(session, base, ctx):
+    return session.get(f"{base}/doctors")
+
+def list_medical_records(session, base, ctx):
+    return session.get(f"{base}/medical_records")
+
+def list_appointments(session, base, ctx):
+    return session.get(f"{base}/appointments")
+
+def list_bills(session, base, ctx):
+    return session.get(f"{base}/bills")
+
+def list_appointments_for_week(session, base, ctx):
+    start = random_day().date()
+    return session.get(f"{base}/appointments", params={"from": start.isoformat(), "to": (start + timedelta(days=7)).isoformat()})
+
+def book_appointment(session, base, ctx):
+    return session.post(f"{base}/appointments", json={
+        "patient_id": random_id(ctx, 'patients'),
+        "doctor_id": random_id(ctx, 'doctors'),
+        "appointment_date": random_day(days_back=0).isoformat(sep=' ')
+    })
+
+def update_appointment_status(session, base, ctx):
+    appointment_id = random_id(ctx, 'appointments')
+    return session.put(f"{base}/appointments/{appointment_id}/status", json={
+        "status": random.choice(("Confirmed", "Completed", "Cancelled"))
+    })
+
+def add_medical_record(session, base, ctx):
+    return session.post(f"{base}/medical_records", json={
+        "patient_id": random_id(ctx, 'patients'),
+        "doctor_id": random_id(ctx, 'doctors'),
+        "diagnosis": "Routine check-up",
+        "treatment": "Rest and fluids"
+    })
+
+def create_bill(session, base, ctx):
+    patient_id = random_id(ctx, 'patients')
+    return session.post(f"{base}/bills", json={
+        "patient_id": patient_id,
+        "appointment_id": random_id(ctx, 'appointments'),
+        "amount": round(random.uniform(20, 400), 2),
+        "email": f"patient{patient_id}@example.com"
+    })
+
+def pay_bill(session, base, ctx):
+    bill_id = random_id(ctx, 'bills')
+    return session.put(f"{base}/bills/{bill_id}/status", json={
+        "status": "Paid",
+        "paid_date": datetime.now().isoformat(sep=' ', timespec='seconds')
+    })
+
+def settle_bills(session, base, ctx):
+    low, high = ctx['ids']['bills']
+    start = random.randint(low, max(low, high - 500))
+    return session.put(f"{base}/bills/status", json={
+        "status": "Paid",
+        "paid_date": datetime.now().isoformat(sep=' ', timespec='seconds'),
+        "ids": list(range(start, min(high, start + 500) + 1))
+    })
+
+def bills_summary(session, base, ctx):
+    return session.get(f"{base}/bills/summary", params={"group_by": random.choice(("day", "month"))})
+
+def patient_balance(session, base, ctx):
+    return session.get(f"{base}/patients/{random_id(ctx, 'patients')}/balance")
+
+workloads = {
+    # Dashboards and clinic screens pulling full lists
+    'list-heavy': [
+        (30, "GET /patients", list_patients),
+        (20, "GET /doctors", list_doctors),
+        (20, "GET /appointments", list_appointments),
+        (20, "GET /medical_records", list_medical_records),
+        (10, "GET /bills", list_bills),
+    ],
+    # Peak booking window at reception
+    'booking-heavy': [
+        (55, "POST /appointments", book_appointment),
+        (20, "PUT /appointments/<id>/status", update_appointment_status),
+        (10, "POST /medical_records", add_medical_record),
+        (10, "GET /appointments?from&to", list_appointments_for_week),
+        (5, "GET /doctors", list_doctors),
+    ],
+    # Month-end billing run: bill creation, payments and settlement files
+    'billing-month-end': [
+        (50, "POST /bills", create_bill),
+        (25, "PUT /bills/<id>/status", pay_bill),
+        (2, "PUT /bills/status", settle_bills),
+        (13, "GET /patients/<id>/balance", patient_balance),
+        (10, "GET /bills/summary", bills_summary),
+    ],
+}
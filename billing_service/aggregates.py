@@ -0,0 +1,177 @@
+from collections import defaultdict
+from decimal import Decimal
+from psycopg2.extras import execute_values
+
+# Summary tables kept in step with 'bills' by create_bill, update_bill_status
+# and delete_bill, so balances and revenue never need a scan of 'bills'.
+#
+# patient_balances: one row per patient with totals over all their bills.
+# daily_billing_summary: one row per day with bills issued that day and bills
+# paid that day (by paid_date, or issued_date for bills paid without a date).
+AGGREGATE_TABLES = """
+    CREATE TABLE IF NOT EXISTS patient_balances (
+        patient_id INTEGER PRIMARY KEY,
+        bill_count INTEGER NOT NULL DEFAULT 0,
+        billed_amount DECIMAL(14, 2) NOT NULL DEFAULT 0,
+        paid_amount DECIMAL(14, 2) NOT NULL DEFAULT 0,
+        outstanding_amount DECIMAL(14, 2) NOT NULL DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS daily_billing_summary (
+        day DATE PRIMARY KEY,
+        issued_count INTEGER NOT NULL DEFAULT 0,
+        issued_amount DECIMAL(14, 2) NOT NULL DEFAULT 0,
+        paid_count INTEGER NOT NULL DEFAULT 0,
+        paid_amount DECIMAL(14, 2) NOT NULL DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS archived_patient_balances (LIKE patient_balances INCLUDING ALL);
+    CREATE TABLE IF NOT EXISTS archived_daily_billing_summary (LIKE daily_billing_summary INCLUDING ALL);
+"""
+
+# Totals over the bills in 'source' (the bills table or one of its partitions)
+def patient_balance_totals(source):
+    return f"""
+        SELECT patient_id,
+               COUNT(*) AS bill_count,
+               SUM(amount) AS billed_amount,
+               COALESCE(SUM(amount) FILTER (WHERE LOWER(status) = 'paid'), 0) AS paid_amount,
+               COALESCE(SUM(amount) FILTER (WHERE LOWER(status) <> 'paid' OR status IS NULL), 0) AS outstanding_amount
+        FROM {source}
+        GROUP BY patient_id
+    """
+
+def daily_summary_totals(source):
+    return f"""
+        SELECT day,
+               SUM(issued_count) AS issued_count,
+               SUM(issued_amount) AS issued_amount,
+               SUM(paid_count) AS paid_count,
+               SUM(paid_amount) AS paid_amount
+        FROM (
+            SELECT issued_date::date AS day, 1 AS issued_count, amount AS issued_amount, 0 AS paid_count, 0 AS paid_amount
+            FROM {source}
+            UNION ALL
+            SELECT COALESCE(paid_date, issued_date)::date, 0, 0, 1, amount
+            FROM {source}
+            WHERE LOWER(status) = 'paid'
+        ) contributions
+        GROUP BY day
+    """
+
+# The summaries computed from scratch, used for backfills and reconciliation.
+# Bills archived out of the table (see manage_partitions.py) keep counting
+# through the archived_* tables.
+EXPECTED_PATIENT_BALANCES = f"""
+    SELECT patient_id,
+           SUM(bill_count) AS bill_count,
+           SUM(billed_amount) AS billed_amount,
+           SUM(paid_amount) AS paid_amount,
+           SUM(outstanding_amount) AS outstanding_amount
+    FROM ({patient_balance_totals('bills')} UNION ALL SELECT * FROM archived_patient_balances) totals
+    GROUP BY patient_id
+"""
+
+EXPECTED_DAILY_SUMMARY = f"""
+    SELECT day,
+           SUM(issued_count) AS issued_count,
+           SUM(issued_amount) AS issued_amount,
+           SUM(paid_count) AS paid_count,
+           SUM(paid_amount) AS paid_amount
+    FROM ({daily_summary_totals('bills')} UNION ALL SELECT * FROM archived_daily_billing_summary) totals
+    GROUP BY day
+"""
+
+def is_paid(status):
+    return status is not None and status.lower() == 'paid'
+
+# Create the summary tables, filling them from 'bills' the first time
+def create_aggregate_tables(cursor):
+    cursor.execute("SELECT to_regclass('patient_balances') IS NOT NULL AS present;")
+    present = cursor.fetchone()['present']
+    cursor.execute(AGGREGATE_TABLES)
+    if not present:
+        rebuild_aggregates(cursor)
+
+# Replace the summary tables with totals recomputed from 'bills'
+def rebuild_aggregates(cursor):
+    cursor.execute("LOCK TABLE bills IN SHARE MODE;")
+    cursor.execute("DELETE FROM patient_balances;")
+    cursor.execute("DELETE FROM daily_billing_summary;")
+    cursor.execute(f"""
+        INSERT INTO patient_balances (patient_id, bill_count, billed_amount, paid_amount, outstanding_amount)
+        {EXPECTED_PATIENT_BALANCES};
+    """)
+    cursor.execute(f"""
+        INSERT INTO daily_billing_summary (day, issued_count, issued_amount, paid_count, paid_amount)
+        {EXPECTED_DAILY_SUMMARY};
+    """)
+
+# Apply the effect of bills disappearing ('removed') and appearing ('added')
+# to the summary tables. Each bill is a dict with patient_id, amount, status,
+# issued_date and paid_date; a status change is the old row removed and the
+# new row added. Deltas are merged per key and written with one upsert per table.
+def apply_bill_changes(cursor, removed=(), added=()):
+    balances = defaultdict(lambda: [0, Decimal(0), Decimal(0), Decimal(0)])
+    days = defaultdict(lambda: [0, Decimal(0), 0, Decimal(0)])
+
+    for sign, bills in ((-1, removed), (1, added)):
+        for bill in bills:
+            amount = Decimal(bill['amount']) * sign
+            paid = is_paid(bill['status'])
+
+            balance = balances[bill['patient_id']]
+            balance[0] += sign
+            balance[1] += amount
+            if paid:
+                balance[2] += amount
+            else:
+                balance[3] += amount
+
+            issued = days[bill['issued_date'].date()]
+            issued[0] += sign
+            issued[1] += amount
+            if paid:
+                paid_day = days[(bill['paid_date'] or bill['issued_date']).date()]
+                paid_day[2] += sign
+                paid_day[3] += amount
+
+    if balances:
+        execute_values(cursor, """
+            INSERT INTO patient_balances (patient_id, bill_count, billed_amount, paid_amount, outstanding_amount)
+            VALUES %s
+            ON CONFLICT (patient_id) DO UPDATE SET
+                bill_count = patient_balances.bill_count + EXCLUDED.bill_count,
+                billed_amount = patient_balances.billed_amount + EXCLUDED.billed_amount,
+                paid_amount = patient_balances.paid_amount + EXCLUDED.paid_amount,
+                outstanding_amount = patient_balances.outstanding_amount + EXCLUDED.outstanding_amount;
+        """, sorted((key, *values) for key, values in balances.items()))
+
+    if days:
+        execute_values(cursor, """
+            INSERT INTO daily_billing_summary (day, issued_count, issued_amount, paid_count, paid_amount)
+            VALUES %s
+            ON CONFLICT (day) DO UPDATE SET
+                issued_count = daily_billing_summary.issued_count + EXCLUDED.issued_count,
+                issued_amount = daily_billing_summary.issued_amount + EXCLUDED.issued_amount,
+                paid_count = daily_billing_summary.paid_count + EXCLUDED.paid_count,
+                paid_amount = daily_billing_summary.paid_amount + EXCLUDED.paid_amount;
+        """, sorted((key, *values) for key, values in days.items()))
+
+# Carry the totals of a bills partition that is about to be archived over
+# into the archived_* tables, so reconciliation still accounts for them
+def archive_bill_totals(cursor, partition):
+    cursor.execute(f"""
+        INSERT INTO archived_patient_balances {patient_balance_totals(partition)}
+        ON CONFLICT (patient_id) DO UPDATE SET
+            bill_count = archived_patient_balances.bill_count + EXCLUDED.bill_count,
+            billed_amount = archived_patient_balances.billed_amount + EXCLUDED.billed_amount,
+            paid_amount = archived_patient_balances.paid_amount + EXCLUDED.paid_amount,
+            outstanding_amount = archived_patient_balances.outstanding_amount + EXCLUDED.outstanding_amount;
+    """)
+    cursor.execute(f"""
+        INSERT INTO archived_daily_billing_summary {daily_summary_totals(partition)}
+        ON CONFLICT (day) DO UPDATE SET
+            issued_count = archived_daily_billing_summary.issued_count + EXCLUDED.issued_count,
+            issued_amount = archived_daily_billing_summary.issued_amount + EXCLUDED.issued_amount,
+            paid_count = archived_daily_billing_summary.paid_count + EXCLUDED.paid_count,
+            paid_amount = archived_daily_billing_summary.paid_amount + EXCLUDED.paid_amount;
+    """)
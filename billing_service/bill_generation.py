@@ -0,0 +1,166 @@
+import os
+import logging
+import requests
+from psycopg2.extras import execute_values
+from common import codec
+from common.references import DEFAULT_URLS
+from common.appointment_statuses import COMPLETED_STATUSES
+from aggregates import apply_bill_changes
+
+logger = logging.getLogger(__name__)
+
+# Bills for completed appointments, generated in bulk for a period (e.g. a
+# month) instead of one create_bill call at a time. Completed appointments
+# are read from the appointment service a chunk at a time in id order; the
+# amount comes from specialty_prices by the doctor's specialty and the
+# address from the patient's contact info. Each chunk's bills, their
+# summary updates, their notification outbox entries and the run's
+# checkpoint commit together, so an interrupted run picks up after the last
+# chunk it finished, and appointments that already have a bill are skipped.
+BILL_GENERATION_CHUNK_SIZE = int(os.getenv('BILL_GENERATION_CHUNK_SIZE', '1000'))
+SERVICE_REQUEST_TIMEOUT = float(os.getenv('SERVICE_REQUEST_TIMEOUT', '30'))
+# Patient ids per GET /patients?ids=... call, so the URL stays under the
+# 4094-byte request line gunicorn accepts (an id and its encoded comma take
+# at most 13 bytes)
+PATIENT_LOOKUP_SIZE = 250
+
+
+def create_bill_generation_tables(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS specialty_prices (
+            specialty VARCHAR(100) PRIMARY KEY,
+            amount DECIMAL(10, 2) NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS bill_generation_runs (
+            period_start DATE NOT NULL,
+            period_end DATE NOT NULL,
+            last_appointment_id INTEGER NOT NULL DEFAULT 0,
+            appointments_seen INTEGER NOT NULL DEFAULT 0,
+            bills_created INTEGER NOT NULL DEFAULT 0,
+            started_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP,
+            PRIMARY KEY (period_start, period_end)
+        );
+        CREATE INDEX IF NOT EXISTS bills_appointment_idx ON bills (appointment_id);
+    """)
+
+
+# Reads from the patient, doctor and appointment services (<SERVICE>_URL)
+class ServiceClient:
+    def __init__(self):
+        self.session = requests.Session()
+        self.urls = {service: os.getenv(f"{service.upper()}_URL", url) for service, url in DEFAULT_URLS.items()}
+
+    def get(self, service, path, **params):
+        response = self.session.get(self.urls[service] + path, params=params, headers=codec.request_headers(),
+                                    timeout=SERVICE_REQUEST_TIMEOUT)
+        response.raise_for_status()
+        return codec.decode_response(response)
+
+    def doctor_specialties(self):
+        return {doctor['id']: doctor['specialty'] for doctor in self.get('doctor_service', '/doctors')}
+
+    def completed_appointments(self, start, end, after_id, limit):
+        return self.get('appointment_service', '/appointments', status=list(COMPLETED_STATUSES),
+                        after_id=after_id, limit=limit, **{'from': start, 'to': end})
+
+    def patient_addresses(self, patient_ids):
+        patient_ids = sorted(patient_ids)
+        addresses = {}
+        for start in range(0, len(patient_ids), PATIENT_LOOKUP_SIZE):
+            group = patient_ids[start:start + PATIENT_LOOKUP_SIZE]
+            patients = self.get('patient_service', '/patients', ids=','.join(str(patient_id) for patient_id in group))
+            addresses.update({patient['id']: patient['contract_info'] for patient in patients if patient.get('contract_info')})
+        return addresses
+
+
+# Insert bills for (appointment_id, patient_id, specialty, email) rows in one
+# statement, skipping appointments that already have a bill and specialties
+# without a price, and queue a notification for each. Returns the new bills.
+def insert_bills(cursor, rows):
+    bills = execute_values(cursor, """
+        WITH completed (appointment_id, patient_id, specialty, email) AS (VALUES %s)
+        INSERT INTO bills (patient_id, appointment_id, amount, email)
+        SELECT completed.patient_id, completed.appointment_id, prices.amount, completed.email
+        FROM completed JOIN specialty_prices prices ON prices.specialty = completed.specialty
+        WHERE NOT EXISTS (SELECT 1 FROM bills WHERE bills.appointment_id = completed.appointment_id)
+        RETURNING *;
+    """, rows, template="(%s::integer, %s::integer, %s::varchar, %s::varchar)", page_size=len(rows), fetch=True)
+    if bills:
+        apply_bill_changes(cursor, added=bills)
+        execute_values(cursor, "INSERT INTO notification_outbox (bill_id, email, amount) VALUES %s;",
+                       [(bill['id'], bill['email'], bill['amount']) for bill in bills], page_size=len(bills))
+    return bills
+
+
+# Generate the bills for appointments completed with start <= date < end.
+# Returns the run's row from bill_generation_runs. An unfinished run
+# continues from its checkpoint unless 'restart' is set.
+def generate_bills(conn, client, start, end, chunk_size=BILL_GENERATION_CHUNK_SIZE, restart=False):
+    cursor = conn.cursor()
+    # One run per period at a time; the lock is released with the session
+    cursor.execute("SELECT pg_try_advisory_lock(hashtext('bill_generation'), hashtext(%s)) AS locked;", (f"{start}/{end}",))
+    if not cursor.fetchone()['locked']:
+        conn.rollback()
+        raise RuntimeError(f"Bills for {start} to {end} are already being generated")
+    try:
+        cursor.execute("""
+            INSERT INTO bill_generation_runs (period_start, period_end) VALUES (%s, %s)
+            ON CONFLICT (period_start, period_end) DO NOTHING;
+            SELECT * FROM bill_generation_runs WHERE period_start = %s AND period_end = %s;
+        """, (start, end, start, end))
+        run = cursor.fetchone()
+        # Appointments can be completed in any id order, so after a finished
+        # run the whole period is gone over again
+        if restart or run['finished_at'] is not None:
+            cursor.execute("""
+                UPDATE bill_generation_runs SET last_appointment_id = 0, appointments_seen = 0, bills_created = 0,
+                    started_at = NOW(), updated_at = NOW(), finished_at = NULL
+                WHERE period_start = %s AND period_end = %s RETURNING *;
+            """, (start, end))
+            run = cursor.fetchone()
+        conn.commit()
+        after_id = run['last_appointment_id']
+        if after_id:
+            logger.info(f"Resuming bill generation for {start} to {end} after appointment {after_id}")
+
+        specialties = client.doctor_specialties()
+        while True:
+            appointments = client.completed_appointments(start, end, after_id, chunk_size)
+            if not appointments:
+                break
+            addresses = client.patient_addresses({appointment['patient_id'] for appointment in appointments})
+            rows = [
+                (appointment['id'], appointment['patient_id'], specialties.get(appointment['doctor_id']),
+                 addresses.get(appointment['patient_id']))
+                for appointment in appointments
+                if appointment['doctor_id'] in specialties and appointment['patient_id'] in addresses
+            ]
+            bills = insert_bills(cursor, rows) if rows else []
+            after_id = appointments[-1]['id']
+            cursor.execute("""
+                UPDATE bill_generation_runs
+                SET last_appointment_id = %s, appointments_seen = appointments_seen + %s,
+                    bills_created = bills_created + %s, updated_at = NOW()
+                WHERE period_start = %s AND period_end = %s;
+            """, (after_id, len(appointments), len(bills), start, end))
+            conn.commit()
+            logger.info(f"Billed {len(bills)} of {len(appointments)} completed appointments up to id {after_id}")
+            if len(appointments) < chunk_size:
+                break
+
+        cursor.execute("""
+            UPDATE bill_generation_runs SET finished_at = NOW(), updated_at = NOW()
+            WHERE period_start = %s AND period_end = %s RETURNING *;
+        """, (start, end))
+        run = cursor.fetchone()
+        conn.commit()
+        return run
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.execute("SELECT pg_advisory_unlock(hashtext('bill_generation'), hashtext(%s));", (f"{start}/{end}",))
+        conn.commit()
+        cursor.close()
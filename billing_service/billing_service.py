@@ -1,42 +1,36 @@
 from flask import Flask, request, jsonify
-import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import execute_values
 import os
-import logging
-import requests
+from datetime import date
+from common.log import configure_logging, get_logger
+from common.db import get_db_connection
+from common.metrics import init_metrics
+from common.tracing import init_tracing, current_traceparent
+from common.profiling import init_profiling
+from common.codec import init_codec
+from common.slow_queries import init_slow_query_log
+from common.idempotency import (init_idempotency, create_idempotency_table, claim_idempotency_key,
+                                remember_response, start_idempotency_cleanup)
+from common.references import init_references, unknown_references
+from aggregates import create_aggregate_tables, apply_bill_changes
+from bill_generation import create_bill_generation_tables
+from common.partitioning import PARTITIONING_ENABLED, ensure_partitions, start_partition_maintenance
+from schema import create_bills_table
 
 app = Flask(__name__)
+init_metrics(app, 'billing_service')
+init_tracing(app, 'billing_service')
+init_profiling(app, 'billing_service')
+init_codec(app)
+init_slow_query_log(app)
+init_idempotency(app)
+init_references(app, patient_id='patient_service', appointment_id='appointment_service')
 
 # Configure logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
-
-# Function to get database configuration from environment variables
-def get_db_config():
-    return {
-        'user': os.getenv('DB_USER'),
-        'password': os.getenv('DB_PASSWORD'),
-        'host': os.getenv('DB_HOST'),
-        'database': os.getenv('DB_NAME')
-    }
-
-# Function to establish a connection to the database
-def get_db_connection():
-    config = get_db_config()
-    try:
-        conn = psycopg2.connect(
-            host=config['host'],
-            database=config['database'],
-            user=config['user'],
-            password=config['password'],
-            cursor_factory=RealDictCursor
-        )
-        return conn
-    except Exception as e:
-        logger.error(f"Error connecting to the database: {e}")
-        return None
+configure_logging('billing_service')
+logger = get_logger(__name__)
 
-# Function to initialize the database and create the 'bills' table
+# Function to initialize the database and create the 'bills', 'notification_outbox' and summary tables
 def initialize_database():
     conn = get_db_connection()
     if not conn:
@@ -46,44 +40,84 @@ def initialize_database():
     try:
         cursor = conn.cursor()
         logger.info("Creating 'bills' table if it doesn't exist...")
+        create_bills_table(cursor)
+        if PARTITIONING_ENABLED:
+            ensure_partitions(cursor, 'bills', 'issued_date')
+        # Notifications are written here in the same transaction as the bill
+        # and delivered later by outbox_dispatcher.py
+        logger.info("Creating 'notification_outbox' table if it doesn't exist...")
         cursor.execute("""
-            CREATE TABLE IF NOT EXISTS bills (
-                id SERIAL PRIMARY KEY,
-                patient_id INTEGER NOT NULL,
-                appointment_id INTEGER NOT NULL,
-                amount DECIMAL(10, 2) NOT NULL,
+            CREATE TABLE IF NOT EXISTS notification_outbox (
+                id BIGSERIAL PRIMARY KEY,
+                bill_id INTEGER NOT NULL,
                 email VARCHAR(255) NOT NULL,
-                status VARCHAR(50) DEFAULT 'Pending',
-                issued_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                paid_date TIMESTAMP
+                amount DECIMAL(10, 2) NOT NULL,
+                status VARCHAR(20) NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                last_error TEXT,
+                created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                sent_at TIMESTAMP
             );
+            CREATE INDEX IF NOT EXISTS notification_outbox_pending_idx
+                ON notification_outbox (next_attempt_at) WHERE status = 'pending';
         """)
+        # Trace context of the request that queued the notification, so its
+        # delivery shows up in the same trace
+        cursor.execute("ALTER TABLE notification_outbox ADD COLUMN IF NOT EXISTS traceparent VARCHAR(55);")
+        logger.info("Creating billing summary tables if they don't exist...")
+        create_aggregate_tables(cursor)
+        # Prices and checkpoints for bulk billing (generate_bills.py)
+        create_bill_generation_tables(cursor)
+        # Responses of create requests sent with an Idempotency-Key
+        create_idempotency_table(cursor)
         conn.commit()
         logger.info("Database initialized successfully.")
     except Exception as e:
-        logger.error(f"Error initializing database: {e}")
+        logger.error("Error initializing database", error=e)
     finally:
         cursor.close()
         conn.close()
 
 
+# Bulk settlement limits: bills per request and bills per UPDATE statement
+MAX_SETTLEMENT_SIZE = int(os.getenv('MAX_SETTLEMENT_SIZE', '100000'))
+SETTLEMENT_CHUNK_SIZE = int(os.getenv('SETTLEMENT_CHUNK_SIZE', '1000'))
+
 # Initialize the database when the service starts
 initialize_database()
+start_idempotency_cleanup(get_db_connection)
+if PARTITIONING_ENABLED:
+    start_partition_maintenance(get_db_connection, [('bills', 'issued_date')])
 
-# Route to get all bills
+# Route to get all bills, optionally only those with
+# from <= issued_date < to (lets Postgres prune partitions)
 @app.route('/bills', methods=['GET'])
 def get_bills():
+    start = request.args.get('from')
+    end = request.args.get('to')
+
     conn = get_db_connection()
     if not conn:
         return jsonify({"error": "Database connection failed"}), 500
 
     try:
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM bills;")
+        query = "SELECT * FROM bills"
+        conditions, params = [], []
+        if start:
+            conditions.append("issued_date >= %s")
+            params.append(start)
+        if end:
+            conditions.append("issued_date < %s")
+            params.append(end)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        cursor.execute(query + ";", params)
         bills = cursor.fetchall()
         return jsonify(bills), 200
     except Exception as e:
-        logger.error(f"Error fetching bills: {e}")
+        logger.error("Error fetching bills", error=e)
         return jsonify({"error": "Failed to fetch bills"}), 500
     finally:
         cursor.close()
@@ -101,25 +135,41 @@ def create_bill():
     if not patient_id or not appointment_id or amount is None or not email:
         return jsonify({"error": "Patient ID, Appointment ID, Amount, and Email are required"}), 400
 
+    # Checked against local copies of the other services' ids, no request to them
+    unknown = unknown_references(patient_id=patient_id, appointment_id=appointment_id)
+    if unknown:
+        return jsonify({"error": f"Unknown {' and '.join(unknown)}"}), 400
+
     conn = get_db_connection()
     if not conn:
         return jsonify({"error": "Database connection failed"}), 500
 
     try:
         cursor = conn.cursor()
+        # A retry with the same Idempotency-Key gets the first response back
+        replay = claim_idempotency_key(cursor)
+        if replay is not None:
+            return replay
         cursor.execute(
-            "INSERT INTO bills (patient_id, appointment_id, amount, email) VALUES (%s, %s, %s, %s) RETURNING id;",
+            "INSERT INTO bills (patient_id, appointment_id, amount, email) VALUES (%s, %s, %s, %s) RETURNING *;",
             (patient_id, appointment_id, amount, email)
         )
-        bill_id = cursor.fetchone()['id']
+        bill = cursor.fetchone()
+        bill_id = bill['id']
+        apply_bill_changes(cursor, added=[bill])
+        # Queue the notification in the same transaction; the outbox dispatcher delivers it
+        cursor.execute(
+            "INSERT INTO notification_outbox (bill_id, email, amount, traceparent) VALUES (%s, %s, %s, %s);",
+            (bill_id, email, amount, current_traceparent())
+        )
+        response = {"id": bill_id, "message": "Bill created successfully"}
+        remember_response(cursor, response, 201)
         conn.commit()
-        logger.info(f"Bill {bill_id} added: patient_id = {patient_id}, appointment_id = {appointment_id}, amount = {amount}, email = {email}")
-        # Send a notification after creating the bill
-        send_notification(email, amount)
+        logger.info("Bill added", bill_id=bill_id, patient_id=patient_id, appointment_id=appointment_id, amount=amount, email=email)
 
-        return jsonify({"id": bill_id, "message": "Bill created successfully"}), 201
+        return jsonify(response), 201
     except Exception as e:
-        logger.error(f"Error creating bill: {e}")
+        logger.error("Error creating bill", error=e)
         return jsonify({"error": "Failed to create bill"}), 500
     finally:
         cursor.close()
@@ -141,26 +191,106 @@ def update_bill_status(bill_id):
 
     try:
         cursor = conn.cursor()
+        cursor.execute("SELECT * FROM bills WHERE id = %s FOR UPDATE;", (bill_id,))
+        old_bill = cursor.fetchone()
+        if not old_bill:
+            conn.rollback()
+            return jsonify({"error": "Bill not found"}), 404
+
         if status.lower() == 'paid' and paid_date:
             cursor.execute(
-                "UPDATE bills SET status = %s, paid_date = %s WHERE id = %s;",
+                "UPDATE bills SET status = %s, paid_date = %s WHERE id = %s RETURNING *;",
                 (status, paid_date, bill_id)
             )
         else:
             cursor.execute(
-                "UPDATE bills SET status = %s WHERE id = %s;",
+                "UPDATE bills SET status = %s WHERE id = %s RETURNING *;",
                 (status, bill_id)
             )
+        apply_bill_changes(cursor, removed=[old_bill], added=[cursor.fetchone()])
         conn.commit()
-        logger.info(f"Bill {bill_id} update: status = {status}, paid_date = {paid_date}")
+        logger.info("Bill updated", bill_id=bill_id, status=status, paid_date=paid_date)
         return jsonify({"message": "Bill status updated successfully"}), 200
     except Exception as e:
-        logger.error(f"Error updating bill status: {e}")
+        logger.error("Error updating bill status", error=e)
         return jsonify({"error": "Failed to update bill status"}), 500
     finally:
         cursor.close()
         conn.close()
 
+# Route to update the status of many bills at once, e.g. from a payment
+# processor settlement file. Accepts {"status", "paid_date", "ids": [...]}
+# and/or {"bills": [{"id", "status", "paid_date"}, ...]}; per-bill values
+# override the top-level ones. All chunks are applied in one transaction.
+@app.route('/bills/status', methods=['PUT'])
+def update_bills_status():
+    data = request.get_json()
+    if not isinstance(data, dict) or not data:
+        return jsonify({"error": "Request body is required"}), 400
+    default_status = data.get('status')
+    default_paid_date = data.get('paid_date')
+    entries = [{"id": bill_id} for bill_id in data.get('ids', [])] + list(data.get('bills', []))
+
+    changes = {}
+    for entry in entries:
+        bill_id = entry.get('id') if isinstance(entry, dict) else None
+        status = entry.get('status', default_status) if isinstance(entry, dict) else None
+        if not isinstance(bill_id, int) or isinstance(bill_id, bool) or not isinstance(status, str) or not status:
+            return jsonify({"error": "Every bill needs an integer ID and a Status"}), 400
+        paid_date = entry.get('paid_date', default_paid_date)
+        # Same rule as update_bill_status: paid_date only applies to paid bills
+        if status.lower() != 'paid':
+            paid_date = None
+        changes[bill_id] = (bill_id, status, paid_date)
+
+    if not changes:
+        return jsonify({"error": "At least one bill is required"}), 400
+    if len(changes) > MAX_SETTLEMENT_SIZE:
+        return jsonify({"error": f"At most {MAX_SETTLEMENT_SIZE} bills per request"}), 400
+
+    conn = get_db_connection()
+    if not conn:
+        return jsonify({"error": "Database connection failed"}), 500
+
+    try:
+        cursor = conn.cursor()
+        rows = sorted(changes.values())
+        updated_ids = set()
+        for start in range(0, len(rows), SETTLEMENT_CHUNK_SIZE):
+            chunk = rows[start:start + SETTLEMENT_CHUNK_SIZE]
+            updated = execute_values(cursor, """
+                WITH changes (id, status, paid_date) AS (VALUES %s),
+                old AS (
+                    SELECT bills.* FROM bills JOIN changes ON bills.id = changes.id
+                    FOR UPDATE OF bills
+                )
+                UPDATE bills
+                SET status = changes.status,
+                    paid_date = COALESCE(changes.paid_date, bills.paid_date)
+                FROM changes JOIN old ON old.id = changes.id
+                WHERE bills.id = changes.id
+                RETURNING bills.*, old.status AS old_status, old.paid_date AS old_paid_date;
+            """, chunk, template="(%s::integer, %s::varchar, %s::timestamp)", page_size=len(chunk), fetch=True)
+
+            removed = [dict(bill, status=bill['old_status'], paid_date=bill['old_paid_date']) for bill in updated]
+            apply_bill_changes(cursor, removed=removed, added=updated)
+            updated_ids.update(bill['id'] for bill in updated)
+        conn.commit()
+
+        missing = sorted(changes.keys() - updated_ids)
+        logger.info("Bulk status update", updated=len(updated_ids), missing=len(missing))
+        return jsonify({
+            "message": "Bill statuses updated successfully",
+            "updated": len(updated_ids),
+            "missing": missing
+        }), 200
+    except Exception as e:
+        logger.error("Error updating bill statuses", error=e)
+        return jsonify({"error": "Failed to update bill statuses"}), 500
+    finally:
+        cursor.close()
+        conn.close()
+
 # Route to delete a bill
 @app.route('/bills/<int:bill_id>', methods=['DELETE'])
 def delete_bill(bill_id):
@@ -170,39 +300,85 @@ def delete_bill(bill_id):
 
     try:
         cursor = conn.cursor()
-        cursor.execute("DELETE FROM bills WHERE id = %s;", (bill_id,))
+        cursor.execute("DELETE FROM bills WHERE id = %s RETURNING *;", (bill_id,))
+        bill = cursor.fetchone()
+        if bill:
+            apply_bill_changes(cursor, removed=[bill])
         conn.commit()
-        logger.info(f"Bill {bill_id} deleted")
+        logger.info("Bill deleted", bill_id=bill_id)
         return jsonify({"message": "Bill deleted successfully"}), 200
     except Exception as e:
-        logger.error(f"Error deleting bill: {e}")
+        logger.error("Error deleting bill", error=e)
         return jsonify({"error": "Failed to delete bill"}), 500
     finally:
         cursor.close()
         conn.close()
 
-def send_notification(email, amount):
-    try:
-        # The URL for the Notification Service
-        url = "http://notification_service:8001/send-notification"
+# Route to get a patient's totals from the incrementally maintained summary
+@app.route('/patients/<int:patient_id>/balance', methods=['GET'])
+def get_patient_balance(patient_id):
+    conn = get_db_connection()
+    if not conn:
+        return jsonify({"error": "Database connection failed"}), 500
 
-        # The payload to be sent
-        payload = {
-            "email": email,
-            "amount": amount
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM patient_balances WHERE patient_id = %s;", (patient_id,))
+        balance = cursor.fetchone() or {
+            "patient_id": patient_id,
+            "bill_count": 0,
+            "billed_amount": 0,
+            "paid_amount": 0,
+            "outstanding_amount": 0
         }
+        return jsonify(balance), 200
+    except Exception as e:
+        logger.error("Error fetching balance", patient_id=patient_id, error=e)
+        return jsonify({"error": "Failed to fetch patient balance"}), 500
+    finally:
+        cursor.close()
+        conn.close()
 
-        # Making a POST request to the Notification Service
-        response = requests.post(url, json=payload)
+# Route to get issued and paid totals per day or month, optionally limited
+# to a date range with ?from=YYYY-MM-DD&to=YYYY-MM-DD (inclusive)
+@app.route('/bills/summary', methods=['GET'])
+def get_bills_summary():
+    group_by = request.args.get('group_by', 'day')
+    if group_by not in ('day', 'month'):
+        return jsonify({"error": "group_by must be 'day' or 'month'"}), 400
+    try:
+        start = date.fromisoformat(request.args['from']) if request.args.get('from') else None
+        end = date.fromisoformat(request.args['to']) if request.args.get('to') else None
+    except ValueError:
+        return jsonify({"error": "from and to must be YYYY-MM-DD"}), 400
 
-        # Check the response status
-        if response.status_code == 200:
-            logger.info(f"Notification successfully sent to {email}: 'You have a pending bill of amount {amount}.'")
-        else:
-            logger.error(f"Failed to send notification. Status code: {response.status_code}, Response: {response.text}")
+    conn = get_db_connection()
+    if not conn:
+        return jsonify({"error": "Database connection failed"}), 500
 
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT date_trunc(%s, day)::date AS period,
+                   SUM(issued_count) AS issued_count,
+                   SUM(issued_amount) AS issued_amount,
+                   SUM(paid_count) AS paid_count,
+                   SUM(paid_amount) AS paid_amount
+            FROM daily_billing_summary
+            WHERE (%s::date IS NULL OR day >= %s::date) AND (%s::date IS NULL OR day <= %s::date)
+            GROUP BY period
+            ORDER BY period;
+        """, (group_by, start, start, end, end))
+        summary = cursor.fetchall()
+        for row in summary:
+            row['period'] = row['period'].isoformat()
+        return jsonify(summary), 200
     except Exception as e:
-        logger.error(f"Error sending notification: {e}")
+        logger.error("Error fetching bills summary", error=e)
+        return jsonify({"error": "Failed to fetch bills summary"}), 500
+    finally:
+        cursor.close()
+        conn.close()
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8000)
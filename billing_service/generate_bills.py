@@ -0,0 +1,93 @@
+import sys
+import logging
+import argparse
+from datetime import date
+from decimal import Decimal
+from common.db import get_db_connection
+from bill_generation import ServiceClient, create_bill_generation_tables, generate_bills, BILL_GENERATION_CHUNK_SIZE
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Bill completed appointments in bulk, e.g. at month end:
+#
+#     python generate_bills.py prices --set Cardiology=180 --set Neurology=220
+#     python generate_bills.py run --month 2024-05
+#     python generate_bills.py status
+#
+# A run that was interrupted continues from its checkpoint when run again;
+# running a finished period again (or with --restart) goes over the whole
+# period, billing only appointments completed since.
+
+def month_bounds(value):
+    year, month = (int(part) for part in value.split('-'))
+    start = date(year, month, 1)
+    return start, date(year + month // 12, month % 12 + 1, 1)
+
+def set_prices(cursor, entries):
+    for entry in entries:
+        specialty, _, amount = entry.rpartition('=')
+        cursor.execute("""
+            INSERT INTO specialty_prices (specialty, amount) VALUES (%s, %s)
+            ON CONFLICT (specialty) DO UPDATE SET amount = EXCLUDED.amount;
+        """, (specialty, Decimal(amount)))
+    cursor.execute("SELECT specialty, amount FROM specialty_prices ORDER BY specialty;")
+    for row in cursor.fetchall():
+        print(f"{row['specialty']:<30}{row['amount']:>10}")
+
+def print_runs(cursor):
+    cursor.execute("SELECT * FROM bill_generation_runs ORDER BY period_start, period_end;")
+    print(f"{'period':<24}{'appointments':>14}{'bills':>10}{'checkpoint':>12}  finished")
+    for run in cursor.fetchall():
+        print(f"{run['period_start']} - {run['period_end']}{run['appointments_seen']:>13}{run['bills_created']:>10}"
+              f"{run['last_appointment_id']:>12}  {run['finished_at'] or '-'}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Create bills for completed appointments in bulk.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser('run', help="bill the appointments completed in a period")
+    run.add_argument('--month', help="period to bill, as YYYY-MM")
+    run.add_argument('--from', dest='start', type=date.fromisoformat, help="first day of the period")
+    run.add_argument('--to', dest='end', type=date.fromisoformat, help="day after the period")
+    run.add_argument('--chunk-size', type=int, default=BILL_GENERATION_CHUNK_SIZE)
+    run.add_argument('--restart', action='store_true', help="ignore the checkpoint and go over the whole period")
+    prices = commands.add_parser('prices', help="show or set the price per doctor specialty")
+    prices.add_argument('--set', action='append', default=[], metavar='SPECIALTY=AMOUNT')
+    commands.add_parser('status', help="show the checkpoint of every period")
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        if args.month:
+            args.start, args.end = month_bounds(args.month)
+        if not args.start or not args.end:
+            parser.error("run needs --month or --from and --to")
+
+    conn = get_db_connection()
+    if not conn:
+        logger.error("Failed to connect to the database.")
+        return 2
+
+    try:
+        cursor = conn.cursor()
+        create_bill_generation_tables(cursor)
+        conn.commit()
+        if args.command == 'prices':
+            set_prices(cursor, args.set)
+        elif args.command == 'status':
+            print_runs(cursor)
+        else:
+            result = generate_bills(conn, ServiceClient(), args.start, args.end, args.chunk_size, args.restart)
+            logger.info(f"Billed {result['bills_created']} of {result['appointments_seen']} completed appointments "
+                        f"from {args.start} to {args.end}.")
+        conn.commit()
+        return 0
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Bill generation failed: {e}")
+        return 1
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    sys.exit(main())
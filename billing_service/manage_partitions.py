@@ -0,0 +1,67 @@
+import sys
+import logging
+import argparse
+from datetime import date
+from common.db import get_db_connection
+from schema import create_bills_table
+from aggregates import archive_bill_totals
+from common.partitioning import ensure_partitions, convert_to_partitioned, archive_partitions, is_partitioned
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def create_partitioned_bills(cursor):
+    create_bills_table(cursor, partitioned=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the monthly partitions of the bills table.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('ensure', help="create the default and upcoming monthly partitions")
+    commands.add_parser('convert', help="turn an existing plain bills table into a partitioned one")
+    archive = commands.add_parser('archive', help="move whole months before a date to cold storage files")
+    archive.add_argument('--before', required=True, help="first month to keep, as YYYY-MM")
+    archive.add_argument('--dir', required=True, help="directory for the archived .csv.gz files")
+    archive.add_argument('--force', action='store_true', help="archive months that still have unpaid bills")
+    args = parser.parse_args()
+
+    conn = get_db_connection()
+    if not conn:
+        logger.error("Failed to connect to the database.")
+        return 2
+
+    try:
+        cursor = conn.cursor()
+        if args.command == 'convert':
+            if is_partitioned(cursor, 'bills'):
+                logger.info("The bills table is already partitioned.")
+                return 0
+            convert_to_partitioned(cursor, 'bills', 'issued_date', create_partitioned_bills)
+        elif args.command == 'ensure':
+            created = ensure_partitions(cursor, 'bills', 'issued_date')
+            logger.info(f"Created {created} partitions.")
+        else:
+            year, month = (int(part) for part in args.before.split('-'))
+
+            # Keep the billing summaries reconcilable and, unless forced,
+            # never move bills that are still waiting to be paid
+            def before_detach(cursor, partition):
+                cursor.execute(f"SELECT COUNT(*) AS unpaid FROM {partition} WHERE LOWER(status) <> 'paid';")
+                unpaid = cursor.fetchone()['unpaid']
+                if unpaid and not args.force:
+                    raise RuntimeError(f"{partition} still has {unpaid} unpaid bills; use --force to archive it")
+                archive_bill_totals(cursor, partition)
+
+            archived = archive_partitions(conn, 'bills', date(year, month, 1), args.dir, before_detach)
+            logger.info(f"Archived {len(archived)} partitions.")
+        conn.commit()
+        return 0
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Partition maintenance failed: {e}")
+        return 1
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,163 @@
+import os
+import time
+import random
+import psycopg2
+import requests
+from common.log import configure_logging, get_logger
+from common.db import get_db_connection
+from common import tracing
+
+# Configure logging
+configure_logging('outbox_dispatcher')
+logger = get_logger(__name__)
+
+# Dispatcher settings, all overridable from the environment
+NOTIFICATION_SERVICE_URL = os.getenv('NOTIFICATION_SERVICE_URL', 'http://notification_service:8001')
+BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', '500'))
+POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', '1.0'))
+REQUEST_TIMEOUT = float(os.getenv('OUTBOX_REQUEST_TIMEOUT', '5.0'))
+MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '10'))
+BASE_BACKOFF = float(os.getenv('OUTBOX_BASE_BACKOFF', '2.0'))
+MAX_BACKOFF = float(os.getenv('OUTBOX_MAX_BACKOFF', '600.0'))
+RETENTION_DAYS = int(os.getenv('OUTBOX_RETENTION_DAYS', '7'))
+# Ask the notification service to fold several bills for one recipient into a single message
+DIGEST = os.getenv('OUTBOX_DIGEST', 'false').lower() in ('1', 'true', 'yes')
+
+# Exponential backoff with jitter, capped at MAX_BACKOFF seconds
+def backoff_seconds(attempts):
+    delay = min(MAX_BACKOFF, BASE_BACKOFF * (2 ** (attempts - 1)))
+    return delay * random.uniform(0.5, 1.0)
+
+# Deliver a batch of outbox entries in one request to the notification
+# service, returning a dict of outbox id -> error message for the failures
+def deliver_batch(session, entries):
+    url = NOTIFICATION_SERVICE_URL + "/send-notifications"
+    payload = {
+        "digest": DIGEST,
+        "notifications": [
+            {
+                "email": entry['email'],
+                "amount": float(entry['amount']),
+                "bill_id": entry['bill_id'],
+                "key": f"bill:{entry['bill_id']}",
+                "traceparent": entry['traceparent']
+            }
+            for entry in entries
+        ]
+    }
+    try:
+        with tracing.start_span("POST notification_service", "client", **{"http.url": url, "batch.size": len(entries)}):
+            response = session.post(url, json=payload, timeout=REQUEST_TIMEOUT, headers=tracing.outbound_headers())
+    except requests.exceptions.RequestException as e:
+        return {entry['id']: str(e) for entry in entries}
+    if response.status_code != 202:
+        error = f"Status code: {response.status_code}, Response: {response.text[:200]}"
+        return {entry['id']: error for entry in entries}
+
+    failures = {}
+    for rejection in response.json().get('rejected', []):
+        failures[entries[rejection['index']]['id']] = rejection['error']
+    return failures
+
+# Claim one batch of due entries, deliver them and record the outcome.
+# Rows are locked with SKIP LOCKED so several dispatchers can run side by side.
+def dispatch_batch(conn, session):
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            SELECT id, bill_id, email, amount, attempts, traceparent
+            FROM notification_outbox
+            WHERE status = 'pending' AND next_attempt_at <= NOW()
+            ORDER BY next_attempt_at
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED;
+        """, (BATCH_SIZE,))
+        entries = cursor.fetchall()
+        if not entries:
+            conn.commit()
+            return 0
+
+        # Polls that find nothing aren't traced; a batch gets its own trace
+        with tracing.start_span("outbox.dispatch", **{"batch.size": len(entries)}):
+            failures = deliver_batch(session, entries)
+            sent_ids = []
+            for entry in entries:
+                error = failures.get(entry['id'])
+                if error is None:
+                    sent_ids.append(entry['id'])
+                    continue
+
+                attempts = entry['attempts'] + 1
+                if attempts >= MAX_ATTEMPTS:
+                    logger.error("Giving up on notification", outbox_id=entry['id'], bill_id=entry['bill_id'], attempts=attempts, error=error)
+                    cursor.execute(
+                        "UPDATE notification_outbox SET status = 'failed', attempts = %s, last_error = %s WHERE id = %s;",
+                        (attempts, error, entry['id'])
+                    )
+                else:
+                    delay = backoff_seconds(attempts)
+                    logger.warning("Notification failed, will retry", outbox_id=entry['id'], bill_id=entry['bill_id'], attempts=attempts, retry_in=round(delay, 1), error=error)
+                    cursor.execute(
+                        """UPDATE notification_outbox
+                           SET attempts = %s, last_error = %s, next_attempt_at = NOW() + %s * INTERVAL '1 second'
+                           WHERE id = %s;""",
+                        (attempts, error, delay, entry['id'])
+                    )
+
+            if sent_ids:
+                cursor.execute(
+                    "UPDATE notification_outbox SET status = 'sent', attempts = attempts + 1, sent_at = NOW(), last_error = NULL WHERE id = ANY(%s);",
+                    (sent_ids,)
+                )
+            conn.commit()
+        logger.info("Dispatched notifications", sent=len(sent_ids), batch=len(entries))
+        return len(entries)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+# Remove delivered entries older than the retention period
+def purge_sent(conn):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            "DELETE FROM notification_outbox WHERE status = 'sent' AND sent_at < NOW() - %s * INTERVAL '1 day';",
+            (RETENTION_DAYS,)
+        )
+        conn.commit()
+    finally:
+        cursor.close()
+
+def run():
+    tracing.configure('outbox_dispatcher')
+    session = requests.Session()
+    conn = None
+    last_purge = 0.0
+    while True:
+        try:
+            if conn is None or conn.closed:
+                conn = get_db_connection()
+                if not conn:
+                    time.sleep(POLL_INTERVAL)
+                    continue
+
+            processed = dispatch_batch(conn, session)
+            if processed == BATCH_SIZE:
+                # A full batch means more work is probably waiting
+                continue
+
+            if time.time() - last_purge > 3600:
+                purge_sent(conn)
+                last_purge = time.time()
+            time.sleep(POLL_INTERVAL)
+        except psycopg2.Error as e:
+            logger.error(f"Database error in outbox dispatcher: {e}")
+            if conn is not None:
+                conn.close()
+            conn = None
+            time.sleep(POLL_INTERVAL)
+
+if __name__ == '__main__':
+    run()
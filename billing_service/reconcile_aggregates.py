@@ -0,0 +1,70 @@
+import sys
+import logging
+import argparse
+from common.db import get_db_connection
+from aggregates import EXPECTED_PATIENT_BALANCES, EXPECTED_DAILY_SUMMARY, rebuild_aggregates
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Compare a summary table with the same totals recomputed from 'bills' and
+# return the rows that differ
+def find_mismatches(cursor, table, key, columns, expected_query):
+    differs = " OR ".join(
+        f"actual.{column} IS DISTINCT FROM COALESCE(expected.{column}, 0)" for column in columns
+    )
+    selected = ", ".join(
+        f"actual.{column} AS actual_{column}, expected.{column} AS expected_{column}" for column in columns
+    )
+    cursor.execute(f"""
+        SELECT COALESCE(actual.{key}, expected.{key}) AS {key}, {selected}
+        FROM {table} actual
+        FULL OUTER JOIN ({expected_query}) expected ON actual.{key} = expected.{key}
+        WHERE actual.{key} IS NULL OR {differs};
+    """)
+    return cursor.fetchall()
+
+def reconcile(repair=False):
+    conn = get_db_connection()
+    if not conn:
+        logger.error("Failed to connect to the database for reconciliation.")
+        return 2
+
+    try:
+        cursor = conn.cursor()
+        # A repeatable-read snapshot makes both sides of the comparison see the same bills
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ;")
+        mismatches = find_mismatches(
+            cursor, "patient_balances", "patient_id",
+            ["bill_count", "billed_amount", "paid_amount", "outstanding_amount"],
+            EXPECTED_PATIENT_BALANCES
+        )
+        mismatches += find_mismatches(
+            cursor, "daily_billing_summary", "day",
+            ["issued_count", "issued_amount", "paid_count", "paid_amount"],
+            EXPECTED_DAILY_SUMMARY
+        )
+        conn.commit()
+
+        for row in mismatches:
+            logger.warning(f"Summary mismatch: {dict(row)}")
+        if not mismatches:
+            logger.info("Billing summaries match the bills table.")
+            return 0
+
+        if repair:
+            rebuild_aggregates(cursor)
+            conn.commit()
+            logger.info(f"Rebuilt billing summaries after {len(mismatches)} mismatches.")
+            return 0
+        return 1
+    finally:
+        cursor.close()
+        conn.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Verify billing summary tables against the bills table.")
+    parser.add_argument('--repair', action='store_true', help="rebuild the summary tables if they differ")
+    args = parser.parse_args()
+    sys.exit(reconcile(repair=args.repair))
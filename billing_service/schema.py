@@ -0,0 +1,36 @@
+from common.partitioning import PARTITIONING_ENABLED
+
+# Schema of the billing service, importable without starting the service
+# (e.g. by manage_partitions.py)
+
+# Create the 'bills' table, range-partitioned by month on issued_date when
+# TABLE_PARTITIONING is enabled
+def create_bills_table(cursor, partitioned=PARTITIONING_ENABLED):
+    if partitioned:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS bills (
+                id SERIAL,
+                patient_id INTEGER NOT NULL,
+                appointment_id INTEGER NOT NULL,
+                amount DECIMAL(10, 2) NOT NULL,
+                email VARCHAR(255) NOT NULL,
+                status VARCHAR(50) DEFAULT 'Pending',
+                issued_date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                paid_date TIMESTAMP,
+                PRIMARY KEY (id, issued_date)
+            ) PARTITION BY RANGE (issued_date);
+        """)
+    else:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS bills (
+                id SERIAL PRIMARY KEY,
+                patient_id INTEGER NOT NULL,
+                appointment_id INTEGER NOT NULL,
+                amount DECIMAL(10, 2) NOT NULL,
+                email VARCHAR(255) NOT NULL,
+                status VARCHAR(50) DEFAULT 'Pending',
+                issued_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                paid_date TIMESTAMP
+            );
+        """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS bills_issued_date_idx ON bills (issued_date);")
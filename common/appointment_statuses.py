@@ -0,0 +1,14 @@
+# Appointment statuses the services act on. A status is free text set
+# through PUT /appointments/<id>/status, so it is compared in lower case
+# against these, e.g. lower(status) IN (...) in SQL; anything else counts as
+# still scheduled.
+CANCELLED_STATUSES = ('cancelled', 'canceled')
+COMPLETED_STATUSES = ('completed',)
+NO_SHOW_STATUSES = ('no-show', 'no_show', 'noshow')
+# Appointments that are over or won't take place: no reminders for these
+CLOSED_STATUSES = CANCELLED_STATUSES + COMPLETED_STATUSES + NO_SHOW_STATUSES
+
+
+# The statuses as a list of SQL literals, for trigger bodies
+def sql_list(statuses):
+    return ', '.join(f"'{status}'" for status in statuses)
@@ -0,0 +1,177 @@
+import os
+import logging
+import threading
+from flask import request, jsonify
+
+logger = logging.getLogger(__name__)
+
+# Change feed of row ids for services other services refer to (patients,
+# doctors, appointments). Statement-level triggers copy the ids of inserted
+# and deleted rows, and TRUNCATEs, into <table>_changes, so every write is
+# captured - including bulk loads that bypass the service. GET /changes
+# serves the log to consumers (see common/references.py).
+#
+# Entries are read in (xid, seq) order, and only from transactions older
+# than the oldest one still running: later commits can then only add entries
+# after the consumer's position, never before it. A consumer without a
+# position, or one behind the pruned part of the log, gets a snapshot of the
+# current ids as ranges instead.
+CHANGE_FEED_PAGE_SIZE = int(os.getenv('CHANGE_FEED_PAGE_SIZE', '10000'))
+CHANGE_RETENTION_DAYS = float(os.getenv('CHANGE_RETENTION_DAYS', '7'))
+CHANGE_PRUNE_INTERVAL = float(os.getenv('CHANGE_PRUNE_INTERVAL', '3600'))
+
+
+# Create the change log and triggers for 'table'; safe to run on every start
+def create_change_feed(cursor, table):
+    # Serialize concurrent setup from several service processes
+    cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s));", (f"change_feed:{table}",))
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {table}_changes (
+            seq BIGSERIAL PRIMARY KEY,
+            xid BIGINT NOT NULL DEFAULT pg_current_xact_id()::text::bigint,
+            entity_id INTEGER,
+            op VARCHAR(10) NOT NULL,
+            changed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE INDEX IF NOT EXISTS {table}_changes_position_idx ON {table}_changes (xid, seq);
+        CREATE TABLE IF NOT EXISTS change_feed_state (
+            table_name VARCHAR(63) PRIMARY KEY,
+            pruned_xid BIGINT NOT NULL DEFAULT 0
+        );
+        INSERT INTO change_feed_state (table_name) VALUES (%s) ON CONFLICT DO NOTHING;
+    """, (table,))
+    cursor.execute(f"""
+        CREATE OR REPLACE FUNCTION {table}_record_changes() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                INSERT INTO {table}_changes (entity_id, op) SELECT id, 'insert' FROM new_rows;
+            ELSIF TG_OP = 'DELETE' THEN
+                INSERT INTO {table}_changes (entity_id, op) SELECT id, 'delete' FROM old_rows;
+            ELSE
+                INSERT INTO {table}_changes (op) VALUES ('truncate');
+            END IF;
+            RETURN NULL;
+        END
+        $$;
+        CREATE OR REPLACE TRIGGER {table}_changes_insert AFTER INSERT ON {table}
+            REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION {table}_record_changes();
+        CREATE OR REPLACE TRIGGER {table}_changes_delete AFTER DELETE ON {table}
+            REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION {table}_record_changes();
+        CREATE OR REPLACE TRIGGER {table}_changes_truncate AFTER TRUNCATE ON {table}
+            FOR EACH STATEMENT EXECUTE FUNCTION {table}_record_changes();
+    """)
+
+
+def parse_position(value):
+    try:
+        xid, seq = (int(part) for part in value.split('.'))
+        return xid, seq
+    except (AttributeError, ValueError):
+        return None
+
+
+def format_position(xid, seq):
+    return f"{xid}.{seq}"
+
+
+# Current ids of 'table' as [first, last] ranges (ids are mostly contiguous)
+def snapshot_ranges(cursor, table):
+    cursor.execute(f"""
+        SELECT MIN(id) AS first, MAX(id) AS last FROM (
+            SELECT id, id - ROW_NUMBER() OVER (ORDER BY id) AS island FROM {table}
+        ) numbered GROUP BY island ORDER BY first;
+    """)
+    return [[row['first'], row['last']] for row in cursor.fetchall()]
+
+
+# One page of the feed after 'position', or a snapshot when the position is
+# missing or has been pruned away
+def read_changes(cursor, table, position, limit=CHANGE_FEED_PAGE_SIZE):
+    cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY;")
+    cursor.execute("SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint AS horizon;")
+    horizon = cursor.fetchone()['horizon']
+    cursor.execute("SELECT pruned_xid FROM change_feed_state WHERE table_name = %s;", (table,))
+    row = cursor.fetchone()
+    pruned_xid = row['pruned_xid'] if row else 0
+
+    # A position past the horizon comes from a different (e.g. recreated) database
+    if position is None or position[0] < pruned_xid or position[0] > horizon:
+        # Everything committed before the horizon is in the snapshot; entries
+        # from later transactions are replayed on top of it
+        return {"snapshot": snapshot_ranges(cursor, table), "position": format_position(horizon, 0), "more": True}
+
+    cursor.execute(f"""
+        SELECT xid, seq, entity_id, op FROM {table}_changes
+        WHERE (xid, seq) > (%s, %s) AND xid < %s
+        ORDER BY xid, seq
+        LIMIT %s;
+    """, (position[0], position[1], horizon, limit))
+    rows = cursor.fetchall()
+    if rows:
+        position = (rows[-1]['xid'], rows[-1]['seq'])
+    return {
+        "changes": [[row['op'], row['entity_id']] for row in rows],
+        "position": format_position(*position),
+        "more": len(rows) == limit,
+    }
+
+
+# Register GET /changes?after=<position> for 'table' on a Flask app
+def init_change_feed(app, table, get_connection):
+    def get_changes():
+        after = request.args.get('after')
+        position = parse_position(after) if after else None
+        if after and position is None:
+            return jsonify({"error": "Invalid position"}), 400
+
+        conn = get_connection()
+        if not conn:
+            return jsonify({"error": "Database connection failed"}), 500
+        try:
+            cursor = conn.cursor()
+            page = read_changes(cursor, table, position)
+            conn.rollback()
+            return jsonify(page), 200
+        except Exception as e:
+            logger.error(f"Error reading {table} changes: {e}")
+            return jsonify({"error": "Failed to read changes"}), 500
+        finally:
+            cursor.close()
+            conn.close()
+
+    app.add_url_rule('/changes', 'get_changes', get_changes, methods=['GET'])
+
+
+# Drop entries older than CHANGE_RETENTION_DAYS; consumers that hadn't read
+# them yet get a snapshot next time
+def prune_changes(cursor, table, retention_days=CHANGE_RETENTION_DAYS):
+    cursor.execute(f"""
+        WITH pruned AS (
+            DELETE FROM {table}_changes WHERE changed_at < NOW() - %s * INTERVAL '1 day' RETURNING xid
+        )
+        UPDATE change_feed_state SET pruned_xid = GREATEST(pruned_xid, (SELECT MAX(xid) + 1 FROM pruned))
+        WHERE table_name = %s AND EXISTS (SELECT 1 FROM pruned);
+    """, (retention_days, table))
+
+
+# Prune the change log every CHANGE_PRUNE_INTERVAL seconds in the background
+def start_change_feed_pruning(get_connection, table, interval=CHANGE_PRUNE_INTERVAL):
+    def prune():
+        while not stop.wait(interval):
+            conn = get_connection()
+            if not conn:
+                continue
+            try:
+                cursor = conn.cursor()
+                prune_changes(cursor, table)
+                conn.commit()
+                cursor.close()
+            except Exception as e:
+                conn.rollback()
+                logger.error(f"Error pruning {table} changes: {e}")
+            finally:
+                conn.close()
+
+    stop = threading.Event()
+    threading.Thread(target=prune, name="change-feed-pruning", daemon=True).start()
+    return stop
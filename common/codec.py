@@ -0,0 +1,85 @@
+import os
+from flask import Request, request, has_request_context
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Content negotiation for internal traffic. Services that call init_codec()
+# answer 'Accept: application/msgpack' with MessagePack instead of JSON and
+# read MessagePack request bodies; everyone else (browsers, curl, external
+# clients of the gateway) keeps getting JSON. The gateway asks for
+# MessagePack on its upstream calls unless INTERNAL_CODEC=json.
+MSGPACK_MIMETYPE = 'application/msgpack'
+INTERNAL_CODEC = os.getenv('INTERNAL_CODEC', 'msgpack')
+MSGPACK_ENABLED = msgpack is not None and INTERNAL_CODEC == 'msgpack'
+
+
+# Values MessagePack has no type for (dates, Decimal, UUID, ...) are
+# converted exactly as jsonify would, so both encodings decode to the same data
+def encode(data):
+    return msgpack.packb(data, default=DefaultJSONProvider.default, use_bin_type=True)
+
+
+def decode(body):
+    return msgpack.unpackb(body, raw=False)
+
+
+def wants_msgpack():
+    return (MSGPACK_ENABLED and has_request_context()
+            and request.accept_mimetypes.best_match(['application/json', MSGPACK_MIMETYPE]) == MSGPACK_MIMETYPE)
+
+
+# jsonify() goes through the app's JSON provider, so handlers don't change
+class NegotiatingJSONProvider(DefaultJSONProvider):
+    def response(self, *args, **kwargs):
+        if not wants_msgpack():
+            return super().response(*args, **kwargs)
+        if args and kwargs:
+            raise TypeError("jsonify() behavior undefined when passed both args and kwargs")
+        data = args[0] if len(args) == 1 else (args or kwargs)
+        response = self._app.response_class(encode(data), mimetype=MSGPACK_MIMETYPE)
+        response.vary.add('Accept')
+        return response
+
+
+# request.get_json() / request.json also accept MessagePack bodies
+class NegotiatingRequest(Request):
+    def get_json(self, force=False, silent=False, cache=True):
+        if self.mimetype != MSGPACK_MIMETYPE or msgpack is None:
+            return super().get_json(force=force, silent=silent, cache=cache)
+        try:
+            return decode(self.get_data(cache=cache))
+        except ValueError as e:
+            if silent:
+                return None
+            return self.on_json_loading_failed(e)
+
+
+def init_codec(app):
+    app.json = NegotiatingJSONProvider(app)
+    app.request_class = NegotiatingRequest
+
+
+# Client side, for the gateway's upstream calls
+
+def request_headers():
+    if MSGPACK_ENABLED:
+        return {'Accept': f"{MSGPACK_MIMETYPE}, application/json;q=0.9"}
+    return {}
+
+
+# Encode a request body; returns keyword arguments for requests
+def body_kwargs(data):
+    if MSGPACK_ENABLED:
+        return {'data': encode(data), 'headers': {'Content-Type': MSGPACK_MIMETYPE}}
+    return {'json': data}
+
+
+# Decode an upstream response in whichever encoding it came back in
+def decode_response(response):
+    if response.headers.get('Content-Type', '').startswith(MSGPACK_MIMETYPE):
+        return decode(response.content)
+    return response.json()
@@ -0,0 +1,156 @@
+import os
+import time
+import logging
+import threading
+import psycopg2
+import psycopg2.extensions
+from psycopg2.extras import RealDictCursor
+
+logger = logging.getLogger(__name__)
+
+# Connections kept per process and how long a request may wait for one
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '10'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '10'))
+
+# Callbacks notified about database activity, used by the instrumentation
+# modules: query observers get (statement, params, seconds, conn) after every
+# statement, pool wait observers get (seconds) for every connection checkout
+query_observers = []
+pool_wait_observers = []
+
+
+# Function to get database configuration from environment variables
+def get_db_config():
+    return {
+        'user': os.getenv('DB_USER'),
+        'password': os.getenv('DB_PASSWORD'),
+        'host': os.getenv('DB_HOST'),
+        'database': os.getenv('DB_NAME')
+    }
+
+
+# RealDictCursor that reports every statement to the query observers
+class InstrumentedCursor(RealDictCursor):
+    def execute(self, query, vars=None):
+        if not query_observers:
+            return super().execute(query, vars)
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            elapsed = time.perf_counter() - start
+            for observer in query_observers:
+                observer(query, vars, elapsed, self.connection)
+
+    def executemany(self, query, vars_list):
+        if not query_observers:
+            return super().executemany(query, vars_list)
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            elapsed = time.perf_counter() - start
+            for observer in query_observers:
+                observer(query, None, elapsed, self.connection)
+
+
+# Connection whose close() hands it back to its pool instead of closing it,
+# so handlers keep their usual try/finally conn.close() pattern
+class PooledConnection(psycopg2.extensions.connection):
+    pool = None
+    checked_out = False
+
+    def close(self):
+        if self.pool is None:
+            return super().close()
+        self.pool.release(self)
+
+    def discard(self):
+        psycopg2.extensions.connection.close(self)
+
+
+# Thread-safe pool of up to 'size' connections. Checkouts wait up to
+# 'timeout' seconds for a free connection and return None if none frees up
+# or the database can't be reached, like the old per-request connect did.
+class ConnectionPool:
+    def __init__(self, config=None, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT):
+        self.config = config
+        self.size = size
+        self.timeout = timeout
+        self.reset()
+
+    # Forget every connection, e.g. in a freshly forked worker process where
+    # the inherited sockets belong to the parent
+    def reset(self):
+        self.idle = []
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(self.size)
+        self.pid = os.getpid()
+
+    def connect(self):
+        config = self.config or get_db_config()
+        conn = psycopg2.connect(
+            host=config['host'],
+            database=config['database'],
+            user=config['user'],
+            password=config['password'],
+            port=config.get('port'),
+            cursor_factory=InstrumentedCursor,
+            connection_factory=PooledConnection
+        )
+        conn.pool = self
+        return conn
+
+    def get_connection(self):
+        if self.pid != os.getpid():
+            self.reset()
+
+        start = time.perf_counter()
+        acquired = self.slots.acquire(timeout=self.timeout)
+        waited = time.perf_counter() - start
+        for observer in pool_wait_observers:
+            observer(waited)
+        if not acquired:
+            logger.error(f"Timed out after {self.timeout}s waiting for a database connection")
+            return None
+
+        with self.lock:
+            conn = self.idle.pop() if self.idle else None
+        if conn is None or conn.closed:
+            try:
+                conn = self.connect()
+            except Exception as e:
+                self.slots.release()
+                logger.error(f"Error connecting to the database: {e}")
+                return None
+        conn.checked_out = True
+        return conn
+
+    def release(self, conn):
+        if not conn.checked_out or self.pid != os.getpid():
+            return
+        conn.checked_out = False
+        if not conn.closed and conn.status != psycopg2.extensions.STATUS_READY:
+            # Handlers that bail out early leave their transaction open
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                conn.discard()
+        with self.lock:
+            if not conn.closed:
+                self.idle.append(conn)
+        self.slots.release()
+
+    def close_all(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.discard()
+
+
+# Process-wide pool for the service's own database
+pool = ConnectionPool()
+
+# Function to get a connection from the pool; close() returns it
+def get_db_connection():
+    return pool.get_connection()
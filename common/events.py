@@ -0,0 +1,118 @@
+import os
+import json
+import itertools
+import threading
+from collections import deque
+from flask import Response, stream_with_context
+
+# Server-Sent Events fan-out. A producer publishes events into an EventHub;
+# every subscriber streams from the hub's buffer of recent events, so
+# publishing costs the same for one subscriber or thousands and each event
+# is serialized once. A subscriber that reconnects with Last-Event-ID picks
+# up after that event if it is still buffered; otherwise, or when it falls
+# more than the buffer behind, it gets a 'reset' event and should reload
+# whatever it shows.
+EVENT_BUFFER_SIZE = int(os.getenv('EVENT_BUFFER_SIZE', '10000'))
+# Seconds between keepalive comments on an idle stream
+EVENT_HEARTBEAT = float(os.getenv('EVENT_HEARTBEAT', '15'))
+# Client reconnect delay suggested to browsers, in milliseconds
+EVENT_RETRY_MS = int(os.getenv('EVENT_RETRY_MS', '3000'))
+
+
+def format_event(event_type, data, event_id=None):
+    lines = [] if event_id is None else [f"id: {event_id}"]
+    lines.append(f"event: {event_type}")
+    lines.append(f"data: {json.dumps(data, separators=(',', ':'), default=str)}")
+    return ("\n".join(lines) + "\n\n").encode()
+
+
+RESET = format_event('reset', {})
+KEEPALIVE = b": keepalive\n\n"
+
+
+class EventHub:
+    def __init__(self, size=EVENT_BUFFER_SIZE):
+        # (number, event id, data, formatted frame); 'number' counts every
+        # event published, so a subscriber's position is a single integer
+        self.events = deque(maxlen=size)
+        self.published = 0
+        self.condition = threading.Condition()
+
+    def publish(self, event_type, data, event_id=None):
+        frame = format_event(event_type, data, event_id)
+        with self.condition:
+            self.published += 1
+            self.events.append((self.published, None if event_id is None else str(event_id), data, frame))
+            self.condition.notify_all()
+
+    # Tell every subscriber that events may have been lost
+    def reset(self):
+        with self.condition:
+            self.published += 1
+            self.events.append((self.published, None, None, RESET))
+            self.condition.notify_all()
+
+    def position_after(self, last_event_id):
+        for number, event_id, _, _ in reversed(self.events):
+            if event_id == last_event_id:
+                return number
+        return None
+
+    # Formatted events (bytes) for one subscriber, forever. 'matches'
+    # filters events by their data; a reset is always passed on.
+    def stream(self, last_event_id=None, matches=None, heartbeat=EVENT_HEARTBEAT):
+        yield f"retry: {EVENT_RETRY_MS}\n\n".encode()
+        with self.condition:
+            position = self.published
+            if last_event_id is not None:
+                found = self.position_after(last_event_id)
+                position = found if found is not None else position
+        if last_event_id is not None and found is None:
+            yield RESET
+
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.published > position, heartbeat)
+                oldest = self.events[0][0] if self.events else self.published + 1
+                if position + 1 < oldest:
+                    # Fell behind the buffer
+                    pending = [(self.published, None, None, RESET)]
+                else:
+                    pending = list(itertools.islice(self.events, position + 1 - oldest, None))
+                position = self.published
+            if not pending:
+                yield KEEPALIVE
+                continue
+            for _, _, data, frame in pending:
+                if data is None or matches is None or matches(data):
+                    yield frame
+
+
+def sse_response(events):
+    response = Response(stream_with_context(events), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Stop proxies such as nginx from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+# Parse a text/event-stream from an iterable of decoded lines into
+# (event type, data, id) tuples
+def parse_events(lines):
+    event_type, data, event_id = 'message', [], None
+    for line in lines:
+        if not line:
+            if data:
+                yield event_type, '\n'.join(data), event_id
+            event_type, data, event_id = 'message', [], None
+        elif line.startswith(':'):
+            continue
+        else:
+            field, _, value = line.partition(':')
+            value = value[1:] if value.startswith(' ') else value
+            if field == 'event':
+                event_type = value
+            elif field == 'data':
+                data.append(value)
+            elif field == 'id':
+                event_id = value
@@ -0,0 +1,134 @@
+import os
+import time
+import queue
+import logging
+import threading
+import contextvars
+from concurrent.futures import Future
+from common.metrics import observe_write_batch
+
+logger = logging.getLogger(__name__)
+
+# Group commit for high-rate inserts. Every commit waits for its WAL flush,
+# so one transaction per request caps inserts at one flush each. With
+# WRITE_BATCHING on, writes handed to GroupCommitter.run() are queued; a
+# flusher thread takes whatever arrives within WRITE_BATCH_MAX_DELAY_MS of
+# the first (up to WRITE_BATCH_MAX_SIZE writes), runs them in one
+# transaction, each in its own savepoint, and commits once. A write that
+# raises is rolled back to its savepoint and only its caller gets the
+# error; if the commit itself fails, every caller in the batch gets it.
+# Callers wait for the commit, so a result they get back is durable.
+#
+# Off (the default), run() is one transaction per call, as before.
+WRITE_BATCHING = os.getenv('WRITE_BATCHING', 'false').lower() in ('1', 'true', 'yes')
+WRITE_BATCH_MAX_DELAY_MS = float(os.getenv('WRITE_BATCH_MAX_DELAY_MS', '1'))
+WRITE_BATCH_MAX_SIZE = int(os.getenv('WRITE_BATCH_MAX_SIZE', '100'))
+
+
+class GroupCommitter:
+    def __init__(self, get_connection, name, enabled=WRITE_BATCHING,
+                 max_delay=WRITE_BATCH_MAX_DELAY_MS / 1000, max_size=WRITE_BATCH_MAX_SIZE):
+        self.get_connection = get_connection
+        self.name = name
+        self.enabled = enabled
+        self.max_delay = max_delay
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.pid = None
+
+    # Start the flusher in each worker process on its first write
+    def ensure_started(self):
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.pending = queue.Queue()
+            threading.Thread(target=self.flush_forever, name=f"group-commit-{self.name}", daemon=True).start()
+
+    def connect(self):
+        conn = self.get_connection()
+        if not conn:
+            raise ConnectionError(f"Failed to connect to {self.name}")
+        return conn
+
+    # Run work(cursor) and commit; returns its result or raises its error.
+    # Batched with other callers' writes when write batching is on.
+    def run(self, work):
+        if not self.enabled:
+            return self.run_transaction(work)
+        self.ensure_started()
+        future = Future()
+        # Carried over so the work sees the request's context (flask.g, tracing)
+        self.pending.put((contextvars.copy_context(), work, future))
+        return future.result()
+
+    # Run work(cursor) in a transaction of its own
+    def run_transaction(self, work):
+        conn = self.connect()
+        try:
+            result = work(conn.cursor())
+            conn.commit()
+            return result
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    # The first pending write and whatever follows within max_delay
+    def collect(self):
+        batch = [self.pending.get()]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_size:
+            try:
+                batch.append(self.pending.get(timeout=max(0.0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        return batch
+
+    def flush(self, batch):
+        done = []
+        try:
+            conn = self.connect()
+        except ConnectionError as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        try:
+            cursor = conn.cursor()
+            for context, work, future in batch:
+                cursor.execute("SAVEPOINT batched_write;")
+                try:
+                    result = context.run(work, cursor)
+                except Exception as e:
+                    cursor.execute("ROLLBACK TO SAVEPOINT batched_write;")
+                    future.set_exception(e)
+                    continue
+                cursor.execute("RELEASE SAVEPOINT batched_write;")
+                done.append((future, result))
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Error committing a batch of {len(batch)} writes on {self.name}: {e}")
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            conn.close()
+        observe_write_batch(self.name, len(batch))
+        for future, result in done:
+            future.set_result(result)
+
+    def flush_forever(self):
+        while True:
+            batch = self.collect()
+            try:
+                self.flush(batch)
+            except Exception as e:
+                logger.error(f"Error flushing writes on {self.name}: {e}")
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
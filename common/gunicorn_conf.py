@@ -0,0 +1,74 @@
+import os
+import shutil
+import tempfile
+import multiprocessing
+
+# Gunicorn settings shared by every service, e.g.
+#
+#   gunicorn -c common/gunicorn_conf.py --bind 0.0.0.0:8000 billing_service:app
+#
+# Each worker is a process running WEB_THREADS request threads, and gets a
+# database pool of DB_POOL_SIZE connections (one per thread by default), so
+# a service holds at most WEB_WORKERS * DB_POOL_SIZE connections.
+
+workers = int(os.getenv('WEB_WORKERS', str(multiprocessing.cpu_count())))
+threads = int(os.getenv('WEB_THREADS', '4'))
+# 'gevent' suits long-lived connections, e.g. the gateway's event streams,
+# where a thread per subscriber would run out long before sockets do
+worker_class = os.getenv('WEB_WORKER_CLASS', 'gthread')
+worker_connections = int(os.getenv('WEB_WORKER_CONNECTIONS', '1000'))
+os.environ.setdefault('DB_POOL_SIZE', str(threads))
+
+# The app is imported once in the master, so table setup in
+# initialize_database() runs once rather than racing in every worker
+preload_app = os.getenv('WEB_PRELOAD', 'true').lower() in ('1', 'true', 'yes')
+
+# Graceful restarts: on SIGHUP or recycling, workers finish in-flight
+# requests for up to graceful_timeout seconds before being replaced
+timeout = int(os.getenv('WEB_TIMEOUT', '60'))
+graceful_timeout = int(os.getenv('WEB_GRACEFUL_TIMEOUT', '30'))
+keepalive = int(os.getenv('WEB_KEEPALIVE', '5'))
+# Recycle workers after this many requests (0 = never), jittered so they
+# don't all restart at once
+max_requests = int(os.getenv('WEB_MAX_REQUESTS', '0'))
+max_requests_jitter = max_requests // 10
+
+accesslog = os.getenv('WEB_ACCESS_LOG') or None
+errorlog = '-'
+
+# Workers share their metrics through files in METRICS_DIR (see
+# common/metrics.py); it's emptied when the master starts and removed when
+# it exits, and an exited worker's file is folded into the retired total
+if workers > 1:
+    os.environ.setdefault('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'service-metrics', str(os.getpid())))
+
+
+def on_starting(server):
+    metrics_dir = os.getenv('METRICS_DIR')
+    if metrics_dir:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+        os.makedirs(metrics_dir, exist_ok=True)
+
+
+def child_exit(server, worker):
+    try:
+        from common import metrics
+    except ImportError:
+        return
+    metrics.retire_worker(worker.pid)
+
+
+def on_exit(server):
+    metrics_dir = os.getenv('METRICS_DIR')
+    if metrics_dir:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
+# Connections the master opened while importing the app must not be shared
+# with (or closed by) the workers, so drop them before every fork
+def pre_fork(server, worker):
+    try:
+        from common import db
+    except ImportError:
+        return
+    db.pool.close_all()
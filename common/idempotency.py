@@ -0,0 +1,147 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from flask import current_app, request, g, jsonify
+from psycopg2.extras import Json
+
+logger = logging.getLogger(__name__)
+
+# Idempotency-Key support for create endpoints. The key is claimed with an
+# INSERT into idempotency_keys in the handler's own transaction and the
+# response is stored in that same transaction, so either both the new row
+# and its stored response commit or neither does. A retry with the same key
+# gets the stored response back (marked Idempotent-Replayed: true) without
+# running the insert again; one that arrives while the first is still in
+# flight waits on the key's row lock and then replays. Keys are kept for
+# IDEMPOTENCY_TTL_HOURS. Keys can carry the patient_id of what they created,
+# so sharded medical records can move a patient's keys with its records.
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+IDEMPOTENCY_TTL_HOURS = float(os.getenv('IDEMPOTENCY_TTL_HOURS', '24'))
+IDEMPOTENCY_CLEANUP_INTERVAL = float(os.getenv('IDEMPOTENCY_CLEANUP_INTERVAL', '3600'))
+MAX_KEY_LENGTH = 255
+
+
+def create_idempotency_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            scope VARCHAR(100) NOT NULL,
+            key VARCHAR(255) NOT NULL,
+            request_hash CHAR(64) NOT NULL,
+            status_code INTEGER,
+            response JSONB,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (scope, key)
+        );
+        CREATE INDEX IF NOT EXISTS idempotency_keys_created_idx ON idempotency_keys (created_at);
+        ALTER TABLE idempotency_keys ADD COLUMN IF NOT EXISTS patient_id INTEGER;
+    """)
+
+
+# Mark a view that reads its request body as a stream (e.g. a file upload)
+# and doesn't take Idempotency-Key, so the body isn't read here first
+def without_idempotency(view):
+    view.without_idempotency = True
+    return view
+
+
+# Remember the request's key, if it has one, for claim_idempotency_key()
+def init_idempotency(app):
+    @app.before_request
+    def read_idempotency_key():
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if not key or request.method != 'POST':
+            return
+        if getattr(current_app.view_functions.get(request.endpoint), 'without_idempotency', False):
+            return
+        if len(key) > MAX_KEY_LENGTH:
+            return jsonify({"error": f"{IDEMPOTENCY_HEADER} must be at most {MAX_KEY_LENGTH} characters"}), 400
+        scope = f"{request.method} {request.url_rule.rule if request.url_rule else request.path}"
+        # Hash the decoded body so the same request matches whether it came
+        # as JSON or MessagePack (see common/codec.py)
+        body = request.get_json(silent=True)
+        if body is None:
+            canonical = request.get_data()
+        else:
+            canonical = json.dumps(body, sort_keys=True, default=str).encode()
+        digest = hashlib.sha256(canonical).hexdigest()
+        g.idempotency = (scope, key, digest)
+
+
+# Claim the request's key in the current transaction. Returns None when the
+# handler should go ahead (no key, or a new one), otherwise the response to
+# return instead: the stored one for a replay, or an error if the key was
+# used for a different request.
+def claim_idempotency_key(cursor, patient_id=None):
+    if 'idempotency' not in g:
+        return None
+    scope, key, digest = g.idempotency
+    cursor.execute("""
+        INSERT INTO idempotency_keys (scope, key, request_hash, patient_id) VALUES (%s, %s, %s, %s)
+        ON CONFLICT (scope, key) DO NOTHING RETURNING key;
+    """, (scope, key, digest, patient_id))
+    if cursor.fetchone() is not None:
+        g.idempotency_claimed = True
+        return None
+
+    cursor.execute(
+        "SELECT request_hash, status_code, response FROM idempotency_keys WHERE scope = %s AND key = %s;",
+        (scope, key)
+    )
+    stored = cursor.fetchone()
+    if stored is None or stored['status_code'] is None:
+        # Expired between the two statements, or claimed without a response
+        return jsonify({"error": "A request with this Idempotency-Key is in progress"}), 409
+    if stored['request_hash'] != digest:
+        return jsonify({"error": f"{IDEMPOTENCY_HEADER} was already used for a different request"}), 422
+    response = jsonify(stored['response'])
+    response.status_code = stored['status_code']
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+# Store the response for the claimed key; call before committing
+def remember_response(cursor, body, status_code):
+    if not g.get('idempotency_claimed'):
+        return
+    scope, key, _ = g.idempotency
+    cursor.execute(
+        "UPDATE idempotency_keys SET status_code = %s, response = %s WHERE scope = %s AND key = %s;",
+        (status_code, Json(body), scope, key)
+    )
+
+
+def purge_expired_keys(cursor, ttl_hours=IDEMPOTENCY_TTL_HOURS):
+    cursor.execute(
+        "DELETE FROM idempotency_keys WHERE created_at < NOW() - %s * INTERVAL '1 hour';",
+        (ttl_hours,)
+    )
+    return cursor.rowcount
+
+
+# Delete expired keys every IDEMPOTENCY_CLEANUP_INTERVAL seconds in the
+# background, from each database 'get_connections' hands out
+def start_idempotency_cleanup(*get_connections, interval=IDEMPOTENCY_CLEANUP_INTERVAL):
+    def clean():
+        while not stop.wait(interval):
+            for get_connection in get_connections:
+                conn = get_connection()
+                if not conn:
+                    continue
+                try:
+                    cursor = conn.cursor()
+                    purged = purge_expired_keys(cursor)
+                    conn.commit()
+                    cursor.close()
+                    if purged:
+                        logger.info(f"Purged {purged} expired idempotency keys")
+                except Exception as e:
+                    conn.rollback()
+                    logger.error(f"Error purging idempotency keys: {e}")
+                finally:
+                    conn.close()
+
+    stop = threading.Event()
+    threading.Thread(target=clean, name="idempotency-cleanup", daemon=True).start()
+    return stop
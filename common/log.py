@@ -0,0 +1,192 @@
+import os
+import re
+import sys
+import json
+import time
+import queue
+import random
+import atexit
+import logging
+import threading
+import logging.handlers
+from common.tracing import current_request_id
+
+# Shared logging setup. Request threads only filter a record and put it on a
+# queue; formatting, PII redaction and the write to stdout happen on a
+# background listener thread. Fields passed as keyword arguments,
+#
+#     logger.info("Bill added", bill_id=bill_id, email=email)
+#
+# stay structured (LOG_FORMAT=json prints one JSON object per line) and are
+# only turned into text on the listener thread.
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+# Fraction of records below WARNING that are kept
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', '1.0'))
+# Records below WARNING allowed per logger per second (0 = unlimited)
+LOG_RATE_LIMIT = float(os.getenv('LOG_RATE_LIMIT', '0'))
+LOG_REDACT_FIELDS = set(os.getenv(
+    'LOG_REDACT_FIELDS', 'name,email,contract_info,contact_info,diagnosis,treatment,phone,address'
+).split(','))
+
+EMAIL_PATTERN = re.compile(r"[\w.+-]+@[\w-]+\.[\w.-]+")
+
+service_name = None
+
+
+# Logger adapter that accepts structured fields as keyword arguments
+class StructuredLogger(logging.LoggerAdapter):
+    RESERVED = ('exc_info', 'stack_info', 'stacklevel', 'extra')
+
+    def process(self, msg, kwargs):
+        fields = {key: kwargs.pop(key) for key in list(kwargs) if key not in self.RESERVED}
+        if fields:
+            kwargs['extra'] = dict(kwargs.get('extra') or {}, fields=fields)
+        return msg, kwargs
+
+
+def get_logger(name):
+    return StructuredLogger(logging.getLogger(name), {})
+
+
+# Per-logger sampling and token-bucket rate limiting for records below
+# WARNING. Warnings and errors always pass; the number of records dropped
+# since the last one that passed is attached to it as 'suppressed'.
+class SamplingFilter(logging.Filter):
+    def __init__(self, sample_rate=LOG_SAMPLE_RATE, rate_limit=LOG_RATE_LIMIT):
+        super().__init__()
+        self.sample_rate = sample_rate
+        self.rate_limit = rate_limit
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.suppressed = {}
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        keep = self.sample_rate >= 1 or random.random() < self.sample_rate
+        if keep and self.rate_limit > 0:
+            keep = self.take_token(record.name)
+        with self.lock:
+            if not keep:
+                self.suppressed[record.name] = self.suppressed.get(record.name, 0) + 1
+                return False
+            suppressed = self.suppressed.pop(record.name, 0)
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+    def take_token(self, name):
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.buckets.get(name, (self.rate_limit, now))
+            tokens = min(self.rate_limit, tokens + (now - last) * self.rate_limit)
+            if tokens < 1:
+                self.buckets[name] = (tokens, now)
+                return False
+            self.buckets[name] = (tokens - 1, now)
+            return True
+
+
+# Queue handler that leaves formatting to the listener thread. It captures
+# only what has to be read on the calling thread: the request id and the
+# exception text (the traceback frames don't outlive the except block).
+# Records are dropped, and counted, when the queue is full.
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, output, size=LOG_QUEUE_SIZE):
+        super().__init__(queue.Queue(size))
+        self.output = output
+        self.size = size
+        self.dropped = 0
+        self.listener_lock = threading.Lock()
+        self.start_listener()
+
+    # Also called in a forked child, which inherits the queue but not the thread
+    def start_listener(self):
+        self.queue = queue.Queue(self.size)
+        self.listener = logging.handlers.QueueListener(self.queue, self.output)
+        self.listener.start()
+        self.pid = os.getpid()
+
+    def stop(self):
+        if self.pid == os.getpid():
+            self.listener.stop()
+
+    def prepare(self, record):
+        record.request_id = current_request_id.get()
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if self.pid != os.getpid():
+            with self.listener_lock:
+                if self.pid != os.getpid():
+                    self.start_listener()
+        if self.dropped:
+            record.dropped, self.dropped = self.dropped, 0
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def redact_value(key, value):
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if key in LOG_REDACT_FIELDS:
+        return '[redacted]'
+    return EMAIL_PATTERN.sub('[email]', str(value))
+
+
+class StructuredFormatter(logging.Formatter):
+    def format(self, record):
+        message = EMAIL_PATTERN.sub('[email]', record.getMessage())
+        fields = {key: redact_value(key, value) for key, value in getattr(record, 'fields', {}).items()}
+        if getattr(record, 'suppressed', 0):
+            fields['suppressed'] = record.suppressed
+        if getattr(record, 'dropped', 0):
+            fields['dropped'] = record.dropped
+        if LOG_FORMAT == 'json':
+            entry = {
+                "time": self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+                "level": record.levelname,
+                "service": service_name,
+                "logger": record.name,
+                "message": message,
+                "request_id": getattr(record, 'request_id', None),
+                **fields,
+            }
+            if record.exc_text:
+                entry["exception"] = record.exc_text
+            return json.dumps(entry, default=str)
+        text = f"{self.formatTime(record)} {record.levelname} {record.name}: {message}"
+        if fields:
+            text += ' ' + ' '.join(f"{key}={value}" for key, value in fields.items())
+        if getattr(record, 'request_id', None):
+            text += f" request_id={record.request_id}"
+        if record.exc_text:
+            text += '\n' + record.exc_text
+        return text
+
+
+# Route all logging through the background queue. Replaces any handlers
+# already on the root logger; safe to call more than once.
+def configure_logging(name):
+    global service_name
+    service_name = name
+    root = logging.getLogger()
+    if any(isinstance(handler, DeferredQueueHandler) for handler in root.handlers):
+        return
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(StructuredFormatter())
+    handler = DeferredQueueHandler(output)
+    atexit.register(handler.stop)
+    handler.addFilter(SamplingFilter())
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
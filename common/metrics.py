@@ -0,0 +1,275 @@
+import os
+import glob
+import json
+import time
+import bisect
+import threading
+from flask import request, g, Response
+
+try:
+    from common import db
+except ImportError:
+    # The gateway and notification service don't install psycopg2
+    db = None
+
+# In-process request and database metrics for the Flask services, exposed in
+# the Prometheus text format on /metrics. Recording an observation is a
+# bisect and a few additions under a lock, so it stays cheap on the hot path.
+
+# With several worker processes (see common/gunicorn_conf.py) each worker
+# periodically writes its series to METRICS_DIR, and /metrics serves the sum
+# over all workers' files. When a worker exits its file is folded into
+# RETIRED_FILE, so totals keep counting what it recorded and the directory
+# doesn't fill up with files of long-gone workers.
+METRICS_DIR = os.getenv('METRICS_DIR')
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '5'))
+RETIRED_FILE = "retired.json"
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+    def dump(self):
+        return self.value
+
+    def merge(self, value):
+        self.value += value
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f"{name}_bucket", labels + (("le", repr(bound)),), cumulative
+        yield f"{name}_bucket", labels + (("le", "+Inf"),), self.count
+        yield f"{name}_sum", labels, self.sum
+        yield f"{name}_count", labels, self.count
+
+    def dump(self):
+        return {"counts": self.counts, "sum": self.sum, "count": self.count}
+
+    def merge(self, value):
+        self.counts = [mine + theirs for mine, theirs in zip(self.counts, value["counts"])]
+        self.sum += value["sum"]
+        self.count += value["count"]
+
+
+# Metric families keyed by name, each holding one series per label set
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.families = {}
+        self.help = {}
+
+    def describe(self, name, kind, text):
+        self.help[name] = (kind, text)
+
+    def series(self, name, labels, factory):
+        family = self.families.setdefault(name, {})
+        metric = family.get(labels)
+        if metric is None:
+            metric = family[labels] = factory()
+        return metric
+
+    def inc(self, name, labels, amount=1):
+        with self.lock:
+            self.series(name, labels, Counter).inc(amount)
+
+    def observe(self, name, labels, value):
+        with self.lock:
+            self.series(name, labels, Histogram).observe(value)
+
+    # JSON-serializable copy of every series, for sharing between workers
+    def dump(self):
+        with self.lock:
+            return [
+                [name, [list(label) for label in labels], type(metric).__name__, metric.dump()]
+                for name, family in self.families.items()
+                for labels, metric in family.items()
+            ]
+
+    def merge(self, series):
+        kinds = {"Counter": Counter, "Histogram": Histogram}
+        with self.lock:
+            for name, labels, kind, value in series:
+                self.series(name, tuple(tuple(label) for label in labels), kinds[kind]).merge(value)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, family in sorted(self.families.items()):
+                kind, text = self.help.get(name, ("untyped", name))
+                lines.append(f"# HELP {name} {text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, metric in sorted(family.items()):
+                    for sample_name, sample_labels, value in metric.samples(name, labels):
+                        label_text = ",".join(f'{key}="{label}"' for key, label in sample_labels)
+                        lines.append(f"{sample_name}{{{label_text}}} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+registry.describe("http_requests_total", "counter", "HTTP requests handled, by route and status code.")
+registry.describe("http_request_duration_seconds", "histogram", "Time spent handling HTTP requests.")
+registry.describe("db_pool_wait_seconds", "histogram", "Time spent waiting for a pooled database connection.")
+registry.describe("db_query_duration_seconds", "histogram", "Time spent executing database statements.")
+registry.describe("upstream_request_duration_seconds", "histogram", "Time spent in calls to upstream services.")
+registry.describe("upstream_requests_total", "counter", "Calls to upstream services, by status code.")
+registry.describe("requests_shed_total", "counter", "Requests turned away by admission control, by reason.")
+registry.describe("write_batches_total", "counter", "Group commits of batched writes.")
+registry.describe("write_batch_writes_total", "counter", "Writes committed in group commits.")
+
+service_labels = ()
+flush_pid = None
+
+
+# Write this worker's series to METRICS_DIR/<pid>.json
+def flush():
+    path = os.path.join(METRICS_DIR, f"{os.getpid()}.json")
+    with open(path + ".tmp", "w") as metrics_file:
+        json.dump(registry.dump(), metrics_file)
+    os.replace(path + ".tmp", path)
+
+
+def flush_periodically():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            flush()
+        except OSError:
+            pass
+
+
+# Start the flush thread in each worker process on its first request. A
+# worker forked from a preloaded master drops whatever the master recorded
+# (e.g. startup queries) so it isn't counted once per worker.
+def ensure_flushing():
+    global flush_pid
+    if METRICS_DIR and flush_pid != os.getpid():
+        flush_pid = os.getpid()
+        with registry.lock:
+            registry.families = {}
+        threading.Thread(target=flush_periodically, daemon=True, name="metrics-flush").start()
+
+
+# Fold the last flushed series of exited worker 'pid' into RETIRED_FILE and
+# remove its file. Called by the gunicorn master (see child_exit in
+# common/gunicorn_conf.py), the only writer of RETIRED_FILE.
+def retire_worker(pid):
+    if not METRICS_DIR:
+        return
+    path = os.path.join(METRICS_DIR, f"{pid}.json")
+    retired_path = os.path.join(METRICS_DIR, RETIRED_FILE)
+    retired = Registry()
+    for source in (retired_path, path):
+        try:
+            with open(source) as metrics_file:
+                retired.merge(json.load(metrics_file))
+        except (OSError, ValueError):
+            continue
+    with open(retired_path + ".tmp", "w") as metrics_file:
+        json.dump(retired.dump(), metrics_file)
+    os.replace(retired_path + ".tmp", retired_path)
+    for leftover in (path, path + ".tmp"):
+        try:
+            os.remove(leftover)
+        except OSError:
+            pass
+
+
+# Exposition text for this process, or for all workers when METRICS_DIR is set
+def render_all():
+    if not METRICS_DIR:
+        return registry.render()
+    flush()
+    combined = Registry()
+    combined.help = registry.help
+    for path in glob.glob(os.path.join(METRICS_DIR, "*.json")):
+        try:
+            with open(path) as metrics_file:
+                combined.merge(json.load(metrics_file))
+        except (OSError, ValueError):
+            continue
+    return combined.render()
+
+
+# Record the time and outcome of a call from this service to another one
+def observe_upstream(upstream, seconds, status):
+    labels = service_labels + (("upstream", upstream),)
+    registry.observe("upstream_request_duration_seconds", labels, seconds)
+    registry.inc("upstream_requests_total", labels + (("status", str(status)),))
+
+
+# Record a request turned away for 'reason' (e.g. rate_limit) on 'target'
+def observe_shed(reason, target):
+    registry.inc("requests_shed_total", service_labels + (("reason", reason), ("target", target)))
+
+
+# Record a group commit of 'size' writes (see common/group_commit.py)
+def observe_write_batch(committer, size):
+    labels = service_labels + (("committer", committer),)
+    registry.inc("write_batches_total", labels)
+    registry.inc("write_batch_writes_total", labels, size)
+
+
+# Instrument a Flask app: per-route request counts and latency, database pool
+# wait and query time, and a /metrics endpoint exposing all of it
+def init_metrics(app, service_name):
+    global service_labels
+    service_labels = (("service", service_name),)
+
+    def record_request(status):
+        start = g.pop('metrics_start', None)
+        if start is None:
+            return
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        labels = service_labels + (("method", request.method), ("route", route))
+        registry.observe("http_request_duration_seconds", labels, time.perf_counter() - start)
+        registry.inc("http_requests_total", labels + (("status", str(status)),))
+
+    @app.before_request
+    def start_timer():
+        ensure_flushing()
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def record_response(response):
+        record_request(response.status_code)
+        return response
+
+    @app.teardown_request
+    def record_failure(exc):
+        # Only reached with the timer still set when after_request didn't run
+        if exc is not None:
+            record_request(500)
+
+    if db is not None:
+        db.pool_wait_observers.append(
+            lambda seconds: registry.observe("db_pool_wait_seconds", service_labels, seconds))
+        db.query_observers.append(
+            lambda statement, params, seconds, conn: registry.observe("db_query_duration_seconds", service_labels, seconds))
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return Response(render_all(), mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,174 @@
+import os
+import gzip
+import logging
+import threading
+from datetime import date
+
+logger = logging.getLogger(__name__)
+
+# Monthly range partitioning helpers shared by the services whose tables only
+# grow over time (appointments, bills). Partitions are named <table>_pYYYYMM
+# and a <table>_default partition catches rows outside the created months
+# until the next maintenance run moves them into a partition of their own.
+PARTITIONING_ENABLED = os.getenv('TABLE_PARTITIONING', 'false').lower() in ('1', 'true', 'yes')
+MONTHS_AHEAD = int(os.getenv('PARTITION_MONTHS_AHEAD', '3'))
+MAINTENANCE_INTERVAL = float(os.getenv('PARTITION_MAINTENANCE_INTERVAL', '86400'))
+
+
+def month_start(value):
+    return date(value.year, value.month, 1)
+
+def add_months(value, months):
+    index = value.year * 12 + value.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+def partition_name(table, month):
+    return f"{table}_p{month:%Y%m}"
+
+def is_partitioned(cursor, table):
+    cursor.execute("""
+        SELECT c.relkind = 'p' AS partitioned FROM pg_class c
+        WHERE c.oid = to_regclass(%s);
+    """, (table,))
+    row = cursor.fetchone()
+    return bool(row and row['partitioned'])
+
+# Month starts of the partitions currently attached to the table
+def attached_months(cursor, table):
+    cursor.execute("""
+        SELECT child.relname FROM pg_inherits
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE pg_inherits.inhparent = to_regclass(%s);
+    """, (table,))
+    prefix = f"{table}_p"
+    months = []
+    for row in cursor.fetchall():
+        suffix = row['relname'][len(prefix):]
+        if row['relname'].startswith(prefix) and len(suffix) == 6 and suffix.isdigit():
+            months.append(date(int(suffix[:4]), int(suffix[4:]), 1))
+    return sorted(months)
+
+# Create the partition for one month. Rows for that month that already landed
+# in the default partition are moved into it before it is attached, so this
+# also repairs months that were written before their partition existed.
+def create_partition(cursor, table, column, month):
+    name = partition_name(table, month)
+    lower, upper = month, add_months(month, 1)
+    cursor.execute(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS);")
+    # Triggers that publish changes (e.g. appointment events) skip moved rows
+    cursor.execute("SELECT set_config('app.moving_rows', 'on', true);")
+    cursor.execute(f"""
+        WITH moved AS (
+            DELETE FROM {table}_default WHERE {column} >= %s AND {column} < %s RETURNING *
+        )
+        INSERT INTO {name} SELECT * FROM moved;
+    """, (lower, upper))
+    cursor.execute("SELECT set_config('app.moving_rows', 'off', true);")
+    cursor.execute(f"ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s);", (lower, upper))
+    logger.info(f"Created partition {name}")
+
+# Make sure the default partition, the partitions from the current month to
+# MONTHS_AHEAD months ahead and partitions for any months sitting in the
+# default partition all exist
+def ensure_partitions(cursor, table, column, months_ahead=MONTHS_AHEAD):
+    # Serialize concurrent maintenance runs from several service processes
+    cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s));", (f"partitions:{table}",))
+    cursor.execute(f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT;")
+    existing = set(attached_months(cursor, table))
+
+    current = month_start(date.today())
+    wanted = {add_months(current, offset) for offset in range(months_ahead + 1)}
+    cursor.execute(f"SELECT DISTINCT date_trunc('month', {column})::date AS month FROM {table}_default;")
+    wanted.update(row['month'] for row in cursor.fetchall() if row['month'] is not None)
+
+    created = 0
+    for month in sorted(wanted - existing):
+        create_partition(cursor, table, column, month)
+        created += 1
+    return created
+
+# Turn an existing plain table into a partitioned one with the same rows.
+# 'create_table' runs the service's partitioned CREATE TABLE statement, and
+# 'create_triggers', if given, the service's trigger setup: the old table's
+# triggers are dropped with it, so they are recreated on the new one once
+# the rows are copied (which then fire none of them).
+def convert_to_partitioned(cursor, table, column, create_table, create_triggers=None):
+    cursor.execute(f"LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE;")
+    cursor.execute(f"ALTER TABLE {table} RENAME TO {table}_unpartitioned;")
+    # The old table's indexes keep their names, so rename them out of the way
+    # or create_table's CREATE INDEX IF NOT EXISTS would skip the new ones
+    cursor.execute("SELECT indexrelid::regclass::text AS name FROM pg_index WHERE indrelid = %s::regclass;",
+                   (f"{table}_unpartitioned",))
+    for number, row in enumerate(cursor.fetchall()):
+        cursor.execute(f"ALTER INDEX {row['name']} RENAME TO {table}_unpartitioned_{number};")
+    create_table(cursor)
+    cursor.execute(f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT;")
+    cursor.execute(f"SELECT DISTINCT date_trunc('month', {column})::date AS month FROM {table}_unpartitioned;")
+    for row in sorted(cursor.fetchall(), key=lambda row: row['month']):
+        create_partition(cursor, table, column, row['month'])
+    ensure_partitions(cursor, table, column)
+    cursor.execute(f"INSERT INTO {table} SELECT * FROM {table}_unpartitioned;")
+    cursor.execute(f"""
+        SELECT setval(pg_get_serial_sequence(%s, 'id'), COALESCE(MAX(id), 0) + 1, false)
+        FROM {table}_unpartitioned;
+    """, (table,))
+    cursor.execute(f"DROP TABLE {table}_unpartitioned;")
+    if create_triggers is not None:
+        create_triggers(cursor)
+
+# Detach every monthly partition that ends on or before 'before', write its
+# rows to a gzipped CSV file in 'directory' and drop it. 'before_detach' is
+# called with the cursor and partition name first, so a service can carry
+# totals over or refuse to archive. Each partition is handled in its own
+# transaction and only dropped once its file is written.
+def archive_partitions(conn, table, before, directory, before_detach=None):
+    os.makedirs(directory, exist_ok=True)
+    cursor = conn.cursor()
+    archived = []
+    try:
+        for month in attached_months(cursor, table):
+            if add_months(month, 1) > before:
+                continue
+            name = partition_name(table, month)
+            path = os.path.join(directory, f"{name}.csv.gz")
+            if before_detach is not None:
+                before_detach(cursor, name)
+            cursor.execute(f"ALTER TABLE {table} DETACH PARTITION {name};")
+            with gzip.open(path + ".tmp", 'wt', newline='') as archive:
+                cursor.copy_expert(f"COPY {name} TO STDOUT WITH (FORMAT csv, HEADER true)", archive)
+            os.replace(path + ".tmp", path)
+            cursor.execute(f"DROP TABLE {name};")
+            conn.commit()
+            logger.info(f"Archived partition {name} to {path}")
+            archived.append(path)
+        conn.commit()
+        return archived
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+# Re-run ensure_partitions every MAINTENANCE_INTERVAL seconds in the
+# background, so future months always have a partition before they start
+def start_partition_maintenance(get_connection, tables, interval=MAINTENANCE_INTERVAL):
+    def maintain():
+        while not stop.wait(interval):
+            conn = get_connection()
+            if not conn:
+                continue
+            try:
+                cursor = conn.cursor()
+                for table, column in tables:
+                    ensure_partitions(cursor, table, column)
+                conn.commit()
+                cursor.close()
+            except Exception as e:
+                conn.rollback()
+                logger.error(f"Error maintaining partitions: {e}")
+            finally:
+                conn.close()
+
+    stop = threading.Event()
+    threading.Thread(target=maintain, name="partition-maintenance", daemon=True).start()
+    return stop
@@ -0,0 +1,120 @@
+import os
+import re
+import sys
+import time
+import random
+import cProfile
+import logging
+import threading
+from collections import Counter
+from flask import request, g
+
+logger = logging.getLogger(__name__)
+
+# Opt-in per-request profiling. A request is profiled when it carries
+# 'X-Profile: <PROFILE_TOKEN>' or is picked at PROFILE_SAMPLE_RATE. With
+# PROFILE_MODE=cprofile the result is a pstats file (.prof); with 'sampling'
+# the request thread's stack is sampled every PROFILE_INTERVAL_MS and written
+# as collapsed stacks (.folded) that flamegraph.pl or speedscope render
+# directly. Files go to PROFILE_DIR/<service>/<route>/. When neither a token
+# nor a sample rate is set no hooks are installed at all.
+PROFILE_TOKEN = os.getenv('PROFILE_TOKEN')
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_MODE = os.getenv('PROFILE_MODE', 'cprofile')
+PROFILE_INTERVAL_MS = float(os.getenv('PROFILE_INTERVAL_MS', '5'))
+PROFILE_DIR = os.getenv('PROFILE_DIR', '/tmp/profiles')
+
+PROFILE_HEADER = 'X-Profile'
+
+# cProfile hooks the interpreter, so only one request per process is
+# profiled at a time; others that ask while it runs are served unprofiled
+profiling_lock = threading.Lock()
+
+
+# Samples one thread's stack from a background thread until stopped
+class StackSampler:
+    def __init__(self, thread_id, interval=PROFILE_INTERVAL_MS / 1000):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True, name='profile-sampler')
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def dump(self, path):
+        with open(path, 'w') as folded_file:
+            for stack, count in self.stacks.items():
+                folded_file.write(f"{stack} {count}\n")
+
+
+def route_directory(service_name, rule):
+    route = re.sub(r'[^A-Za-z0-9_.-]+', '_', rule.strip('/')) or 'root'
+    return os.path.join(PROFILE_DIR, service_name, f"{request.method}_{route}")
+
+
+def wants_profile():
+    if PROFILE_TOKEN and request.headers.get(PROFILE_HEADER) == PROFILE_TOKEN:
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+# Install the profiling hooks on a Flask app if profiling is configured
+def init_profiling(app, service_name):
+    if not PROFILE_TOKEN and PROFILE_SAMPLE_RATE <= 0:
+        return
+
+    @app.before_request
+    def start_profile():
+        if not wants_profile() or not profiling_lock.acquire(blocking=False):
+            return
+        if PROFILE_MODE == 'sampling':
+            profiler = StackSampler(threading.get_ident())
+            profiler.start()
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        g.profile = (profiler, time.perf_counter())
+
+    @app.teardown_request
+    def finish_profile(exc):
+        profile = g.pop('profile', None)
+        if profile is None:
+            return
+        profiler, start = profile
+        try:
+            if PROFILE_MODE == 'sampling':
+                profiler.stop()
+            else:
+                profiler.disable()
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            directory = route_directory(service_name, request.url_rule.rule if request.url_rule else 'unmatched')
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{elapsed_ms:.0f}ms-{os.getpid()}-{threading.get_ident()}"
+                                           f".{'folded' if PROFILE_MODE == 'sampling' else 'prof'}")
+            if PROFILE_MODE == 'sampling':
+                profiler.dump(path)
+            else:
+                profiler.dump_stats(path)
+            logger.info(f"Profile of {request.method} {request.path} ({elapsed_ms:.1f} ms) written to {path}")
+        except OSError as e:
+            logger.warning(f"Failed to write profile: {e}")
+        finally:
+            profiling_lock.release()
@@ -0,0 +1,220 @@
+import os
+import json
+import logging
+import threading
+import urllib.parse
+import urllib.request
+from common import codec
+
+logger = logging.getLogger(__name__)
+
+# Cheap existence checks for ids owned by other services. Each referenced
+# service's change feed (common/change_feed.py) is followed by a background
+# thread into a bitmap of the ids that exist, so a write is validated
+# against local memory. An id missing from the bitmap may simply be newer
+# than the last poll (and serial ids can commit out of order, so that holds
+# for ids below the highest one seen too); on a miss the check waits up to
+# REFERENCE_MISS_WAIT seconds for a fresh poll before rejecting, and accepts
+# the id if the poll doesn't complete (or the feed is failing). Until the
+# first sync completes, or with validation turned off by
+# REFERENCE_VALIDATION=false, every id is accepted.
+REFERENCE_VALIDATION = os.getenv('REFERENCE_VALIDATION', 'true').lower() in ('1', 'true', 'yes')
+REFERENCE_POLL_INTERVAL = float(os.getenv('REFERENCE_POLL_INTERVAL', '1.0'))
+REFERENCE_MISS_WAIT = float(os.getenv('REFERENCE_MISS_WAIT', '2.0'))
+REFERENCE_REQUEST_TIMEOUT = float(os.getenv('REFERENCE_REQUEST_TIMEOUT', '10.0'))
+
+
+# Set of non-negative integer ids stored one bit per id
+class IdBitmap:
+    def __init__(self):
+        self.bits = bytearray()
+        self.highest = 0
+
+    def add(self, entity_id):
+        index = entity_id >> 3
+        if index >= len(self.bits):
+            self.bits.extend(bytes(index - len(self.bits) + 1 + len(self.bits) // 2))
+        self.bits[index] |= 1 << (entity_id & 7)
+        self.highest = max(self.highest, entity_id)
+
+    def add_range(self, first, last):
+        self.add(last)
+        # Whole bytes in the middle of the range are filled in one go
+        low, high = (first + 7) >> 3, (last + 1) >> 3
+        for entity_id in range(first, min(last + 1, low << 3)):
+            self.add(entity_id)
+        if low < high:
+            self.bits[low:high] = b'\xff' * (high - low)
+        for entity_id in range(max(first, high << 3), last + 1):
+            self.add(entity_id)
+
+    def discard(self, entity_id):
+        index = entity_id >> 3
+        if index < len(self.bits):
+            self.bits[index] &= ~(1 << (entity_id & 7)) & 0xFF
+
+    def __contains__(self, entity_id):
+        index = entity_id >> 3
+        return index < len(self.bits) and bool(self.bits[index] & (1 << (entity_id & 7)))
+
+
+# Follows one service's change feed into an IdBitmap
+class ReferenceSet:
+    def __init__(self, name, url, interval=REFERENCE_POLL_INTERVAL):
+        self.name = name
+        self.url = url.rstrip('/') + '/changes'
+        self.interval = interval
+        self.ids = IdBitmap()
+        self.position = None
+        self.ready = False
+        self.failing = False
+        self.started = 0
+        self.completed = 0
+        self.condition = threading.Condition()
+        self.wake = threading.Event()
+        self.pid = None
+
+    # Start the poller; called on every check, and starts a new one in a
+    # forked worker, which inherits the bitmap but not the thread
+    def ensure_started(self):
+        if self.pid == os.getpid():
+            return
+        with self.condition:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            threading.Thread(target=self.run, name=f"references-{self.name}", daemon=True).start()
+
+    def fetch(self):
+        url = self.url
+        if self.position is not None:
+            url += '?' + urllib.parse.urlencode({'after': self.position})
+        headers = {'Accept': 'application/json'}
+        headers.update(codec.request_headers())
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=REFERENCE_REQUEST_TIMEOUT) as response:
+            body = response.read()
+            if response.headers.get('Content-Type', '').startswith(codec.MSGPACK_MIMETYPE):
+                return codec.decode(body)
+            return json.loads(body)
+
+    def apply(self, page):
+        if 'snapshot' in page:
+            ids = IdBitmap()
+            for first, last in page['snapshot']:
+                ids.add_range(first, last)
+            self.ids = ids
+        for op, entity_id in page.get('changes', []):
+            if op == 'insert':
+                self.ids.add(entity_id)
+            elif op == 'delete':
+                self.ids.discard(entity_id)
+            elif op == 'truncate':
+                self.ids = IdBitmap()
+        self.position = page['position']
+
+    def poll(self):
+        with self.condition:
+            self.started += 1
+            number = self.started
+        while True:
+            page = self.fetch()
+            self.apply(page)
+            if not page.get('more'):
+                break
+        with self.condition:
+            self.ready = True
+            self.failing = False
+            self.completed = number
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            try:
+                self.poll()
+            except Exception as e:
+                with self.condition:
+                    self.failing = True
+                    self.condition.notify_all()
+                logger.warning(f"Failed to read {self.name} changes from {self.url}: {e}")
+            self.wake.wait(self.interval)
+            self.wake.clear()
+
+    # Block until a poll that started after this call has finished; False
+    # if it failed or didn't finish in time
+    def wait_for_poll(self, timeout):
+        with self.condition:
+            target = self.started + 1
+            self.wake.set()
+            self.condition.wait_for(lambda: self.completed >= target or self.failing, timeout)
+            return self.completed >= target
+
+    # True or False, or None when it can't be told: the set hasn't been
+    # loaded yet, or the id is missing and the feed can't be read to catch up
+    def contains(self, entity_id):
+        if entity_id < 0:
+            return False
+        self.ensure_started()
+        if not self.ready:
+            return None
+        if entity_id in self.ids:
+            return True
+        if self.failing or not self.wait_for_poll(REFERENCE_MISS_WAIT):
+            return None
+        return entity_id in self.ids
+
+DEFAULT_URLS = {
+    'patient_service': 'http://patient_service:4000',
+    'doctor_service': 'http://doctor_service:5000',
+    'appointment_service': 'http://appointment_service:7000',
+}
+
+# Field name -> ReferenceSet, filled by init_references
+reference_sets = {}
+
+
+# Follow the change feeds of the services a service refers to, e.g.
+#
+#     init_references(app, patient_id='patient_service', doctor_id='doctor_service')
+#
+# Each service's URL comes from <SERVICE>_URL (e.g. PATIENT_SERVICE_URL).
+def init_references(app, **fields):
+    if not REFERENCE_VALIDATION:
+        return
+    for field, service in fields.items():
+        url = os.getenv(f"{service.upper()}_URL", DEFAULT_URLS[service])
+        reference_sets[field] = ReferenceSet(service, url)
+
+    @app.before_request
+    def start_reference_pollers():
+        for references in reference_sets.values():
+            references.ensure_started()
+
+
+# The integer id a request field holds, or None if it isn't one. JSON
+# bodies may carry ids as strings ("12"), which the database would accept.
+def reference_id(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str):
+        try:
+            return int(value.strip())
+        except ValueError:
+            return None
+    return None
+
+
+# Names of the given fields whose id is known not to exist, or isn't an id
+def unknown_references(**ids):
+    unknown = []
+    for field, value in ids.items():
+        references = reference_sets.get(field)
+        if references is None:
+            continue
+        entity_id = reference_id(value)
+        if entity_id is None or references.contains(entity_id) is False:
+            unknown.append(field)
+    return unknown
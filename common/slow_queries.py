@@ -0,0 +1,250 @@
+import os
+import re
+import time
+import queue
+import logging
+import threading
+from collections import deque
+from flask import jsonify
+from psycopg2.extras import RealDictCursor
+from common import db
+
+logger = logging.getLogger(__name__)
+
+# Slow statement capture for the database services. Every statement run
+# through common.db is timed; those over SLOW_QUERY_MS are recorded by shape
+# (literals stripped, parameters reduced to their types) and, for the slowest
+# shapes, a plan is sampled in the background with EXPLAIN (ANALYZE, BUFFERS)
+# on the database the statement ran on. Writes, reads that lock rows and
+# reads that call functions other than SAFE_FUNCTIONS (which may take locks
+# or change state, e.g. pg_advisory_lock, set_config, nextval) are only
+# EXPLAINed, never run again.
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', '100'))
+SLOW_QUERY_LOG_SIZE = int(os.getenv('SLOW_QUERY_LOG_SIZE', '200'))
+SLOW_QUERY_MAX_SHAPES = int(os.getenv('SLOW_QUERY_MAX_SHAPES', '500'))
+EXPLAIN_SAMPLING = os.getenv('EXPLAIN_SAMPLING', 'true').lower() in ('1', 'true', 'yes')
+EXPLAIN_TOP_SHAPES = int(os.getenv('EXPLAIN_TOP_SHAPES', '10'))
+EXPLAIN_INTERVAL = float(os.getenv('EXPLAIN_INTERVAL', '600'))
+EXPLAIN_TIMEOUT_MS = int(os.getenv('EXPLAIN_TIMEOUT_MS', '10000'))
+
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+ROW_LIST = re.compile(r"(\([^()]*\))(?:\s*,\s*\([^()]*\))+")
+PLACEHOLDER_LIST = re.compile(r"(\?|%s)(?:\s*,\s*(?:\?|%s))+")
+CALL = re.compile(r"([a-z_][\w.$]*)\s*\(")
+
+# Keywords that can precede a parenthesis, and built-in functions without
+# side effects; any other name followed by '(' is taken as a function call
+SAFE_FUNCTIONS = frozenset((
+    'select', 'from', 'join', 'lateral', 'where', 'and', 'or', 'not', 'on', 'using', 'in', 'any', 'all',
+    'exists', 'values', 'as', 'over', 'filter', 'by', 'when', 'then', 'else', 'case', 'is', 'distinct',
+    'array', 'row', 'with', 'interval', 'date', 'cast', 'extract', 'coalesce', 'nullif', 'greatest', 'least',
+    'count', 'sum', 'min', 'max', 'avg', 'array_agg', 'json_agg', 'jsonb_agg', 'row_number', 'rank',
+    'lower', 'upper', 'length', 'abs', 'round', 'now', 'date_trunc', 'to_char',
+))
+
+
+# Reduce a statement to its shape so executions that differ only in their
+# values are counted together, and no values are kept
+def statement_shape(statement):
+    if isinstance(statement, bytes):
+        statement = statement.decode('utf-8', 'replace')
+    shape = ' '.join(str(statement).split())
+    shape = STRING_LITERAL.sub('?', shape)
+    shape = NUMBER_LITERAL.sub('?', shape)
+    shape = ROW_LIST.sub(r'\1, ...', shape)
+    return PLACEHOLDER_LIST.sub(r'\1, ...', shape)
+
+
+def redact(value):
+    if value is None:
+        return None
+    if isinstance(value, (list, tuple)):
+        return f"<{type(value).__name__} of {len(value)}>"
+    return f"<{type(value).__name__}>"
+
+
+def redact_params(params):
+    if isinstance(params, dict):
+        return {key: redact(value) for key, value in params.items()}
+    if isinstance(params, (list, tuple)):
+        return [redact(value) for value in params]
+    return redact(params)
+
+
+# Plans spell out the constants they compare against; strip those from the
+# conditions so plans are as redacted as the parameters
+def redact_plan(node, key=None):
+    if isinstance(node, dict):
+        return {name: redact_plan(value, name) for name, value in node.items()}
+    if isinstance(node, list):
+        return [redact_plan(value, key) for value in node]
+    if isinstance(node, str) and key and (key.endswith('Cond') or key.endswith('Filter') or key == 'Output'):
+        return NUMBER_LITERAL.sub('?', STRING_LITERAL.sub('?', node))
+    return node
+
+
+# Statements EXPLAIN accepts (DDL and utility statements are only recorded)
+def can_explain(shape):
+    return shape.lower().startswith(('select', 'insert', 'update', 'delete', 'with'))
+
+
+# Only plain reads are safe to run a second time under EXPLAIN ANALYZE
+def can_analyze(shape):
+    lowered = shape.lower()
+    if not lowered.startswith('select') or ' for update' in lowered or ' for share' in lowered:
+        return False
+    return all(name in SAFE_FUNCTIONS for name in CALL.findall(lowered))
+
+
+class ShapeStats:
+    def __init__(self, shape):
+        self.shape = shape
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last_seen = None
+        self.last_params = None
+        self.plan = None
+        self.plan_analyzed = False
+        self.plan_at = None
+        self.plan_error = None
+        self.explain_pending = False
+
+    def to_dict(self):
+        return {
+            "shape": self.shape,
+            "count": self.count,
+            "total_ms": round(self.total * 1000, 3),
+            "mean_ms": round(self.total / self.count * 1000, 3),
+            "max_ms": round(self.max * 1000, 3),
+            "last_seen": self.last_seen,
+            "last_params": self.last_params,
+            "plan": self.plan,
+            "plan_analyzed": self.plan_analyzed,
+            "plan_at": self.plan_at,
+            "plan_error": self.plan_error,
+        }
+
+
+class SlowQueryLog:
+    def __init__(self, threshold_ms=SLOW_QUERY_MS, size=SLOW_QUERY_LOG_SIZE, max_shapes=SLOW_QUERY_MAX_SHAPES):
+        self.threshold = threshold_ms / 1000
+        self.max_shapes = max_shapes
+        self.lock = threading.Lock()
+        self.shapes = {}
+        self.recent = deque(maxlen=size)
+        self.explain_queue = queue.Queue(maxsize=EXPLAIN_TOP_SHAPES)
+        # EXPLAINs use their own single connection per database so they
+        # never take a request's slot in a service pool; keyed by the pool
+        # the statement ran on (e.g. one per medical record shard)
+        self.explain_pools = {}
+        self.pid = None
+
+    # Query observer: cheap comparison for the common fast case
+    def observe(self, statement, params, seconds, conn):
+        if seconds < self.threshold:
+            return
+        shape = statement_shape(statement)
+        now = time.time()
+        with self.lock:
+            stats = self.shapes.get(shape)
+            if stats is None:
+                if len(self.shapes) >= self.max_shapes:
+                    return
+                stats = self.shapes[shape] = ShapeStats(shape)
+            stats.count += 1
+            stats.total += seconds
+            stats.max = max(stats.max, seconds)
+            stats.last_seen = now
+            stats.last_params = redact_params(params)
+            self.recent.append({"shape": shape, "ms": round(seconds * 1000, 3), "at": now, "params": stats.last_params})
+            sample = EXPLAIN_SAMPLING and self.wants_plan(stats, now)
+            if sample:
+                stats.explain_pending = True
+        if sample:
+            self.request_plan(stats, statement, params, getattr(conn, 'pool', None))
+
+    # A shape gets a (fresh) plan if it's among the slowest by mean time
+    def wants_plan(self, stats, now):
+        if not can_explain(stats.shape):
+            return False
+        if stats.explain_pending or (stats.plan_at is not None and now - stats.plan_at < EXPLAIN_INTERVAL):
+            return False
+        slowest = sorted(self.shapes.values(), key=lambda other: other.total / other.count, reverse=True)
+        return stats in slowest[:EXPLAIN_TOP_SHAPES]
+
+    def request_plan(self, stats, statement, params, pool):
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.pid = os.getpid()
+                    self.explain_queue = queue.Queue(maxsize=EXPLAIN_TOP_SHAPES)
+                    threading.Thread(target=self.explain_worker, daemon=True, name='explain-sampler').start()
+        try:
+            self.explain_queue.put_nowait((stats, statement, params, pool))
+        except queue.Full:
+            stats.explain_pending = False
+
+    def explain_worker(self):
+        while True:
+            stats, statement, params, pool = self.explain_queue.get()
+            try:
+                plan, analyzed = self.explain(stats.shape, statement, params, pool)
+                stats.plan, stats.plan_analyzed, stats.plan_error = plan, analyzed, None
+            except Exception as e:
+                stats.plan, stats.plan_error = None, str(e)
+                logger.warning(f"Failed to EXPLAIN slow statement: {e}")
+            finally:
+                stats.plan_at = time.time()
+                stats.explain_pending = False
+
+    # One-connection pool for the database 'pool' connects to; None (a
+    # connection made outside any pool) means the service's own database
+    def explain_pool(self, pool):
+        explain_pool = self.explain_pools.get(pool)
+        if explain_pool is None:
+            config = pool.config if pool is not None else None
+            explain_pool = self.explain_pools.setdefault(pool, db.ConnectionPool(config, size=1))
+        return explain_pool
+
+    def explain(self, shape, statement, params, pool=None):
+        analyze = can_analyze(shape)
+        options = 'ANALYZE, BUFFERS, FORMAT JSON' if analyze else 'FORMAT JSON'
+        prefix = f"EXPLAIN ({options}) "
+        statement = prefix.encode() + statement if isinstance(statement, bytes) else prefix + statement
+        conn = self.explain_pool(pool).get_connection()
+        if conn is None:
+            raise RuntimeError("No database connection for EXPLAIN")
+        try:
+            # A plain cursor, so the EXPLAIN itself isn't reported as a query
+            cursor = conn.cursor(cursor_factory=RealDictCursor)
+            cursor.execute("SET LOCAL statement_timeout = %s;", (EXPLAIN_TIMEOUT_MS,))
+            cursor.execute(statement, params)
+            plan = redact_plan(cursor.fetchone()['QUERY PLAN'])
+            cursor.close()
+            return plan, analyze
+        finally:
+            # Always roll back: nothing an EXPLAIN ran is kept
+            conn.rollback()
+            conn.close()
+
+    def summary(self):
+        with self.lock:
+            shapes = [stats.to_dict() for stats in self.shapes.values()]
+            recent = list(self.recent)
+        shapes.sort(key=lambda stats: stats['total_ms'], reverse=True)
+        return {"threshold_ms": self.threshold * 1000, "shapes": shapes, "recent": recent[::-1]}
+
+
+slow_queries = SlowQueryLog()
+
+
+# Record this process's slow statements and serve a summary of them on
+# /debug/slow-queries, slowest shapes (by total time) first
+def init_slow_query_log(app):
+    db.query_observers.append(slow_queries.observe)
+
+    @app.route('/debug/slow-queries', methods=['GET'])
+    def slow_query_summary():
+        return jsonify(slow_queries.summary()), 200
@@ -0,0 +1,259 @@
+import os
+import json
+import time
+import uuid
+import queue
+import random
+import logging
+import threading
+import contextvars
+import urllib.request
+from contextlib import contextmanager
+from flask import request, g
+
+logger = logging.getLogger(__name__)
+
+# Request tracing across the gateway, the services and the notification path.
+# Context travels in W3C 'traceparent' headers plus an 'X-Request-ID', and
+# finished spans are exported by a background thread as JSON lines to
+# TRACE_FILE and/or in batches to TRACE_COLLECTOR_URL. With neither set, only
+# the request id is propagated and spans are never built.
+TRACE_FILE = os.getenv('TRACE_FILE')
+TRACE_COLLECTOR_URL = os.getenv('TRACE_COLLECTOR_URL')
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '1.0'))
+TRACE_QUEUE_SIZE = int(os.getenv('TRACE_QUEUE_SIZE', '10000'))
+TRACING_ENABLED = bool(TRACE_FILE or TRACE_COLLECTOR_URL)
+
+REQUEST_ID_HEADER = 'X-Request-ID'
+
+service_name = None
+current_span = contextvars.ContextVar('current_span', default=None)
+current_request_id = contextvars.ContextVar('current_request_id', default=None)
+
+
+class SpanContext:
+    def __init__(self, trace_id, span_id, sampled=True):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.sampled = sampled
+
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+
+# Parse a 'traceparent' header into a SpanContext, or None if it's malformed
+def parse_traceparent(header):
+    parts = (header or '').strip().split('-')
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        flags = int(parts[3], 16)
+        int(parts[1], 16), int(parts[2], 16)
+    except ValueError:
+        return None
+    return SpanContext(parts[1], parts[2], bool(flags & 1))
+
+
+def new_id(length):
+    return '%0*x' % (length, random.getrandbits(length * 4))
+
+
+class Span:
+    def __init__(self, name, kind, parent=None, attributes=None, start=None):
+        if parent is None:
+            self.context = SpanContext(new_id(32), new_id(16), random.random() < TRACE_SAMPLE_RATE)
+            self.parent_id = None
+        else:
+            self.context = SpanContext(parent.trace_id, new_id(16), parent.sampled)
+            self.parent_id = parent.span_id
+        self.name = name
+        self.kind = kind
+        self.attributes = dict(attributes or {})
+        self.start = time.time() if start is None else start
+        self.status = 'ok'
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def end(self, end=None):
+        if not self.context.sampled:
+            return
+        end = time.time() if end is None else end
+        exporter.export({
+            "trace_id": self.context.trace_id,
+            "span_id": self.context.span_id,
+            "parent_id": self.parent_id,
+            "service": service_name,
+            "name": self.name,
+            "kind": self.kind,
+            "start": round(self.start, 6),
+            "duration_ms": round((end - self.start) * 1000, 3),
+            "status": self.status,
+            "request_id": current_request_id.get(),
+            "attributes": self.attributes,
+        })
+
+
+# Run a block inside a child span of the current one (or a new trace)
+@contextmanager
+def start_span(name, kind='internal', parent=None, **attributes):
+    if not TRACING_ENABLED:
+        yield None
+        return
+    if parent is None:
+        parent = current_span.get()
+        parent = parent.context if parent is not None else None
+    span = Span(name, kind, parent, attributes)
+    token = current_span.set(span)
+    try:
+        yield span
+    except Exception as e:
+        span.status = 'error'
+        span.set_attribute('error', type(e).__name__)
+        raise
+    finally:
+        current_span.reset(token)
+        span.end()
+
+
+# Headers to add to an outgoing request so the callee joins this trace
+def outbound_headers():
+    headers = {}
+    request_id = current_request_id.get()
+    if request_id:
+        headers[REQUEST_ID_HEADER] = request_id
+    span = current_span.get()
+    if span is not None:
+        headers['traceparent'] = span.context.traceparent()
+    return headers
+
+
+# The current trace context as a 'traceparent' value, for work handed off
+# through the database (e.g. the notification outbox); None when not tracing
+def current_traceparent():
+    span = current_span.get()
+    return span.context.traceparent() if span is not None else None
+
+
+# Record a span for work that already finished, e.g. a database statement
+# reported by common.db once it returns
+def record_span(name, kind, seconds, parent=None, **attributes):
+    if parent is None:
+        parent = current_span.get()
+        if parent is None:
+            return
+        parent = parent.context
+    if not parent.sampled:
+        return
+    end = time.time()
+    Span(name, kind, parent, attributes, start=end - seconds).end(end)
+
+
+def record_query(statement, params, seconds, conn):
+    if isinstance(statement, bytes):
+        statement = statement.decode('utf-8', 'replace')
+    record_span('db.query', 'client', seconds, statement=' '.join(str(statement).split())[:500])
+
+
+# Background exporter: spans are queued by request threads and written out in
+# batches, so exporting never blocks a request. Spans are dropped when the
+# queue is full.
+class Exporter:
+    def __init__(self, max_size=TRACE_QUEUE_SIZE):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.pid = None
+
+    def start(self):
+        self.queue = queue.Queue(self.max_size)
+        thread = threading.Thread(target=self.run, daemon=True, name='trace-exporter')
+        thread.start()
+        self.pid = os.getpid()
+
+    def export(self, span):
+        # (Re)start the writer thread lazily, also after a fork
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.start()
+        try:
+            self.queue.put_nowait(span)
+        except queue.Full:
+            pass
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < 500:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.write(batch)
+            except Exception as e:
+                logger.warning(f"Failed to export {len(batch)} spans: {e}")
+
+    def write(self, batch):
+        if TRACE_FILE:
+            with open(TRACE_FILE, 'a') as trace_file:
+                trace_file.write(''.join(json.dumps(span) + '\n' for span in batch))
+        if TRACE_COLLECTOR_URL:
+            body = json.dumps({"spans": batch}).encode()
+            collector_request = urllib.request.Request(
+                TRACE_COLLECTOR_URL, data=body, headers={'Content-Type': 'application/json'})
+            urllib.request.urlopen(collector_request, timeout=5).close()
+
+
+exporter = Exporter()
+
+
+# Name the spans of this process and trace its database statements
+def configure(name):
+    global service_name
+    service_name = name
+    if TRACING_ENABLED:
+        try:
+            from common import db
+        except ImportError:
+            return
+        db.query_observers.append(record_query)
+
+
+# Trace every request handled by a Flask app and the database statements it
+# runs; incoming trace context and request ids are continued, and the request
+# id is echoed back in the response
+def init_tracing(app, name):
+    configure(name)
+
+    @app.before_request
+    def start_request_span():
+        request_id = request.headers.get(REQUEST_ID_HEADER) or uuid.uuid4().hex
+        g.trace_tokens = [current_request_id.set(request_id)]
+        if TRACING_ENABLED:
+            parent = parse_traceparent(request.headers.get('traceparent'))
+            span = Span(f"{request.method} {request.url_rule.rule if request.url_rule else 'unmatched'}", 'server', parent,
+                        {"http.method": request.method, "http.target": request.full_path.rstrip('?')})
+            g.trace_span = span
+            g.trace_tokens.append(current_span.set(span))
+
+    @app.after_request
+    def finish_request_span(response):
+        response.headers[REQUEST_ID_HEADER] = current_request_id.get()
+        span = g.get('trace_span')
+        if span is not None:
+            span.set_attribute('http.status_code', response.status_code)
+            if response.status_code >= 500:
+                span.status = 'error'
+        return response
+
+    @app.teardown_request
+    def end_request_span(exc):
+        span = g.pop('trace_span', None)
+        if span is not None:
+            if exc is not None:
+                span.status = 'error'
+                span.set_attribute('error', type(exc).__name__)
+            span.end()
+        for token in reversed(g.pop('trace_tokens', [])):
+            token.var.reset(token)
@@ -1,39 +1,27 @@
 from flask import Flask, request, jsonify
-import psycopg2
-from psycopg2.extras import RealDictCursor
-import os
-import logging
+from common.log import configure_logging, get_logger
+from common.db import get_db_connection
+from common.metrics import init_metrics
+from common.tracing import init_tracing
+from common.profiling import init_profiling
+from common.codec import init_codec
+from common.slow_queries import init_slow_query_log
+from common.idempotency import (init_idempotency, create_idempotency_table, claim_idempotency_key,
+                                remember_response, start_idempotency_cleanup)
+from common.change_feed import create_change_feed, init_change_feed, start_change_feed_pruning
 
 app = Flask(__name__)
+init_metrics(app, 'doctor_service')
+init_tracing(app, 'doctor_service')
+init_profiling(app, 'doctor_service')
+init_codec(app)
+init_slow_query_log(app)
+init_idempotency(app)
+init_change_feed(app, 'doctors', get_db_connection)
 
 # Configure logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
-
-# Function to get database configuration from environment variables
-def get_db_config():
-    return {
-        'user': os.getenv('DB_USER'),
-        'password': os.getenv('DB_PASSWORD'),
-        'host': os.getenv('DB_HOST'),
-        'database': os.getenv('DB_NAME')
-    }
-
-# Function to establish a connection to the database
-def get_db_connection():
-    config = get_db_config()
-    try:
-        conn = psycopg2.connect(
-            host=config['host'],
-            database=config['database'],
-            user=config['user'],
-            password=config['password'],
-            cursor_factory=RealDictCursor
-        )
-        return conn
-    except Exception as e:
-        logger.error(f"Error connecting to the database: {e}")
-        return None
+configure_logging('doctor_service')
+logger = get_logger(__name__)
 
 # Function to initialize the database and create the 'doctors' table
 def initialize_database():
@@ -53,16 +41,22 @@ def initialize_database():
                 experience_years INTEGER NOT NULL
             );
         """)
+        # Other services follow this table's ids through GET /changes
+        create_change_feed(cursor, 'doctors')
+        # Responses of create requests sent with an Idempotency-Key
+        create_idempotency_table(cursor)
         conn.commit()
         logger.info("Database initialized successfully.")
     except Exception as e:
-        logger.error(f"Error initializing database: {e}")
+        logger.error("Error initializing database", error=e)
     finally:
         cursor.close()
         conn.close()
 
 # Initialize the database when the service starts
 initialize_database()
+start_idempotency_cleanup(get_db_connection)
+start_change_feed_pruning(get_db_connection, 'doctors')
 
 # Route to get all doctors
 @app.route('/doctors', methods=['GET'])
@@ -77,7 +71,7 @@ def get_doctors():
         doctors = cursor.fetchall()
         return jsonify(doctors), 200
     except Exception as e:
-        logger.error(f"Error fetching doctors: {e}")
+        logger.error("Error fetching doctors", error=e)
         return jsonify({"error": "Failed to fetch doctors"}), 500
     finally:
         cursor.close()
@@ -100,16 +94,22 @@ def add_doctor():
 
     try:
         cursor = conn.cursor()
+        # A retry with the same Idempotency-Key gets the first response back
+        replay = claim_idempotency_key(cursor)
+        if replay is not None:
+            return replay
         cursor.execute(
             "INSERT INTO doctors (name, specialty, experience_years) VALUES (%s, %s, %s) RETURNING id;",
             (name, specialty, experience_years)
         )
         doctor_id = cursor.fetchone()['id']
+        response = {"id": doctor_id, "message": "Doctor added successfully"}
+        remember_response(cursor, response, 201)
         conn.commit()
-        logger.info(f"Patient {doctor_id} added: name = {name}, specialty = {specialty}, experience_years = {experience_years}")
-        return jsonify({"id": doctor_id, "message": "Doctor added successfully"}), 201
+        logger.info("Doctor added", doctor_id=doctor_id, name=name, specialty=specialty, experience_years=experience_years)
+        return jsonify(response), 201
     except Exception as e:
-        logger.error(f"Error adding doctor: {e}")
+        logger.error("Error adding doctor", error=e)
         return jsonify({"error": "Failed to add doctor"}), 500
     finally:
         cursor.close()
@@ -134,10 +134,10 @@ def update_doctor(doctor_id):
             (name, specialty, experience_years, doctor_id)
         )
         conn.commit()
-        logger.info(f"Patient {doctor_id} updated: name = {name}, specialty = {specialty}, experience_years = {experience_years}")
+        logger.info("Doctor updated", doctor_id=doctor_id, name=name, specialty=specialty, experience_years=experience_years)
         return jsonify({"message": "Doctor updated successfully"}), 200
     except Exception as e:
-        logger.error(f"Error updating doctor: {e}")
+        logger.error("Error updating doctor", error=e)
         return jsonify({"error": "Failed to update doctor"}), 500
     finally:
         cursor.close()
@@ -154,10 +154,10 @@ def delete_doctor(doctor_id):
         cursor = conn.cursor()
         cursor.execute("DELETE FROM doctors WHERE id = %s;", (doctor_id,))
         conn.commit()
-        logger.info(f"Doctor {doctor_id} deleted")
+        logger.info("Doctor deleted", doctor_id=doctor_id)
         return jsonify({"message": "Doctor deleted successfully"}), 200
     except Exception as e:
-        logger.error(f"Error deleting doctor: {e}")
+        logger.error("Error deleting doctor", error=e)
         return jsonify({"error": "Failed to delete doctor"}), 500
     finally:
         cursor.close()
@@ -0,0 +1,227 @@
+import os
+import math
+import time
+import sqlite3
+import logging
+import tempfile
+import threading
+from flask import request, jsonify
+from common.metrics import observe_shed
+
+logger = logging.getLogger(__name__)
+
+# Admission control for the gateway. Each client gets a token bucket per
+# route, refilled at the route's rate up to its burst; a request that finds
+# the bucket empty is turned away with 429 and a Retry-After of when the
+# next token arrives. Calls to each upstream service are capped at a number
+# in flight per gateway process, and a call over the cap fails at once with
+# 503 instead of queueing behind the others.
+#
+# Limits are "<requests per second>/<burst>". RATE_LIMIT applies to every
+# route; RATE_LIMITS overrides single routes, e.g.
+#
+#     RATE_LIMITS="GET /medical_records=5/10,POST /bills=2/5"
+#
+# Clients are told apart by RATE_LIMIT_CLIENT_HEADER (an API key), or by
+# address when they don't send it. Rate limiting is off unless RATE_LIMITING
+# is set: behind a load balancer every client has the balancer's address.
+RATE_LIMITING = os.getenv('RATE_LIMITING', 'false').lower() in ('1', 'true', 'yes')
+RATE_LIMIT = os.getenv('RATE_LIMIT', '50/100')
+RATE_LIMITS = os.getenv('RATE_LIMITS', '')
+RATE_LIMIT_CLIENT_HEADER = os.getenv('RATE_LIMIT_CLIENT_HEADER', 'X-Api-Key')
+# Where the buckets are kept: 'memory' (this process only) or the path of a
+# SQLite file, which stands in for a shared store such as Redis: every
+# worker and every gateway replica on the host (or sharing the volume) that
+# points at the same file draws from the same buckets
+RATE_LIMIT_STORE = os.getenv('RATE_LIMIT_STORE', os.path.join(tempfile.gettempdir(), 'gateway-rate-limits.sqlite3'))
+# Calls in flight per upstream service: UPSTREAM_CONCURRENCY for each, or
+# per service in UPSTREAM_CONCURRENCY_LIMITS, e.g. "medical_record_service=8"
+UPSTREAM_CONCURRENCY = int(os.getenv('UPSTREAM_CONCURRENCY', os.getenv('UPSTREAM_POOL_SIZE', '32')))
+UPSTREAM_CONCURRENCY_LIMITS = os.getenv('UPSTREAM_CONCURRENCY_LIMITS', '')
+UPSTREAM_RETRY_AFTER = int(os.getenv('UPSTREAM_RETRY_AFTER', '1'))
+# Buckets idle this long are full again and are dropped from the store
+IDLE_BUCKET_SECONDS = 3600
+EXEMPT_ENDPOINTS = ('metrics',)
+
+
+def parse_limit(value):
+    rate, _, burst = value.partition('/')
+    rate = float(rate)
+    return rate, float(burst) if burst else max(rate, 1.0)
+
+
+def parse_limits(value):
+    limits = {}
+    for entry in value.split(','):
+        if entry.strip():
+            route, _, limit = entry.rpartition('=')
+            limits[route.strip()] = parse_limit(limit.strip())
+    return limits
+
+
+# Take one token from a bucket holding 'tokens' as of 'updated'. Returns the
+# tokens left and how long to wait for a token (0 when one was taken).
+def take_token(tokens, updated, rate, burst, now):
+    tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0.0
+    return tokens, (1 - tokens) / rate
+
+
+class MemoryStore:
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.swept_at = time.time()
+
+    def take(self, key, rate, burst, now):
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (burst, now))
+            tokens, wait = take_token(tokens, updated, rate, burst, now)
+            self.buckets[key] = (tokens, now)
+            if now - self.swept_at > IDLE_BUCKET_SECONDS:
+                self.buckets = {key: bucket for key, bucket in self.buckets.items() if now - bucket[1] < IDLE_BUCKET_SECONDS}
+                self.swept_at = now
+            return wait
+
+
+class SQLiteStore:
+    def __init__(self, path, timeout=1.0):
+        self.path = path
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.conn = None
+        self.pid = None
+        self.swept_at = time.time()
+
+    # One connection per process, shared under the lock by its threads (or
+    # gevent greenlets, which would each get their own from a threading.local),
+    # and a new one in a forked worker
+    def connection(self):
+        if self.conn is None or self.pid != os.getpid():
+            # No busy timeout: SQLite's busy handler sleeps in C, which would
+            # stall a gevent worker's whole event loop (see begin())
+            conn = sqlite3.connect(self.path, timeout=0, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode = WAL;")
+            conn.execute("PRAGMA synchronous = OFF;")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS token_buckets (
+                    key TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated REAL NOT NULL
+                );
+            """)
+            self.conn, self.pid = conn, os.getpid()
+        return self.conn
+
+    # Take the write lock up front so read-modify-write is atomic across
+    # processes, retrying with time.sleep (which yields under gevent) while
+    # another process holds it
+    def begin(self, conn):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                conn.execute("BEGIN IMMEDIATE;")
+                return
+            except sqlite3.OperationalError as e:
+                if 'locked' not in str(e) or time.monotonic() > deadline:
+                    raise
+                time.sleep(0.001)
+
+    def take(self, key, rate, burst, now):
+        with self.lock:
+            conn = self.connection()
+            self.begin(conn)
+            try:
+                row = conn.execute("SELECT tokens, updated FROM token_buckets WHERE key = ?;", (key,)).fetchone()
+                tokens, updated = row if row else (burst, now)
+                tokens, wait = take_token(tokens, updated, rate, burst, now)
+                conn.execute("INSERT OR REPLACE INTO token_buckets (key, tokens, updated) VALUES (?, ?, ?);", (key, tokens, now))
+                if now - self.swept_at > IDLE_BUCKET_SECONDS:
+                    conn.execute("DELETE FROM token_buckets WHERE updated < ?;", (now - IDLE_BUCKET_SECONDS,))
+                    self.swept_at = now
+                conn.execute("COMMIT;")
+            except Exception:
+                conn.execute("ROLLBACK;")
+                raise
+            return wait
+
+
+def open_store(value=RATE_LIMIT_STORE):
+    if value == 'memory':
+        return MemoryStore()
+    return SQLiteStore(value)
+
+
+class Overloaded(Exception):
+    """An upstream service already has as many calls in flight as allowed."""
+
+    def __init__(self, service):
+        super().__init__(service)
+        self.service = service
+
+
+# Non-blocking cap on calls in flight per upstream service
+class ConcurrencyLimiter:
+    def __init__(self, default=UPSTREAM_CONCURRENCY, limits=UPSTREAM_CONCURRENCY_LIMITS):
+        self.default = default
+        self.limits = {service: int(limit) for service, limit in
+                       (entry.split('=') for entry in limits.split(',') if entry.strip())}
+        self.slots = {}
+        self.lock = threading.Lock()
+
+    def semaphore(self, service):
+        slots = self.slots.get(service)
+        if slots is None:
+            with self.lock:
+                slots = self.slots.setdefault(service, threading.BoundedSemaphore(self.limits.get(service, self.default)))
+        return slots
+
+    def acquire(self, service):
+        if not self.semaphore(service).acquire(blocking=False):
+            observe_shed("concurrency", service)
+            raise Overloaded(service)
+
+    def release(self, service):
+        self.semaphore(service).release()
+
+
+upstream_limiter = ConcurrencyLimiter()
+
+
+def client_id():
+    return request.headers.get(RATE_LIMIT_CLIENT_HEADER) or request.remote_addr or 'unknown'
+
+
+def init_admission(app):
+    @app.errorhandler(Overloaded)
+    def shed_overloaded(e):
+        response = jsonify({"error": f"{e.service} is overloaded, try again shortly"})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(UPSTREAM_RETRY_AFTER)
+        return response
+
+    if not RATE_LIMITING:
+        return
+    default = parse_limit(RATE_LIMIT)
+    overrides = parse_limits(RATE_LIMITS)
+    store = open_store()
+
+    @app.before_request
+    def limit_rate():
+        if request.url_rule is None or request.endpoint in EXEMPT_ENDPOINTS:
+            return
+        route = f"{request.method} {request.url_rule.rule}"
+        rate, burst = overrides.get(route, default)
+        try:
+            wait = store.take(f"{client_id()}|{route}", rate, burst, time.time())
+        except Exception as e:
+            # A store that can't be reached shouldn't take the gateway down with it
+            logger.warning(f"Rate limit store unavailable, admitting request: {e}")
+            return
+        if wait:
+            observe_shed("rate_limit", route)
+            response = jsonify({"error": "Too many requests"})
+            response.status_code = 429
+            response.headers['Retry-After'] = str(math.ceil(wait))
+            return response
@@ -0,0 +1,177 @@
+import os
+import zlib
+import hashlib
+import threading
+from collections import OrderedDict
+from flask import request
+
+# Accept-Encoding negotiated compression for gateway responses. zstd and
+# brotli are used when their packages are installed; gzip always is.
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', '1024'))
+# Bodies at least this large are compressed and sent in chunks as they go
+COMPRESS_STREAM_SIZE = int(os.getenv('COMPRESS_STREAM_SIZE', str(1024 * 1024)))
+COMPRESS_CHUNK_SIZE = 64 * 1024
+COMPRESS_LEVELS = {
+    'gzip': int(os.getenv('GZIP_LEVEL', '6')),
+    'br': int(os.getenv('BROTLI_QUALITY', '4')),
+    'zstd': int(os.getenv('ZSTD_LEVEL', '3')),
+}
+# Memory kept for compressed bodies, shared by all responses (0 disables)
+COMPRESS_CACHE_BYTES = int(os.getenv('COMPRESS_CACHE_BYTES', str(32 * 1024 * 1024)))
+COMPRESSIBLE_TYPES = ('application/json', 'text/')
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class GzipStream:
+    def __init__(self, level):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush()
+
+
+class BrotliStream:
+    def __init__(self, level):
+        self.compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.finish()
+
+
+class ZstdStream:
+    def __init__(self, level):
+        self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush()
+
+
+# Supported encodings in order of preference when the client rates them equally
+ENCODINGS = OrderedDict()
+if zstandard is not None:
+    ENCODINGS['zstd'] = ZstdStream
+if brotli is not None:
+    ENCODINGS['br'] = BrotliStream
+ENCODINGS['gzip'] = GzipStream
+
+
+# Pick the encoding for an Accept-Encoding header, or None for identity
+def negotiate(header):
+    ratings = {}
+    for part in (header or '').split(','):
+        coding, _, params = part.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if coding:
+            ratings[coding.strip().lower()] = quality
+    best, best_quality = None, 0.0
+    for encoding in ENCODINGS:
+        quality = ratings.get(encoding, ratings.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+# Least recently used compressed bodies, keyed by a digest of the
+# uncompressed body and the encoding, so repeated list responses with the
+# same content are compressed once
+class CompressedCache:
+    def __init__(self, max_bytes=COMPRESS_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            body = self.entries.get(key)
+            if body is not None:
+                self.entries.move_to_end(key)
+            return body
+
+    def put(self, key, body):
+        if len(body) > self.max_bytes // 4:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = body
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+
+cache = CompressedCache()
+
+
+def compress_chunks(encoding, body, key):
+    stream = ENCODINGS[encoding](COMPRESS_LEVELS[encoding])
+    parts = []
+    for offset in range(0, len(body), COMPRESS_CHUNK_SIZE):
+        chunk = stream.compress(body[offset:offset + COMPRESS_CHUNK_SIZE])
+        if chunk:
+            parts.append(chunk)
+            yield chunk
+    tail = stream.flush()
+    parts.append(tail)
+    yield tail
+    if key is not None:
+        cache.put(key, b''.join(parts))
+
+
+# after_request hook: compress the body if the client accepts it and it's
+# worth it; large bodies are streamed chunk by chunk
+def compress_response(response):
+    if (response.status_code < 200 or response.status_code in (204, 206, 304)
+            or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers
+            or not response.mimetype.startswith(COMPRESSIBLE_TYPES)):
+        return response
+    response.vary.add('Accept-Encoding')
+
+    encoding = negotiate(request.headers.get('Accept-Encoding'))
+    if encoding is None:
+        return response
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_SIZE:
+        return response
+
+    key = (hashlib.blake2b(body, digest_size=16).digest(), encoding) if COMPRESS_CACHE_BYTES > 0 else None
+    compressed = cache.get(key) if key is not None else None
+    response.headers['Content-Encoding'] = encoding
+    if compressed is not None:
+        response.set_data(compressed)
+    elif len(body) >= COMPRESS_STREAM_SIZE:
+        response.response = compress_chunks(encoding, body, key)
+        response.headers.pop('Content-Length', None)
+    else:
+        response.set_data(b''.join(compress_chunks(encoding, body, key)))
+    return response
+
+
+def init_compression(app):
+    app.after_request(compress_response)
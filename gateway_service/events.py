@@ -0,0 +1,96 @@
+import os
+import json
+import time
+import logging
+import threading
+import requests
+from flask import request
+from common.events import EventHub, sse_response, parse_events
+
+logger = logging.getLogger(__name__)
+
+# Appointment change events for clients (e.g. reception dashboards) on
+# GET /appointments/events. Each gateway process follows the appointment
+# service's event stream over one upstream connection and fans it out to
+# all of its subscribers through an EventHub, each filtered by the
+# subscriber's doctor_id, patient_id and from/to (on appointment_date).
+EVENT_RECONNECT_DELAY = float(os.getenv('EVENT_RECONNECT_DELAY', '1.0'))
+# An upstream stream silent for this long is considered dead (the service
+# sends keepalives more often)
+EVENT_UPSTREAM_TIMEOUT = float(os.getenv('EVENT_UPSTREAM_TIMEOUT', '60'))
+
+
+class UpstreamFollower:
+    def __init__(self, hub, get_url):
+        self.hub = hub
+        self.get_url = get_url
+        self.last_event_id = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    # Start following; called for every subscriber, and starts a new
+    # follower in a forked worker, which doesn't inherit the thread
+    def ensure_started(self):
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            threading.Thread(target=self.run, name="appointment-events", daemon=True).start()
+
+    def follow(self):
+        headers = {'Accept': 'text/event-stream'}
+        # The service replays what we missed while reconnecting, or sends a reset
+        if self.last_event_id is not None:
+            headers['Last-Event-ID'] = self.last_event_id
+        with requests.get(self.get_url(), headers=headers, stream=True, timeout=(5, EVENT_UPSTREAM_TIMEOUT)) as response:
+            response.raise_for_status()
+            for event_type, data, event_id in parse_events(response.iter_lines(decode_unicode=True)):
+                if event_type == 'reset':
+                    self.hub.reset()
+                else:
+                    self.hub.publish(event_type, json.loads(data), event_id)
+                if event_id is not None:
+                    self.last_event_id = event_id
+
+    def run(self):
+        while True:
+            try:
+                self.follow()
+            except Exception as e:
+                logger.warning(f"Lost the appointment event stream: {e}")
+            time.sleep(EVENT_RECONNECT_DELAY)
+
+
+def appointment_filter(args):
+    doctor_id = args.get('doctor_id', type=int)
+    patient_id = args.get('patient_id', type=int)
+    start, end = args.get('from'), args.get('to')
+    if doctor_id is None and patient_id is None and not start and not end:
+        return None
+
+    # Dates are compared as ISO strings, like from/to on GET /appointments
+    def matches(event):
+        appointment = event['appointment']
+        date = appointment['appointment_date']
+        return ((doctor_id is None or appointment['doctor_id'] == doctor_id)
+                and (patient_id is None or appointment['patient_id'] == patient_id)
+                and (not start or date >= start)
+                and (not end or date < end))
+    return matches
+
+
+hub = EventHub()
+
+
+# Register GET /appointments/events; 'get_url' returns the URL of the
+# appointment service's event stream
+def init_events(app, get_url):
+    follower = UpstreamFollower(hub, get_url)
+
+    def appointment_events():
+        follower.ensure_started()
+        return sse_response(hub.stream(request.headers.get('Last-Event-ID'), appointment_filter(request.args)))
+
+    app.add_url_rule('/appointments/events', 'appointment_events', appointment_events, methods=['GET'])
@@ -1,10 +1,27 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, g
 import requests
+import os
+import time
+from common.log import configure_logging
+from common.metrics import init_metrics, observe_upstream
+from common.tracing import init_tracing, start_span, outbound_headers
+from common.profiling import init_profiling
+from common.codec import request_headers, body_kwargs, decode_response
+from compression import init_compression
+from admission import init_admission, upstream_limiter
+from events import init_events
+
+configure_logging('gateway_service')
 
 app = Flask(__name__)
+init_metrics(app, 'gateway_service')
+init_tracing(app, 'gateway_service')
+init_profiling(app, 'gateway_service')
+init_compression(app)
+init_admission(app)
 
-# List of microservices with their instances for round-robin
-services = {
+# Default instances of each microservice for round-robin
+default_services = {
     "patient_service": ["http://patient_service:4000"],
     "doctor_service": ["http://doctor_service:5000"],
     "medical_record_service": ["http://medical_record_service:6000"],
@@ -12,6 +29,13 @@ services = {
     "billing_service": ["http://billing_service:8000"]
 }
 
+# List of microservices with their instances, overridable with a
+# comma-separated <SERVICE>_URLS variable, e.g. PATIENT_SERVICE_URLS
+services = {
+    name: os.getenv(f"{name.upper()}_URLS", ",".join(instances)).split(",")
+    for name, instances in default_services.items()
+}
+
 # Round-robin counters for each service
 counters = {service: 0 for service in services}
 
@@ -23,17 +47,78 @@ def get_next_instance(service_name):
     counters[service_name] = (index + 1) % len(instances)
     return next_instance
 
+# One session for all upstream calls so connections to the services are reused
+session = requests.Session()
+session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=int(os.getenv("UPSTREAM_POOL_SIZE", "32"))))
+# Seconds to wait for a service to accept the connection and to answer
+UPSTREAM_TIMEOUT = (float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "3.05")),
+                    float(os.getenv("UPSTREAM_READ_TIMEOUT", "30")))
+
+class UpstreamTimeout(Exception):
+    """A service did not answer within UPSTREAM_TIMEOUT."""
+
+    def __init__(self, service):
+        super().__init__(service)
+        self.service = service
+
+@app.errorhandler(UpstreamTimeout)
+def upstream_timeout(e):
+    return jsonify({"error": f"{e.service} did not respond in time"}), 504
+
+def call_service(service_name, method, url, **kwargs):
+    """Make a request to a service instance, recording its time per service"""
+    start = time.perf_counter()
+    status = "error"
+    # Bodies and responses use the internal codec (see common/codec.py);
+    # routes still pass json= and get plain data back from decode_response
+    headers = outbound_headers()
+    headers.update(request_headers())
+    # Retries of a create are recognised by the service, which keeps the key
+    if "Idempotency-Key" in request.headers:
+        headers["Idempotency-Key"] = request.headers["Idempotency-Key"]
+    headers.update(kwargs.pop("headers", {}))
+    if "json" in kwargs:
+        body = body_kwargs(kwargs.pop("json"))
+        headers.update(body.pop("headers", {}))
+        kwargs.update(body)
+    kwargs.setdefault("timeout", UPSTREAM_TIMEOUT)
+    # Over the service's limit of calls in flight the request is shed (503)
+    upstream_limiter.acquire(service_name)
+    with start_span(f"{method} {service_name}", "client", **{"http.url": url}) as span:
+        try:
+            try:
+                response = session.request(method, url, headers=headers, **kwargs)
+            except requests.exceptions.Timeout:
+                status = "timeout"
+                raise UpstreamTimeout(service_name)
+            status = response.status_code
+            if span is not None:
+                span.set_attribute("http.status_code", status)
+            if "Idempotent-Replayed" in response.headers:
+                g.idempotent_replayed = response.headers["Idempotent-Replayed"]
+            return response
+        finally:
+            upstream_limiter.release(service_name)
+            observe_upstream(service_name, time.perf_counter() - start, status)
+
+@app.after_request
+def pass_on_replayed(response):
+    """Tell the client when a service answered with a stored response"""
+    if "idempotent_replayed" in g:
+        response.headers["Idempotent-Replayed"] = g.idempotent_replayed
+    return response
+
 # Patient routes
 @app.route('/patients', methods=['GET'])
 @app.route('/patients', methods=['POST'])
 def patients():
     url = get_next_instance("patient_service") + "/patients"
     if request.method == 'GET':
-        response = requests.get(url)
+        response = call_service("patient_service", "GET", url)
     elif request.method == 'POST':
         data = request.get_json()
-        response = requests.post(url, json=data)
-    return jsonify(response.json()), response.status_code
+        response = call_service("patient_service", "POST", url, json=data)
+    return jsonify(decode_response(response)), response.status_code
 
 @app.route('/patients/<int:patient_id>', methods=['PUT', 'DELETE'])
 def patient_by_id(patient_id):
@@ -42,13 +127,13 @@ def patient_by_id(patient_id):
     if request.method == 'PUT':
         data = request.get_json()
         try:
-            response = requests.put(url, json=data)
+            response = call_service("patient_service", "PUT", url, json=data)
         except requests.exceptions.RequestException as e:
             app.logger.error(f"Error making PUT request: {e}")
             return jsonify({"error": "Failed to make PUT request"}), 500
     elif request.method == 'DELETE':
         try:
-            response = requests.delete(url)
+            response = call_service("patient_service", "DELETE", url)
         except requests.exceptions.RequestException as e:
             app.logger.error(f"Error making DELETE request: {e}")
             return jsonify({"error": "Failed to make DELETE request"}), 500
@@ -57,7 +142,7 @@ def patient_by_id(patient_id):
         app.logger.error(f"404 Not Found at {url}")
         return jsonify({"error": "Resource not found"}), 404
 
-    return jsonify(response.json()), response.status_code
+    return jsonify(decode_response(response)), response.status_code
 
     
 # Doctor routes
@@ -66,11 +151,11 @@ def patient_by_id(patient_id):
 def doctors():
     url = get_next_instance("doctor_service") + "/doctors"
     if request.method == 'GET':
-        response = requests.get(url)
+        response = call_service("doctor_service", "GET", url)
     elif request.method == 'POST':
         data = request.get_json()
-        response = requests.post(url, json=data)
-    return jsonify(response.json()), response.status_code
+        response = call_service("doctor_service", "POST", url, json=data)
+    return jsonify(decode_response(response)), response.status_code
 
 @app.route('/doctors/<int:doctor_id>', methods=['PUT'])
 @app.route('/doctors/<int:doctor_id>', methods=['DELETE'])
@@ -78,10 +163,10 @@ def doctor_by_id(doctor_id):
     url = f"{get_next_instance('doctor_service')}/doctors/{doctor_id}"
     if request.method == 'PUT':
         data = request.get_json()
-        response = requests.put(url, json=data)
+        response = call_service("doctor_service", "PUT", url, json=data)
     elif request.method == 'DELETE':
-        response = requests.delete(url)
-    return jsonify(response.json()), response.status_code
+        response = call_service("doctor_service", "DELETE", url)
+    return jsonify(decode_response(response)), response.status_code
 
 # Medical record routes
 @app.route('/medical_records', methods=['GET'])
@@ -89,11 +174,12 @@ def doctor_by_id(doctor_id):
 def medical_records():
     url = get_next_instance("medical_record_service") + "/medical_records"
     if request.method == 'GET':
-        response = requests.get(url)
+        # Filters, sorting and the limit (patient_id, from, sort, ...) pass through
+        response = call_service("medical_record_service", "GET", url, params=request.args)
     elif request.method == 'POST':
         data = request.get_json()
-        response = requests.post(url, json=data)
-    return jsonify(response.json()), response.status_code
+        response = call_service("medical_record_service", "POST", url, json=data)
+    return jsonify(decode_response(response)), response.status_code
 
 @app.route('/medical_records/<int:record_id>', methods=['PUT'])
 @app.route('/medical_records/<int:record_id>', methods=['DELETE'])
@@ -101,10 +187,53 @@ def medical_record_by_id(record_id):
     url = f"{get_next_instance('medical_record_service')}/medical_records/{record_id}"
     if request.method == 'PUT':
         data = request.get_json()
-        response = requests.put(url, json=data)
+        response = call_service("medical_record_service", "PUT", url, json=data)
     elif request.method == 'DELETE':
-        response = requests.delete(url)
-    return jsonify(response.json()), response.status_code
+        response = call_service("medical_record_service", "DELETE", url)
+    return jsonify(decode_response(response)), response.status_code
+
+# Attachments of a medical record. Files are passed through a chunk at a
+# time in both directions, never held whole in the gateway.
+ATTACHMENT_CHUNK_SIZE = 64 * 1024
+# Headers passed on to and back from attachment downloads (Range requests,
+# conditional requests)
+DOWNLOAD_REQUEST_HEADERS = ('Range', 'If-Range', 'If-None-Match', 'If-Modified-Since')
+DOWNLOAD_RESPONSE_HEADERS = ('Content-Type', 'Content-Length', 'Content-Range', 'Content-Disposition',
+                             'Accept-Ranges', 'ETag', 'Last-Modified', 'Cache-Control')
+
+@app.route('/medical_records/<int:record_id>/attachments', methods=['GET'])
+@app.route('/medical_records/<int:record_id>/attachments', methods=['POST'])
+def medical_record_attachments(record_id):
+    url = f"{get_next_instance('medical_record_service')}/medical_records/{record_id}/attachments"
+    if request.method == 'GET':
+        response = call_service("medical_record_service", "GET", url)
+    elif request.method == 'POST':
+        # Sent on with chunked transfer encoding as it arrives
+        body = iter(lambda: request.stream.read(ATTACHMENT_CHUNK_SIZE), b'')
+        response = call_service("medical_record_service", "POST", url, params=request.args, data=body,
+                                headers={"Content-Type": request.content_type or "application/octet-stream"})
+    return jsonify(decode_response(response)), response.status_code
+
+@app.route('/medical_records/<int:record_id>/attachments/<sha256>', methods=['GET'])
+@app.route('/medical_records/<int:record_id>/attachments/<sha256>', methods=['DELETE'])
+def medical_record_attachment(record_id, sha256):
+    url = f"{get_next_instance('medical_record_service')}/medical_records/{record_id}/attachments/{sha256}"
+    if request.method == 'DELETE':
+        response = call_service("medical_record_service", "DELETE", url)
+        return jsonify(decode_response(response)), response.status_code
+
+    headers = {name: request.headers[name] for name in DOWNLOAD_REQUEST_HEADERS if name in request.headers}
+    response = call_service("medical_record_service", "GET", url, headers=headers, stream=True)
+    if response.status_code not in (200, 206, 304, 416):
+        try:
+            return jsonify(decode_response(response)), response.status_code
+        finally:
+            response.close()
+    download = Response(response.raw.stream(ATTACHMENT_CHUNK_SIZE, decode_content=False), status=response.status_code,
+                        headers={name: response.headers[name] for name in DOWNLOAD_RESPONSE_HEADERS if name in response.headers},
+                        direct_passthrough=True)
+    download.call_on_close(response.close)
+    return download
 
 # Appointment routes
 @app.route('/appointments', methods=['GET'])
@@ -112,23 +241,41 @@ def medical_record_by_id(record_id):
 def appointments():
     url = get_next_instance("appointment_service") + "/appointments"
     if request.method == 'GET':
-        response = requests.get(url)
+        response = call_service("appointment_service", "GET", url, params=request.args)
     elif request.method == 'POST':
         data = request.get_json()
-        response = requests.post(url, json=data)
-    return jsonify(response.json()), response.status_code
+        response = call_service("appointment_service", "POST", url, json=data)
+    return jsonify(decode_response(response)), response.status_code
 
 @app.route('/appointments/<int:appointment_id>', methods=['DELETE'])
 @app.route('/appointments/<int:appointment_id>/status', methods=['PUT'])
 def appointment_by_id(appointment_id):
     if request.method == 'DELETE':
         url = f"{get_next_instance('appointment_service')}/appointments/{appointment_id}"
-        response = requests.delete(url)
+        response = call_service("appointment_service", "DELETE", url)
     elif request.method == 'PUT':
         url = f"{get_next_instance('appointment_service')}/appointments/{appointment_id}/status"
         data = request.get_json()
-        response = requests.put(url, json=data)
-    return jsonify(response.json()), response.status_code
+        response = call_service("appointment_service", "PUT", url, json=data)
+    return jsonify(decode_response(response)), response.status_code
+
+# Doctor schedules and workload, from the appointment service's daily rollups
+@app.route('/doctors/<int:doctor_id>/schedule', methods=['GET'])
+@app.route('/doctors/<int:doctor_id>/workload', methods=['GET'])
+def doctor_schedule(doctor_id):
+    view = request.path.rsplit('/', 1)[-1]
+    url = f"{get_next_instance('appointment_service')}/doctors/{doctor_id}/{view}"
+    response = call_service("appointment_service", "GET", url, params=request.args)
+    return jsonify(decode_response(response)), response.status_code
+
+@app.route('/doctors/workload', methods=['GET'])
+def doctors_workload():
+    url = get_next_instance("appointment_service") + "/doctors/workload"
+    response = call_service("appointment_service", "GET", url, params=request.args)
+    return jsonify(decode_response(response)), response.status_code
+
+# Appointment changes as Server-Sent Events, fanned out from one upstream stream
+init_events(app, lambda: get_next_instance("appointment_service") + "/appointments/events")
 
 # Billing routes
 @app.route('/bills', methods=['GET'])
@@ -136,23 +283,42 @@ def appointment_by_id(appointment_id):
 def bills():
     url = get_next_instance("billing_service") + "/bills"
     if request.method == 'GET':
-        response = requests.get(url)
+        response = call_service("billing_service", "GET", url, params=request.args)
     elif request.method == 'POST':
         data = request.get_json()
-        response = requests.post(url, json=data)
-    return jsonify(response.json()), response.status_code
+        response = call_service("billing_service", "POST", url, json=data)
+    return jsonify(decode_response(response)), response.status_code
 
 @app.route('/bills/<int:bill_id>', methods=['DELETE'])
 @app.route('/bills/<int:bill_id>/status', methods=['PUT'])
 def bill_by_id(bill_id):
     if request.method == 'DELETE':
         url = f"{get_next_instance('billing_service')}/bills/{bill_id}"
-        response = requests.delete(url)
+        response = call_service("billing_service", "DELETE", url)
     elif request.method == 'PUT':
         url = f"{get_next_instance('billing_service')}/bills/{bill_id}/status"
         data = request.get_json()
-        response = requests.put(url, json=data)
-    return jsonify(response.json()), response.status_code
+        response = call_service("billing_service", "PUT", url, json=data)
+    return jsonify(decode_response(response)), response.status_code
+
+@app.route('/bills/status', methods=['PUT'])
+def bills_status():
+    url = get_next_instance("billing_service") + "/bills/status"
+    data = request.get_json()
+    response = call_service("billing_service", "PUT", url, json=data)
+    return jsonify(decode_response(response)), response.status_code
+
+@app.route('/bills/summary', methods=['GET'])
+def bills_summary():
+    url = get_next_instance("billing_service") + "/bills/summary"
+    response = call_service("billing_service", "GET", url, params=request.args)
+    return jsonify(decode_response(response)), response.status_code
+
+@app.route('/patients/<int:patient_id>/balance', methods=['GET'])
+def patient_balance(patient_id):
+    url = f"{get_next_instance('billing_service')}/patients/{patient_id}/balance"
+    response = call_service("billing_service", "GET", url)
+    return jsonify(decode_response(response)), response.status_code
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=8080)
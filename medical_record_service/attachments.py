@@ -0,0 +1,195 @@
+import os
+import time
+import fcntl
+import hashlib
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Files attached to medical records (scans, lab PDFs, images). The bytes
+# are stored once per content on local disk under ATTACHMENT_DIR, at
+# <sha256[:2]>/<sha256[2:4]>/<sha256>, shared by every shard; the metadata
+# (record, name, type, size) lives in record_attachments on the record's
+# shard and moves with its bucket. Uploads are written to disk a chunk at a
+# time while they are hashed, so no file is ever held whole in memory, and
+# a file that is already stored is not stored again.
+ATTACHMENT_DIR = os.getenv('ATTACHMENT_DIR', os.path.join(tempfile.gettempdir(), 'medical-record-attachments'))
+ATTACHMENT_CHUNK_SIZE = int(os.getenv('ATTACHMENT_CHUNK_SIZE', str(1024 * 1024)))
+ATTACHMENT_MAX_SIZE = int(os.getenv('ATTACHMENT_MAX_SIZE', str(512 * 1024 * 1024)))
+# Blobs no attachment refers to are deleted once they are this old
+ATTACHMENT_SWEEP_GRACE = float(os.getenv('ATTACHMENT_SWEEP_GRACE', '3600'))
+ATTACHMENT_SWEEP_INTERVAL = float(os.getenv('ATTACHMENT_SWEEP_INTERVAL', '3600'))
+SWEEP_BATCH_SIZE = 1000
+
+
+class AttachmentTooLarge(Exception):
+    """The upload is larger than ATTACHMENT_MAX_SIZE."""
+
+
+def create_attachment_table(cursor, buckets):
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS record_attachments (
+            record_id INTEGER NOT NULL REFERENCES medical_records (id) ON DELETE CASCADE,
+            sha256 CHAR(64) NOT NULL,
+            patient_id INTEGER NOT NULL,
+            filename VARCHAR(255) NOT NULL,
+            content_type VARCHAR(255) NOT NULL,
+            size BIGINT NOT NULL,
+            uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (record_id, sha256)
+        );
+        CREATE INDEX IF NOT EXISTS record_attachments_sha256_idx ON record_attachments (sha256);
+        CREATE INDEX IF NOT EXISTS record_attachments_bucket_idx ON record_attachments ((patient_id % {buckets}));
+    """)
+
+
+def is_digest(value):
+    return len(value) == 64 and all(char in '0123456789abcdef' for char in value)
+
+
+class Blob:
+    def __init__(self, sha256, size, deduplicated):
+        self.sha256 = sha256
+        self.size = size
+        self.deduplicated = deduplicated
+
+
+class BlobStore:
+    def __init__(self, root=ATTACHMENT_DIR):
+        self.root = root
+        self.incoming = os.path.join(root, 'incoming')
+        os.makedirs(self.incoming, exist_ok=True)
+
+    def path(self, sha256):
+        return os.path.join(self.root, sha256[:2], sha256[2:4], sha256)
+
+    # Uploads hold the lock shared from storing their blob until their
+    # metadata is committed; the sweeper holds it exclusively, so it never
+    # deletes a blob an upload has just found and is about to refer to
+    @contextmanager
+    def locked(self, exclusive=False):
+        with open(os.path.join(self.root, '.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    # Store everything read from 'stream' and yield its Blob. Meant to wrap
+    # the metadata insert: the blob is kept from the sweeper until the block
+    # ends, and is left for the sweeper if the block raises.
+    @contextmanager
+    def store(self, stream, max_size=ATTACHMENT_MAX_SIZE):
+        digest, size = hashlib.sha256(), 0
+        descriptor, temporary = tempfile.mkstemp(dir=self.incoming)
+        try:
+            with os.fdopen(descriptor, 'wb') as incoming:
+                while True:
+                    chunk = stream.read(ATTACHMENT_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > max_size:
+                        raise AttachmentTooLarge(max_size)
+                    digest.update(chunk)
+                    incoming.write(chunk)
+                incoming.flush()
+                os.fsync(incoming.fileno())
+
+            sha256 = digest.hexdigest()
+            path = self.path(sha256)
+            with self.locked():
+                deduplicated = os.path.exists(path)
+                if deduplicated:
+                    # Fresh again, so the sweeper's grace period starts over
+                    os.utime(path)
+                else:
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    os.replace(temporary, path)
+                yield Blob(sha256, size, deduplicated)
+        finally:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+
+    # Blobs (and abandoned uploads) last modified before 'cutoff'
+    def stale(self, cutoff):
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                path = os.path.join(directory, name)
+                try:
+                    if os.stat(path).st_mtime >= cutoff:
+                        continue
+                except FileNotFoundError:
+                    continue
+                if directory == self.incoming:
+                    yield None, path
+                elif is_digest(name):
+                    yield name, path
+
+
+def referenced_digests(shards, digests):
+    referenced = set()
+    for shard in shards:
+        conn = shard.get_connection()
+        if not conn:
+            raise ConnectionError(f"Failed to connect to shard {shard.name}")
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT DISTINCT sha256 FROM record_attachments WHERE sha256 = ANY(%s);", (digests,))
+            referenced.update(row['sha256'] for row in cursor.fetchall())
+            conn.rollback()
+        finally:
+            conn.close()
+    return referenced
+
+
+def delete_unreferenced(store, shards, candidates):
+    deleted = 0
+    with store.locked(exclusive=True):
+        referenced = referenced_digests(shards, [sha256 for sha256, _ in candidates])
+        for sha256, path in candidates:
+            if sha256 not in referenced:
+                try:
+                    os.remove(path)
+                    deleted += 1
+                except FileNotFoundError:
+                    pass
+    return deleted
+
+
+# Delete blobs that no attachment on any shard refers to any more (deleted
+# attachments and records, uploads whose record went away) once they are
+# older than 'grace' seconds, and uploads abandoned halfway. Returns the
+# number of files deleted.
+def sweep_blobs(store, shards, grace=ATTACHMENT_SWEEP_GRACE):
+    deleted, candidates = 0, []
+    for sha256, path in store.stale(time.time() - grace):
+        if sha256 is None:
+            os.remove(path)
+            deleted += 1
+            continue
+        candidates.append((sha256, path))
+        if len(candidates) == SWEEP_BATCH_SIZE:
+            deleted += delete_unreferenced(store, shards, candidates)
+            candidates = []
+    if candidates:
+        deleted += delete_unreferenced(store, shards, candidates)
+    return deleted
+
+
+def start_attachment_sweeper(store, shards, interval=ATTACHMENT_SWEEP_INTERVAL):
+    def sweep():
+        while not stop.wait(interval):
+            try:
+                deleted = sweep_blobs(store, shards)
+                if deleted:
+                    logger.info(f"Deleted {deleted} unreferenced attachment files")
+            except Exception as e:
+                logger.error(f"Error sweeping attachment files: {e}")
+
+    stop = threading.Event()
+    threading.Thread(target=sweep, name="attachment-sweeper", daemon=True).start()
+    return stop
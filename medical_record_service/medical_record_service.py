@@ -1,89 +1,101 @@
-from flask import Flask, request, jsonify
-import psycopg2
-from psycopg2.extras import RealDictCursor
 import os
-import logging
+from flask import Flask, request, jsonify, send_file
+from common.log import configure_logging, get_logger
+from common.metrics import init_metrics
+from common.tracing import init_tracing
+from common.profiling import init_profiling
+from common.codec import init_codec
+from common.slow_queries import init_slow_query_log
+from common.idempotency import (init_idempotency, claim_idempotency_key, remember_response, start_idempotency_cleanup,
+                                without_idempotency)
+from common.references import init_references, unknown_references
+from sharding import (load_shards, initialize_shards, ShardMap, BucketUnavailable, run_on_patient_shard,
+                      run_on_record_shard, records_query, gather)
+from attachments import BlobStore, AttachmentTooLarge, is_digest, start_attachment_sweeper
 
 app = Flask(__name__)
+init_metrics(app, 'medical_record_service')
+init_tracing(app, 'medical_record_service')
+init_profiling(app, 'medical_record_service')
+init_codec(app)
+init_slow_query_log(app)
+init_idempotency(app)
+init_references(app, patient_id='patient_service', doctor_id='doctor_service')
 
 # Configure logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
-
-# Function to get database configuration from environment variables
-def get_db_config():
-    return {
-        'user': os.getenv('DB_USER'),
-        'password': os.getenv('DB_PASSWORD'),
-        'host': os.getenv('DB_HOST'),
-        'database': os.getenv('DB_NAME')
-    }
-
-# Function to establish a connection to the database
-def get_db_connection():
-    config = get_db_config()
-    try:
-        conn = psycopg2.connect(
-            host=config['host'],
-            database=config['database'],
-            user=config['user'],
-            password=config['password'],
-            cursor_factory=RealDictCursor
-        )
-        return conn
-    except Exception as e:
-        logger.error(f"Error connecting to the database: {e}")
-        return None
+configure_logging('medical_record_service')
+logger = get_logger(__name__)
 
-# Function to initialize the database and create the 'medical_records' table
-def initialize_database():
-    conn = get_db_connection()
-    if not conn:
-        logger.error("Failed to connect to the database for initialization.")
-        return
+# Shards holding the medical records, and which of them owns each patient's bucket
+shards = load_shards()
+shard_map = ShardMap(shards)
+# Attachment files, stored once per content (see attachments.py)
+blob_store = BlobStore()
 
+# Function to initialize the database and create the 'medical_records' table on every shard
+def initialize_database():
     try:
-        cursor = conn.cursor()
-        logger.info("Creating 'medical_records' table if it doesn't exist...")
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS medical_records (
-                id SERIAL PRIMARY KEY,
-                patient_id INTEGER NOT NULL,
-                doctor_id INTEGER NOT NULL,
-                diagnosis TEXT NOT NULL,
-                treatment TEXT,
-                record_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-        """)
-        conn.commit()
+        logger.info("Creating 'medical_records' table if it doesn't exist...", shards=len(shards))
+        initialize_shards(shards)
         logger.info("Database initialized successfully.")
     except Exception as e:
-        logger.error(f"Error initializing database: {e}")
-    finally:
-        cursor.close()
-        conn.close()
+        logger.error("Error initializing database", error=e)
 
 # Initialize the database when the service starts
 initialize_database()
+start_idempotency_cleanup(*(shard.get_connection for shard in shards))
+start_attachment_sweeper(blob_store, shards)
 
-# Route to get all medical records
+# Route to get medical records, optionally filtered by patient_id, doctor_id,
+# diagnosis (substring), from <= record_date < to, sorted by 'sort' (id or
+# record_date, '-' for descending) and cut to 'limit'. Records of one patient
+# are read from that patient's shard; anything else is gathered from all.
 @app.route('/medical_records', methods=['GET'])
 def get_medical_records():
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({"error": "Database connection failed"}), 500
+    patient_id = request.args.get('patient_id', type=int)
+    doctor_id = request.args.get('doctor_id', type=int)
+    diagnosis = request.args.get('diagnosis')
+    start = request.args.get('from')
+    end = request.args.get('to')
+    sort = request.args.get('sort', 'id')
+    limit = request.args.get('limit', type=int)
+
+    order_column = sort.lstrip('-')
+    if order_column not in ('id', 'record_date'):
+        return jsonify({"error": "sort must be id or record_date"}), 400
+
+    conditions, params = [], []
+    if patient_id is not None:
+        conditions.append("m.patient_id = %s")
+        params.append(patient_id)
+    if doctor_id is not None:
+        conditions.append("m.doctor_id = %s")
+        params.append(doctor_id)
+    if diagnosis:
+        conditions.append("m.diagnosis ILIKE %s")
+        params.append(f"%{diagnosis}%")
+    if start:
+        conditions.append("m.record_date >= %s")
+        params.append(start)
+    if end:
+        conditions.append("m.record_date < %s")
+        params.append(end)
+    descending = sort.startswith('-')
 
     try:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM medical_records;")
-        records = cursor.fetchall()
+        if patient_id is not None:
+            def fetch(cursor):
+                cursor.execute(records_query(conditions, order_column, descending, limit), params + ([limit] if limit else []))
+                return cursor.fetchall()
+            records = run_on_patient_shard(shard_map, patient_id, fetch)
+        else:
+            records = gather(shards, conditions, params, order_column, descending, limit)
         return jsonify(records), 200
+    except BucketUnavailable:
+        return jsonify({"error": "This patient's records are being moved, try again shortly"}), 503
     except Exception as e:
-        logger.error(f"Error fetching medical records: {e}")
+        logger.error("Error fetching medical records", error=e)
         return jsonify({"error": "Failed to fetch medical records"}), 500
-    finally:
-        cursor.close()
-        conn.close()
 
 # Route to add a new medical record
 @app.route('/medical_records', methods=['POST'])
@@ -96,27 +108,44 @@ def add_medical_record():
 
     if not patient_id or not doctor_id or not diagnosis:
         return jsonify({"error": "Patient ID, Doctor ID, and Diagnosis are required"}), 400
+    try:
+        patient_id = int(patient_id)
+    except (TypeError, ValueError):
+        return jsonify({"error": "Patient ID must be a number"}), 400
+    # A negative id would land in no bucket (Postgres' % keeps the sign)
+    if patient_id <= 0:
+        return jsonify({"error": "Patient ID must be positive"}), 400
 
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({"error": "Database connection failed"}), 500
+    # Checked against local copies of the other services' ids, no request to them
+    unknown = unknown_references(patient_id=patient_id, doctor_id=doctor_id)
+    if unknown:
+        return jsonify({"error": f"Unknown {' and '.join(unknown)}"}), 400
 
-    try:
-        cursor = conn.cursor()
+    # Returns (replayed response, None) for a retry with a known
+    # Idempotency-Key, else (None, response body) for the new record
+    def insert(cursor):
+        replay = claim_idempotency_key(cursor, patient_id)
+        if replay is not None:
+            return replay, None
         cursor.execute(
             "INSERT INTO medical_records (patient_id, doctor_id, diagnosis, treatment) VALUES (%s, %s, %s, %s) RETURNING id;",
             (patient_id, doctor_id, diagnosis, treatment)
         )
-        record_id = cursor.fetchone()['id']
-        conn.commit()
-        logger.info(f"New record {record_id} added: patient_id = {patient_id}, doctor_id = {doctor_id}, diagnosis = {diagnosis}, treatment = {treatment}")
-        return jsonify({"id": record_id, "message": "Medical record added successfully"}), 201
+        response = {"id": cursor.fetchone()['id'], "message": "Medical record added successfully"}
+        remember_response(cursor, response, 201)
+        return None, response
+
+    try:
+        replay, response = run_on_patient_shard(shard_map, patient_id, insert, batched=True)
+        if replay is not None:
+            return replay
+        logger.info("Record added", record_id=response['id'], patient_id=patient_id, doctor_id=doctor_id, diagnosis=diagnosis, treatment=treatment)
+        return jsonify(response), 201
+    except BucketUnavailable:
+        return jsonify({"error": "This patient's records are being moved, try again shortly"}), 503
     except Exception as e:
-        logger.error(f"Error adding medical record: {e}")
+        logger.error("Error adding medical record", error=e)
         return jsonify({"error": "Failed to add medical record"}), 500
-    finally:
-        cursor.close()
-        conn.close()
 
 # Route to update a medical record
 @app.route('/medical_records/<int:record_id>', methods=['PUT'])
@@ -125,45 +154,138 @@ def update_medical_record(record_id):
     diagnosis = data.get('diagnosis')
     treatment = data.get('treatment')
 
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({"error": "Database connection failed"}), 500
-
-    try:
-        cursor = conn.cursor()
+    def update(cursor):
         cursor.execute(
             "UPDATE medical_records SET diagnosis = %s, treatment = %s WHERE id = %s;",
             (diagnosis, treatment, record_id)
         )
-        conn.commit()
-        logger.info(f"Record {record_id} updated: diagnosis = {diagnosis}, treatment = {treatment}")
+        return cursor.rowcount
+
+    try:
+        # Record ids don't say which shard holds them, so every shard is asked
+        if not run_on_record_shard(shards, record_id, update):
+            return jsonify({"error": "Medical record not found"}), 404
+        logger.info("Record updated", record_id=record_id, diagnosis=diagnosis, treatment=treatment)
         return jsonify({"message": "Medical record updated successfully"}), 200
     except Exception as e:
-        logger.error(f"Error updating medical record: {e}")
+        logger.error("Error updating medical record", error=e)
         return jsonify({"error": "Failed to update medical record"}), 500
-    finally:
-        cursor.close()
-        conn.close()
 
 # Route to delete a medical record
 @app.route('/medical_records/<int:record_id>', methods=['DELETE'])
 def delete_medical_record(record_id):
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({"error": "Database connection failed"}), 500
+    def delete(cursor):
+        cursor.execute("DELETE FROM medical_records WHERE id = %s;", (record_id,))
+        return cursor.rowcount
 
     try:
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM medical_records WHERE id = %s;", (record_id,))
-        conn.commit()
-        logger.info(f"Record {record_id} deleted")
+        if not run_on_record_shard(shards, record_id, delete):
+            return jsonify({"error": "Medical record not found"}), 404
+        logger.info("Record deleted", record_id=record_id)
         return jsonify({"message": "Medical record deleted successfully"}), 200
     except Exception as e:
-        logger.error(f"Error deleting medical record: {e}")
+        logger.error("Error deleting medical record", error=e)
         return jsonify({"error": "Failed to delete medical record"}), 500
-    finally:
-        cursor.close()
-        conn.close()
+
+# Route to list the attachments of a medical record
+@app.route('/medical_records/<int:record_id>/attachments', methods=['GET'])
+def get_attachments(record_id):
+    def fetch(cursor):
+        cursor.execute("SELECT * FROM record_attachments WHERE record_id = %s ORDER BY uploaded_at, sha256;", (record_id,))
+        return cursor.fetchall()
+
+    try:
+        attachments = run_on_record_shard(shards, record_id, fetch)
+        if attachments is None:
+            return jsonify({"error": "Medical record not found"}), 404
+        return jsonify(attachments), 200
+    except Exception as e:
+        logger.error("Error fetching attachments", record_id=record_id, error=e)
+        return jsonify({"error": "Failed to fetch attachments"}), 500
+
+# Route to attach a file to a medical record. The body is the file itself
+# (sent with its Content-Type, chunked or with a Content-Length) and is
+# streamed to disk; ?filename= names it. The same content attached to the
+# record again just updates its name and type.
+@app.route('/medical_records/<int:record_id>/attachments', methods=['POST'])
+@without_idempotency
+def add_attachment(record_id):
+    filename = (request.args.get('filename') or 'attachment')[:255]
+    content_type = (request.content_type or 'application/octet-stream')[:255]
+
+    def attach(blob):
+        def insert(cursor):
+            cursor.execute("""
+                INSERT INTO record_attachments (record_id, sha256, patient_id, filename, content_type, size)
+                SELECT id, %s, patient_id, %s, %s, %s FROM medical_records WHERE id = %s
+                ON CONFLICT (record_id, sha256) DO UPDATE
+                SET filename = EXCLUDED.filename, content_type = EXCLUDED.content_type
+                RETURNING *;
+            """, (blob.sha256, filename, content_type, blob.size, record_id))
+            return cursor.fetchone()
+        return run_on_record_shard(shards, record_id, insert)
+
+    try:
+        # Don't take the upload for a record that isn't there
+        if run_on_record_shard(shards, record_id, lambda cursor: True) is None:
+            return jsonify({"error": "Medical record not found"}), 404
+        with blob_store.store(request.stream) as blob:
+            if blob.size == 0:
+                return jsonify({"error": "Attachment is empty"}), 400
+            attachment = attach(blob)
+        if attachment is None:
+            return jsonify({"error": "Medical record not found"}), 404
+        logger.info("Attachment added", record_id=record_id, sha256=blob.sha256, size=blob.size, deduplicated=blob.deduplicated)
+        return jsonify(dict(attachment, deduplicated=blob.deduplicated)), 201
+    except AttachmentTooLarge as e:
+        return jsonify({"error": f"Attachments can be at most {e.args[0]} bytes"}), 413
+    except Exception as e:
+        logger.error("Error adding attachment", record_id=record_id, error=e)
+        return jsonify({"error": "Failed to add attachment"}), 500
+
+def find_attachment(record_id, sha256):
+    def fetch(cursor):
+        cursor.execute("SELECT * FROM record_attachments WHERE record_id = %s AND sha256 = %s;", (record_id, sha256))
+        return cursor.fetchone()
+    return run_on_record_shard(shards, record_id, fetch)
+
+# Route to download an attachment. Served straight from disk, with Range
+# requests (206 Partial Content) and conditional requests on its digest.
+@app.route('/medical_records/<int:record_id>/attachments/<sha256>', methods=['GET'])
+def download_attachment(record_id, sha256):
+    if not is_digest(sha256):
+        return jsonify({"error": "Attachment not found"}), 404
+    try:
+        attachment = find_attachment(record_id, sha256)
+    except Exception as e:
+        logger.error("Error fetching attachment", record_id=record_id, sha256=sha256, error=e)
+        return jsonify({"error": "Failed to fetch attachment"}), 500
+    if attachment is None:
+        return jsonify({"error": "Attachment not found"}), 404
+    path = blob_store.path(sha256)
+    if not os.path.exists(path):
+        logger.error("Attachment file is missing", record_id=record_id, sha256=sha256)
+        return jsonify({"error": "Attachment file is missing"}), 500
+    return send_file(path, mimetype=attachment['content_type'], as_attachment=True,
+                     download_name=attachment['filename'], conditional=True, etag=sha256,
+                     last_modified=attachment['uploaded_at'])
+
+# Route to remove an attachment from a medical record. The file itself is
+# deleted by the sweeper once no record refers to it.
+@app.route('/medical_records/<int:record_id>/attachments/<sha256>', methods=['DELETE'])
+def delete_attachment(record_id, sha256):
+    def delete(cursor):
+        cursor.execute("DELETE FROM record_attachments WHERE record_id = %s AND sha256 = %s;", (record_id, sha256))
+        return cursor.rowcount or None
+
+    try:
+        if not is_digest(sha256) or run_on_record_shard(shards, record_id, delete) is None:
+            return jsonify({"error": "Attachment not found"}), 404
+        logger.info("Attachment deleted", record_id=record_id, sha256=sha256)
+        return jsonify({"message": "Attachment deleted successfully"}), 200
+    except Exception as e:
+        logger.error("Error deleting attachment", record_id=record_id, sha256=sha256, error=e)
+        return jsonify({"error": "Failed to delete attachment"}), 500
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=6000)
@@ -0,0 +1,283 @@
+import sys
+import logging
+import argparse
+from psycopg2.extras import execute_values, Json
+from sharding import BUCKETS, BUCKET_TABLES as TABLES, load_shards, initialize_shards
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Move buckets of medical records between shards while the service keeps
+# running. The old shard first starts logging the keys of the bucket's rows
+# that change (see create_bucket_move_log in sharding.py). The bucket is
+# then copied to its new shard in batches, and its ownership is handed over
+# in a short final step: the old shard gives the bucket up (which waits for
+# writes in flight and holds off new ones), the logged rows are brought over,
+# and the new shard takes the bucket. Writers that raced the handover retry
+# on the new shard. The old copy is deleted afterwards.
+
+
+def upsert(table):
+    columns, key = TABLES[table]
+    return f"""
+        INSERT INTO {table} ({', '.join(columns)}) VALUES %s
+        ON CONFLICT ({', '.join(key)}) DO UPDATE SET
+        {', '.join(f'{column} = EXCLUDED.{column}' for column in columns if column not in key)};
+    """
+
+
+def connect(shard):
+    conn = shard.get_connection()
+    if not conn:
+        raise RuntimeError(f"Failed to connect to shard {shard.name}")
+    return conn
+
+
+def bucket_owners(shards):
+    owners = {}
+    for shard in shards:
+        conn = connect(shard)
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT bucket FROM record_buckets;")
+            for row in cursor.fetchall():
+                owners[row['bucket']] = shard
+            conn.rollback()
+        finally:
+            conn.close()
+    return owners
+
+
+# A fetched row as a tuple in TABLES order, ready to insert again (JSONB
+# columns come back as dicts and lists)
+def row_values(row, columns):
+    return tuple(Json(row[column]) if isinstance(row[column], (dict, list)) else row[column] for column in columns)
+
+
+# Rows of the table with the given keys, as tuples in TABLES order
+def rows_by_key(cursor, table, keys):
+    columns, key = TABLES[table]
+    rows = execute_values(cursor, f"SELECT {', '.join(columns)} FROM {table} WHERE ({', '.join(key)}) IN (VALUES %s);",
+                          keys, fetch=True)
+    return [row_values(row, columns) for row in rows]
+
+
+# Start logging changes to the bucket's rows on its shard. Taking the
+# bucket's row lock waits for writes in flight, which didn't log theirs.
+def start_tracking(conn, bucket, lock_timeout):
+    cursor = conn.cursor()
+    cursor.execute(f"SET LOCAL lock_timeout = '{int(lock_timeout * 1000)}ms';")
+    cursor.execute("DELETE FROM bucket_move_changes WHERE bucket = %s;", (bucket,))
+    cursor.execute("INSERT INTO moving_buckets (bucket) VALUES (%s) ON CONFLICT DO NOTHING;", (bucket,))
+    cursor.execute("SELECT bucket FROM record_buckets WHERE bucket = %s FOR UPDATE;", (bucket,))
+    if cursor.fetchone() is None:
+        raise RuntimeError(f"Bucket {bucket} is no longer owned by the source shard")
+    conn.commit()
+
+
+def stop_tracking(cursor, bucket):
+    cursor.execute("DELETE FROM moving_buckets WHERE bucket = %s;", (bucket,))
+    cursor.execute("DELETE FROM bucket_move_changes WHERE bucket = %s;", (bucket,))
+
+
+# Keys of the bucket's rows changed since tracking started, per table
+def changed_keys(cursor, bucket):
+    cursor.execute("SELECT DISTINCT table_name, row_key FROM bucket_move_changes WHERE bucket = %s;", (bucket,))
+    keys = {table: [] for table in TABLES}
+    for row in cursor.fetchall():
+        keys[row['table_name']].append(tuple(row['row_key']))
+    return keys
+
+
+# Copy the bucket to the target in batches of 'batch_size' rows, each
+# committed on its own so the source is never locked for long
+def copy_bucket(source_conn, target_conn, bucket, batch_size):
+    source, target = source_conn.cursor(), target_conn.cursor()
+    copied = 0
+    for table, (columns, key) in TABLES.items():
+        last_key = None
+        while True:
+            after = f"AND ({', '.join(key)}) > ({', '.join(['%s'] * len(key))})" if last_key else ""
+            source.execute(f"""
+                SELECT {', '.join(columns)} FROM {table}
+                WHERE patient_id %% {BUCKETS} = %s {after} ORDER BY {', '.join(key)} LIMIT %s;
+            """, (bucket, *(last_key or ()), batch_size))
+            rows = [row_values(row, columns) for row in source.fetchall()]
+            source_conn.rollback()
+            if not rows:
+                break
+            execute_values(target, upsert(table), rows, page_size=batch_size)
+            target_conn.commit()
+            last_key = tuple(rows[-1][columns.index(column)] for column in key)
+            if table == 'medical_records':
+                copied += len(rows)
+    return copied
+
+
+# Hand the bucket over. Writes to it on the source wait on the row lock
+# taken by the DELETE until the source commits; by then the target holds
+# every row and is about to own the bucket, so they retry there.
+def hand_over(source_conn, target_conn, bucket, lock_timeout):
+    source, target = source_conn.cursor(), target_conn.cursor()
+    source.execute(f"SET LOCAL lock_timeout = '{int(lock_timeout * 1000)}ms';")
+    source.execute("DELETE FROM record_buckets WHERE bucket = %s RETURNING bucket;", (bucket,))
+    if source.fetchone() is None:
+        raise RuntimeError(f"Bucket {bucket} is no longer owned by the source shard")
+
+    # Catch up with writes made during the copy: rows whose key was logged
+    # are copied again, or deleted from the target if they are gone
+    changed, removed = 0, 0
+    for table, keys in changed_keys(source, bucket).items():
+        columns, key = TABLES[table]
+        rows = rows_by_key(source, table, keys) if keys else []
+        present = {tuple(row[columns.index(column)] for column in key) for row in rows}
+        removed_keys = [row_key for row_key in keys if row_key not in present]
+        if rows:
+            execute_values(target, upsert(table), rows)
+        if removed_keys:
+            execute_values(target, f"DELETE FROM {table} WHERE ({', '.join(key)}) IN (VALUES %s);", removed_keys)
+        if table == 'medical_records':
+            changed, removed = len(rows), len(removed_keys)
+    stop_tracking(source, bucket)
+    target.execute("INSERT INTO record_buckets (bucket) VALUES (%s);", (bucket,))
+
+    # Give the bucket up first: if the target's commit then fails the bucket
+    # is briefly owned by nobody (writers retry) rather than by both
+    source_conn.commit()
+    try:
+        target_conn.commit()
+    except Exception:
+        source.execute("INSERT INTO record_buckets (bucket) VALUES (%s);", (bucket,))
+        source_conn.commit()
+        raise
+    return changed, removed
+
+
+# Delete the old copy of a moved bucket in batches (its attachments go with
+# their records), and its idempotency keys
+def purge_bucket(conn, bucket, batch_size):
+    cursor = conn.cursor()
+    cursor.execute(f"DELETE FROM idempotency_keys WHERE patient_id %% {BUCKETS} = %s;", (bucket,))
+    conn.commit()
+    purged = 0
+    while True:
+        cursor.execute(f"""
+            DELETE FROM medical_records WHERE id IN (
+                SELECT id FROM medical_records WHERE patient_id %% {BUCKETS} = %s LIMIT %s
+            );
+        """, (bucket, batch_size))
+        deleted = cursor.rowcount
+        conn.commit()
+        purged += deleted
+        if deleted < batch_size:
+            return purged
+
+
+def move_bucket(shards, bucket, target, batch_size=5000, lock_timeout=5.0):
+    source = bucket_owners(shards).get(bucket)
+    if source is None:
+        raise RuntimeError(f"Bucket {bucket} has no owner; is another move running?")
+    if source is target:
+        logger.info(f"Bucket {bucket} is already on {target.name}")
+        return
+
+    source_conn, target_conn = connect(source), connect(target)
+    try:
+        target_cursor = target_conn.cursor()
+        target_cursor.execute("SELECT 1 FROM record_buckets WHERE bucket = %s;", (bucket,))
+        if target_cursor.fetchone() is not None:
+            raise RuntimeError(f"Bucket {bucket} is owned by both {source.name} and {target.name}")
+        # Leftovers from an earlier, interrupted move would be stale
+        purge_bucket(target_conn, bucket, batch_size)
+        start_tracking(source_conn, bucket, lock_timeout)
+        copied = copy_bucket(source_conn, target_conn, bucket, batch_size)
+        changed, removed = hand_over(source_conn, target_conn, bucket, lock_timeout)
+        purged = purge_bucket(source_conn, bucket, batch_size)
+        logger.info(f"Moved bucket {bucket} from {source.name} to {target.name}: "
+                    f"{copied} copied, {changed} caught up, {removed} removed, {purged} purged")
+    except Exception:
+        source_conn.rollback()
+        target_conn.rollback()
+        try:
+            stop_tracking(source_conn.cursor(), bucket)
+            source_conn.commit()
+        except Exception as e:
+            logger.error(f"Failed to stop tracking changes to bucket {bucket}: {e}")
+        raise
+    finally:
+        source_conn.close()
+        target_conn.close()
+
+
+# Moves that leave every shard with BUCKETS / len(shards) buckets, give or take one
+def plan_rebalance(shards, owners):
+    owned = {shard.index: sorted(bucket for bucket, owner in owners.items() if owner is shard) for shard in shards}
+    quota = {shard.index: BUCKETS // len(shards) + (1 if shard.index < BUCKETS % len(shards) else 0) for shard in shards}
+    spare = [bucket for index in owned for bucket in owned[index][quota[index]:]]
+    moves = []
+    for shard in shards:
+        while len(owned[shard.index]) < quota[shard.index] and spare:
+            bucket = spare.pop()
+            owned[shard.index].append(bucket)
+            moves.append((bucket, shard))
+    return moves
+
+
+def print_status(shards):
+    owners = bucket_owners(shards)
+    print(f"{'shard':<40}{'buckets':>9}{'records':>12}")
+    for shard in shards:
+        conn = connect(shard)
+        try:
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                SELECT COUNT(*) AS records FROM medical_records m
+                JOIN record_buckets b ON b.bucket = m.patient_id % {BUCKETS};
+            """)
+            records = cursor.fetchone()['records']
+            conn.rollback()
+        finally:
+            conn.close()
+        print(f"{shard.name:<40}{sum(owner is shard for owner in owners.values()):>9}{records:>12}")
+    unowned = BUCKETS - len(owners)
+    if unowned:
+        print(f"{unowned} bucket(s) have no owner")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect and rebalance the medical record shards (MEDICAL_RECORD_SHARDS).")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('status', help="show buckets and records per shard")
+    move = commands.add_parser('move', help="move one bucket to another shard")
+    move.add_argument('--bucket', type=int, required=True)
+    move.add_argument('--to', type=int, required=True, help="index of the target shard in MEDICAL_RECORD_SHARDS")
+    rebalance = commands.add_parser('rebalance', help="spread the buckets evenly, e.g. after adding a shard")
+    rebalance.add_argument('--dry-run', action='store_true')
+    for command in (move, rebalance):
+        command.add_argument('--batch-size', type=int, default=5000)
+        command.add_argument('--lock-timeout', type=float, default=5.0, help="seconds to wait for writes in flight at handover")
+    args = parser.parse_args()
+
+    shards = load_shards()
+    try:
+        initialize_shards(shards)
+        if args.command == 'status':
+            print_status(shards)
+        elif args.command == 'move':
+            move_bucket(shards, args.bucket, shards[args.to], args.batch_size, args.lock_timeout)
+        else:
+            moves = plan_rebalance(shards, bucket_owners(shards))
+            logger.info(f"{len(moves)} bucket(s) to move")
+            for bucket, target in moves:
+                if args.dry_run:
+                    logger.info(f"Would move bucket {bucket} to {target.name}")
+                else:
+                    move_bucket(shards, bucket, target, args.batch_size, args.lock_timeout)
+        return 0
+    except Exception as e:
+        logger.error(f"Shard maintenance failed: {e}")
+        return 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,365 @@
+import os
+import time
+import heapq
+import logging
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from common import db
+from common.idempotency import create_idempotency_table
+from common.group_commit import GroupCommitter
+from attachments import create_attachment_table
+
+logger = logging.getLogger(__name__)
+
+# Medical records are sharded by patient across the databases listed in
+# MEDICAL_RECORD_SHARDS, e.g.
+#
+#     MEDICAL_RECORD_SHARDS=records-db-0/medical-record-db,records-db-1:5433/medical-record-db
+#
+# (host[:port]/database, with DB_USER and DB_PASSWORD). Without it the
+# service's own database is the only shard.
+#
+# A patient's records live in bucket patient_id % BUCKETS, and each shard
+# lists the buckets it owns in its record_buckets table. Writes lock their
+# bucket's row there (FOR SHARE) in the same transaction, so a bucket moved
+# by rebalance_shards.py can't take writes on its old shard; a writer that
+# finds its bucket gone refreshes the map and retries. Record ids are
+# unique across shards (each shard's sequence steps by ID_STRIDE from its
+# own offset) so records keep their id when they move.
+BUCKETS = 64
+ID_STRIDE = 16
+SHARD_MAP_REFRESH = float(os.getenv('SHARD_MAP_REFRESH', '30'))
+SHARD_RETRIES = int(os.getenv('SHARD_RETRIES', '5'))
+
+
+# Tables whose rows move with their bucket, in copy order:
+# (columns, key columns). An attachment refers to its record, so records go
+# first, and deleting a record deletes its attachments. Idempotency keys of
+# record creation go too, so a retry after the move still replays.
+BUCKET_TABLES = {
+    'medical_records': (('id', 'patient_id', 'doctor_id', 'diagnosis', 'treatment', 'record_date'), ('id',)),
+    'record_attachments': (('record_id', 'sha256', 'patient_id', 'filename', 'content_type', 'size', 'uploaded_at'),
+                           ('record_id', 'sha256')),
+    'idempotency_keys': (('scope', 'key', 'patient_id', 'request_hash', 'status_code', 'response', 'created_at'),
+                         ('scope', 'key')),
+}
+
+
+class BucketUnavailable(Exception):
+    """The bucket has no owning shard right now (it is being moved)."""
+
+
+def bucket_of(patient_id):
+    return patient_id % BUCKETS
+
+
+def parse_shards(value):
+    base = db.get_db_config()
+    configs = []
+    for entry in value.split(','):
+        address, _, database = entry.strip().partition('/')
+        host, _, port = address.partition(':')
+        configs.append(dict(base, host=host, port=int(port) if port else None, database=database or base['database']))
+    return configs
+
+
+class Shard:
+    def __init__(self, index, pool):
+        self.index = index
+        self.pool = pool
+        config = pool.config or db.get_db_config()
+        self.name = f"{config['host']}/{config['database']}"
+        # Batched writes to this shard (see common/group_commit.py)
+        self.writes = GroupCommitter(self.get_connection, f"shard {self.name}")
+
+    def get_connection(self):
+        return self.pool.get_connection()
+
+
+def load_shards(value=os.getenv('MEDICAL_RECORD_SHARDS')):
+    if not value:
+        return [Shard(0, db.pool)]
+    return [Shard(index, db.ConnectionPool(config)) for index, config in enumerate(parse_shards(value))]
+
+
+def create_shard_tables(cursor):
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS medical_records (
+            id SERIAL PRIMARY KEY,
+            patient_id INTEGER NOT NULL,
+            doctor_id INTEGER NOT NULL,
+            diagnosis TEXT NOT NULL,
+            treatment TEXT,
+            record_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE INDEX IF NOT EXISTS medical_records_patient_idx ON medical_records (patient_id);
+        CREATE INDEX IF NOT EXISTS medical_records_bucket_idx ON medical_records ((patient_id % {BUCKETS}));
+        CREATE TABLE IF NOT EXISTS record_buckets (
+            bucket INTEGER PRIMARY KEY
+        );
+    """)
+    # Attachment metadata and idempotency keys of record creation live on
+    # the patient's shard too
+    create_attachment_table(cursor, BUCKETS)
+    create_idempotency_table(cursor)
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS idempotency_keys_bucket_idx ON idempotency_keys ((patient_id % {BUCKETS}));")
+    create_bucket_move_log(cursor)
+
+
+# While rebalance_shards.py copies a bucket (listed in moving_buckets), the
+# keys of its rows that change are logged in bucket_move_changes, so the
+# handover only has to bring those rows over again
+def create_bucket_move_log(cursor):
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS moving_buckets (
+            bucket INTEGER PRIMARY KEY
+        );
+        CREATE TABLE IF NOT EXISTS bucket_move_changes (
+            bucket INTEGER NOT NULL,
+            table_name TEXT NOT NULL,
+            row_key JSONB NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS bucket_move_changes_bucket_idx ON bucket_move_changes (bucket);
+
+        -- Trigger arguments are the table's key columns
+        CREATE OR REPLACE FUNCTION log_bucket_move_change() RETURNS trigger LANGUAGE plpgsql AS $$
+        DECLARE
+            changed JSONB;
+            row_key JSONB;
+        BEGIN
+            IF NOT EXISTS (SELECT 1 FROM moving_buckets) THEN
+                RETURN NULL;
+            END IF;
+            FOR changed IN
+                SELECT value FROM jsonb_array_elements(CASE TG_OP
+                    WHEN 'INSERT' THEN jsonb_build_array(to_jsonb(NEW))
+                    WHEN 'DELETE' THEN jsonb_build_array(to_jsonb(OLD))
+                    ELSE jsonb_build_array(to_jsonb(OLD), to_jsonb(NEW)) END)
+            LOOP
+                IF EXISTS (SELECT 1 FROM moving_buckets WHERE bucket = (changed ->> 'patient_id')::int % {BUCKETS}) THEN
+                    row_key := '[]';
+                    FOR i IN 0 .. TG_NARGS - 1 LOOP
+                        row_key := row_key || jsonb_build_array(changed -> TG_ARGV[i]);
+                    END LOOP;
+                    INSERT INTO bucket_move_changes (bucket, table_name, row_key)
+                    VALUES ((changed ->> 'patient_id')::int % {BUCKETS}, TG_TABLE_NAME, row_key);
+                END IF;
+            END LOOP;
+            RETURN NULL;
+        END
+        $$;
+    """)
+    for table, (_, key) in BUCKET_TABLES.items():
+        cursor.execute(f"""
+            CREATE OR REPLACE TRIGGER {table}_log_bucket_move AFTER INSERT OR UPDATE OR DELETE ON {table}
+            FOR EACH ROW EXECUTE FUNCTION log_bucket_move_change({', '.join(f"'{column}'" for column in key)});
+        """)
+
+
+# Make ids unique across shards: shard i hands out ids congruent to i + 1
+# modulo ID_STRIDE, starting above every id already in use anywhere
+def stride_sequences(cursors):
+    highest = 0
+    for cursor in cursors:
+        cursor.execute("SELECT COALESCE(MAX(id), 0) AS highest FROM medical_records;")
+        highest = max(highest, cursor.fetchone()['highest'])
+    for index, cursor in enumerate(cursors):
+        cursor.execute("SELECT increment_by FROM pg_sequences WHERE sequencename = 'medical_records_id_seq';")
+        if cursor.fetchone()['increment_by'] == ID_STRIDE:
+            continue
+        start = highest - highest % ID_STRIDE + ID_STRIDE + index + 1
+        cursor.execute(f"ALTER SEQUENCE medical_records_id_seq INCREMENT BY {ID_STRIDE} RESTART WITH {start};")
+
+
+# Create the tables on every shard and, on a fresh set of shards, spread
+# the buckets over them
+def initialize_shards(shards):
+    conns = [shard.get_connection() for shard in shards]
+    if not all(conns):
+        for conn in conns:
+            if conn:
+                conn.close()
+        raise RuntimeError("Failed to connect to every medical record shard")
+    try:
+        cursors = [conn.cursor() for conn in conns]
+        # Serialize setup from several service processes
+        cursors[0].execute("SELECT pg_advisory_xact_lock(hashtext('medical_record_shards'));")
+        for cursor in cursors:
+            create_shard_tables(cursor)
+        owned = 0
+        for cursor in cursors:
+            cursor.execute("SELECT COUNT(*) AS owned FROM record_buckets;")
+            owned += cursor.fetchone()['owned']
+        if owned == 0:
+            for bucket in range(BUCKETS):
+                cursors[bucket % len(cursors)].execute("INSERT INTO record_buckets (bucket) VALUES (%s);", (bucket,))
+        if len(cursors) > 1:
+            stride_sequences(cursors)
+        # The first shard holds the advisory lock, so it commits last
+        for conn in reversed(conns):
+            conn.commit()
+    except Exception:
+        for conn in conns:
+            conn.rollback()
+        raise
+    finally:
+        for conn in conns:
+            conn.close()
+
+
+# Which shard owns each bucket, re-read from the shards every
+# SHARD_MAP_REFRESH seconds or when a write finds the map out of date
+class ShardMap:
+    def __init__(self, shards, refresh_interval=SHARD_MAP_REFRESH):
+        self.shards = shards
+        self.refresh_interval = refresh_interval
+        self.owners = {}
+        self.refreshed_at = 0.0
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        owners = {}
+        for shard in self.shards:
+            conn = shard.get_connection()
+            if not conn:
+                continue
+            try:
+                cursor = conn.cursor()
+                cursor.execute("SELECT bucket FROM record_buckets;")
+                for row in cursor.fetchall():
+                    owners[row['bucket']] = shard
+                conn.rollback()
+            finally:
+                conn.close()
+        with self.lock:
+            self.owners = owners
+            self.refreshed_at = time.monotonic()
+
+    def shard_for(self, patient_id):
+        if time.monotonic() - self.refreshed_at > self.refresh_interval:
+            self.refresh()
+        return self.owners.get(bucket_of(patient_id))
+
+
+# Returned by work whose bucket turned out not to be on the shard
+BUCKET_MOVED = object()
+
+
+def owns_bucket(cursor, bucket):
+    cursor.execute("SELECT bucket FROM record_buckets WHERE bucket = %s FOR SHARE;", (bucket,))
+    return cursor.fetchone() is not None
+
+
+# Run work(cursor) in a transaction on the shard owning the patient's bucket
+# and return its result. Retries on another shard if the bucket moved.
+# 'batched' writes are group committed with others when WRITE_BATCHING is on.
+def run_on_patient_shard(shard_map, patient_id, work, batched=False):
+    bucket = bucket_of(patient_id)
+
+    def owned_work(cursor):
+        if not owns_bucket(cursor, bucket):
+            return BUCKET_MOVED
+        return work(cursor)
+
+    for attempt in range(SHARD_RETRIES):
+        shard = shard_map.shard_for(patient_id)
+        if shard is not None:
+            run = shard.writes.run if batched else shard.writes.run_transaction
+            result = run(owned_work)
+            if result is not BUCKET_MOVED:
+                return result
+        # Moved or mid-move: the map is stale or nobody owns the bucket yet
+        time.sleep(0.05 * attempt)
+        shard_map.refresh()
+    raise BucketUnavailable(bucket)
+
+
+def db_unavailable(shard):
+    return ConnectionError(f"Failed to connect to shard {shard.name}")
+
+
+# Call function(shard) on every shard at once and return the results in
+# shard order. Trace and request context is carried into the threads.
+def scatter(shards, function):
+    if len(shards) == 1:
+        return [function(shards[0])]
+    with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, function, shard) for shard in shards]
+        return [future.result() for future in futures]
+
+
+# Run work(cursor) on whichever shard owns record 'record_id'; returns its
+# result, or None when no shard has the record
+def run_on_record_shard(shards, record_id, work):
+    def attempt(shard):
+        conn = shard.get_connection()
+        if not conn:
+            raise db_unavailable(shard)
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT b.bucket FROM medical_records m
+                JOIN record_buckets b ON b.bucket = m.patient_id %% %s
+                WHERE m.id = %s
+                FOR SHARE OF b;
+            """, (BUCKETS, record_id))
+            if cursor.fetchone() is None:
+                conn.rollback()
+                return None
+            result = work(cursor)
+            conn.commit()
+            return result
+        finally:
+            conn.close()
+
+    for result in scatter(shards, attempt):
+        if result is not None:
+            return result
+    return None
+
+
+# SELECT for records matching 'where', restricted to the buckets the shard
+# owns (a shard may hold copies of a bucket that is being moved to it)
+def records_query(where, order_column='id', descending=False, limit=None):
+    direction = 'DESC' if descending else 'ASC'
+    return f"""
+        SELECT m.* FROM medical_records m
+        JOIN record_buckets b ON b.bucket = m.patient_id %% {BUCKETS}
+        {'WHERE ' + ' AND '.join(where) if where else ''}
+        ORDER BY m.{order_column} {direction} NULLS LAST, m.id {direction}
+        {'LIMIT %s' if limit else ''};
+    """
+
+
+# Rows matching 'where' from every shard at once, merged in order and cut
+# to 'limit'
+def gather(shards, where, params, order_column='id', descending=False, limit=None):
+    query = records_query(where, order_column, descending, limit)
+    params = list(params) + ([limit] if limit else [])
+
+    def fetch(shard):
+        conn = shard.get_connection()
+        if not conn:
+            raise db_unavailable(shard)
+        try:
+            cursor = conn.cursor()
+            cursor.execute(query, params)
+            rows = cursor.fetchall()
+            conn.rollback()
+            return rows
+        finally:
+            conn.close()
+
+    def sort_key(row):
+        value = row[order_column]
+        # NULLS LAST in either direction
+        return (value is None) != descending, value, row['id']
+
+    merged = heapq.merge(*scatter(shards, fetch), key=sort_key, reverse=descending)
+    rows = []
+    for row in merged:
+        rows.append(row)
+        if limit and len(rows) == limit:
+            break
+    return rows
@@ -0,0 +1,202 @@
+import os
+import time
+import queue
+import importlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from common import tracing
+from common.log import get_logger
+
+logger = get_logger(__name__)
+
+# Delivery settings, all overridable from the environment
+DELIVERY_BACKEND = os.getenv('DELIVERY_BACKEND', 'log')
+WORKER_COUNT = int(os.getenv('NOTIFICATION_WORKERS', '4'))
+QUEUE_SIZE = int(os.getenv('NOTIFICATION_QUEUE_SIZE', '10000'))
+DEDUP_CACHE_SIZE = int(os.getenv('DEDUP_CACHE_SIZE', '100000'))
+DEDUP_TTL_SECONDS = float(os.getenv('DEDUP_TTL_SECONDS', '86400'))
+# How long a batch request waits for its messages to be sent; keep it below
+# the senders' request timeout (5 seconds by default)
+DELIVERY_TIMEOUT = float(os.getenv('NOTIFICATION_DELIVERY_TIMEOUT', '4.0'))
+
+
+# A message ready to be handed to a delivery backend
+class Message:
+    def __init__(self, email, subject, body, items=()):
+        self.email = email
+        self.subject = subject
+        self.body = body
+        # Request items the message was built from
+        self.items = list(items)
+
+
+# Default backend: mimic sending by writing the message to the log
+class LogBackend:
+    def send(self, message):
+        logger.info("Notification sent", email=message.email, body=message.body)
+
+
+backends = {
+    'log': LogBackend,
+}
+
+# Resolve DELIVERY_BACKEND to a backend instance, either one of the built-in
+# names or a 'module:ClassName' path to a class with a send(message) method
+def load_backend(name=DELIVERY_BACKEND):
+    if name in backends:
+        return backends[name]()
+    module_name, _, class_name = name.partition(':')
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+# Bounded LRU of recently accepted notifications per recipient, used to drop
+# repeats (e.g. a retried outbox batch) within DEDUP_TTL_SECONDS
+class RecentNotifications:
+    def __init__(self, max_size=DEDUP_CACHE_SIZE, ttl=DEDUP_TTL_SECONDS):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    # Record the key and return True if it was not seen recently
+    def add(self, email, key):
+        cache_key = (email, key)
+        now = time.monotonic()
+        with self.lock:
+            seen_at = self.entries.get(cache_key)
+            if seen_at is not None and now - seen_at < self.ttl:
+                self.entries.move_to_end(cache_key)
+                return False
+            self.entries[cache_key] = now
+            self.entries.move_to_end(cache_key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+            return True
+
+    # Forget a key, so a notification that could not be queued can be resent
+    def discard(self, email, key):
+        with self.lock:
+            self.entries.pop((email, key), None)
+
+
+# Who a notification goes to. Appointment reminders carry the patient id
+# when the sender has no address; the backend resolves it.
+def recipient(item):
+    return item.get('email') or f"patient:{item['patient_id']}"
+
+# Error message for an item the batch endpoint can't send, or None
+def validate_item(item):
+    if not isinstance(item, dict):
+        return "Email and Amount are required"
+    if item.get('type') == 'appointment_reminder':
+        if item.get('appointment_id') is None or not item.get('appointment_date'):
+            return "Appointment ID and date are required"
+        if not item.get('email') and item.get('patient_id') is None:
+            return "Email or Patient ID is required"
+        return None
+    if not item.get('email') or item.get('amount') is None:
+        return "Email and Amount are required"
+    if not is_number(item['amount']):
+        return "Amount must be a number"
+    return None
+
+def is_number(value):
+    if isinstance(value, bool):
+        return False
+    try:
+        float(value)
+        return True
+    except (TypeError, ValueError):
+        return False
+
+def dedup_key(item):
+    if item.get('key') is not None:
+        return str(item['key'])
+    return f"bill:{item.get('bill_id')}:{item['amount']}"
+
+def render_bill(item):
+    return f"You have a pending bill of amount {item['amount']}."
+
+def render_reminder(item):
+    return f"Reminder: you have an appointment on {item['appointment_date']}."
+
+def render_digest(items):
+    total = sum(float(item['amount']) for item in items)
+    lines = [f"You have {len(items)} pending bills totalling {total:.2f}:"]
+    for item in items:
+        label = f"Bill {item['bill_id']}" if item.get('bill_id') is not None else "Bill"
+        lines.append(f"- {label}: {item['amount']}")
+    return "\n".join(lines)
+
+# Turn validated items into messages, optionally folding several bills for the
+# same recipient into a single digest message. Reminders are always sent on
+# their own.
+def build_messages(items, digest=False):
+    messages = [
+        Message(recipient(item), "Appointment reminder", render_reminder(item), [item])
+        for item in items if item.get('type') == 'appointment_reminder'
+    ]
+    bills = [item for item in items if item.get('type') != 'appointment_reminder']
+    if not digest:
+        return messages + [Message(item['email'], "Pending bill", render_bill(item), [item]) for item in bills]
+
+    by_email = OrderedDict()
+    for item in bills:
+        by_email.setdefault(item['email'], []).append(item)
+
+    for email, group in by_email.items():
+        if len(group) == 1:
+            messages.append(Message(email, "Pending bill", render_bill(group[0]), group))
+        else:
+            messages.append(Message(email, "Pending bills", render_digest(group), group))
+    return messages
+
+
+# Bounded in-memory queue drained by a pool of worker threads that hand
+# messages to the delivery backend. Each submitted message gets a Future that
+# completes once the backend has sent it, or with the backend's error.
+class DeliveryQueue:
+    def __init__(self, backend, workers=WORKER_COUNT, max_size=QUEUE_SIZE):
+        self.backend = backend
+        self.worker_count = workers
+        self.queue = queue.Queue(maxsize=max_size)
+        self.workers = []
+        self.pid = None
+        self.lock = threading.Lock()
+
+    # Workers are started lazily so that forked server processes get their own
+    def start(self):
+        with self.lock:
+            self.pid = os.getpid()
+            self.workers = [worker for worker in self.workers if worker.is_alive()]
+            while len(self.workers) < self.worker_count:
+                worker = threading.Thread(target=self.work, name=f"delivery-{len(self.workers)}", daemon=True)
+                worker.start()
+                self.workers.append(worker)
+
+    # Queue a message, returning its Future, or None if the queue is full
+    def submit(self, message):
+        if self.pid != os.getpid():
+            self.start()
+        future = Future()
+        try:
+            self.queue.put_nowait((message, future))
+            return future
+        except queue.Full:
+            return None
+
+    def work(self):
+        while True:
+            message, future = self.queue.get()
+            # Continue the trace of the request that created the (first) bill
+            parent = tracing.parse_traceparent(message.items[0].get('traceparent')) if message.items else None
+            try:
+                with tracing.start_span("notification.deliver", "consumer", parent=parent, items=len(message.items)):
+                    self.backend.send(message)
+                future.set_result(None)
+            except Exception as e:
+                logger.error("Error delivering notification", email=message.email, error=e)
+                future.set_exception(e)
+            finally:
+                self.queue.task_done()
@@ -1,11 +1,29 @@
+import time
+from concurrent import futures
 from flask import Flask, request, jsonify
-import logging
+from delivery import (load_backend, RecentNotifications, DeliveryQueue, Message, build_messages, dedup_key, render_bill,
+                      recipient, validate_item, DELIVERY_TIMEOUT)
+from common.log import configure_logging, get_logger
+from common.metrics import init_metrics
+from common.tracing import init_tracing
+from common.profiling import init_profiling
 
 app = Flask(__name__)
+init_metrics(app, 'notification_service')
+init_tracing(app, 'notification_service')
+init_profiling(app, 'notification_service')
 
 # Configure logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+configure_logging('notification_service')
+logger = get_logger(__name__)
+
+# Delivery backend, recently seen notifications and the worker-pool queue
+backend = load_backend()
+recent = RecentNotifications()
+delivery_queue = DeliveryQueue(backend)
+
+# Maximum number of notifications accepted in one batch request
+MAX_BATCH_SIZE = 1000
 
 # Route to mimic sending a notification
 @app.route('/send-notification', methods=['POST'])
@@ -18,12 +36,88 @@ def send_notification():
         return jsonify({"error": "Email and Amount are required"}), 400
 
     try:
-        # Mimic sending a notification
-        logger.info(f"Notification sent to {email}: 'You have a pending bill of amount {amount}.'")
+        backend.send(Message(email, "Pending bill", render_bill(data)))
         return jsonify({"message": "Notification sent successfully"}), 200
     except Exception as e:
-        logger.error(f"Error sending notification: {e}")
+        logger.error("Error sending notification", error=e)
         return jsonify({"error": "Failed to send notification"}), 500
 
+# Route to send many notifications at once: bills, and appointment
+# reminders (items with "type": "appointment_reminder"). Repeats of recently
+# accepted notifications are dropped, and with "digest" set several bills
+# for the same recipient are combined into one message. The worker pool sends
+# the messages before the response goes out; items that could not be sent
+# within DELIVERY_TIMEOUT are listed in "rejected" so the sender retries them.
+@app.route('/send-notifications', methods=['POST'])
+def send_notifications():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": "Notifications list is required"}), 400
+    items = data.get('notifications')
+    digest = bool(data.get('digest'))
+
+    if not isinstance(items, list):
+        return jsonify({"error": "Notifications list is required"}), 400
+    if len(items) > MAX_BATCH_SIZE:
+        return jsonify({"error": f"At most {MAX_BATCH_SIZE} notifications per batch"}), 400
+
+    rejected = []
+    duplicates = 0
+    accepted = []
+    positions = {}
+    for index, item in enumerate(items):
+        error = validate_item(item)
+        if error:
+            rejected.append({"index": index, "error": error})
+            continue
+        if not recent.add(recipient(item), dedup_key(item)):
+            duplicates += 1
+            continue
+        accepted.append(item)
+        positions[id(item)] = index
+
+    pending = []
+    for message in build_messages(accepted, digest):
+        future = delivery_queue.submit(message)
+        if future is not None:
+            pending.append((message, future))
+            continue
+        # Queue is full: forget these items so the sender can retry them
+        reject_message(message, "Notification queue is full", positions, rejected)
+
+    if not pending and accepted:
+        return jsonify({"error": "Notification queue is full", "rejected": rejected}), 503
+
+    sent = 0
+    deadline = time.monotonic() + DELIVERY_TIMEOUT
+    for message, future in pending:
+        try:
+            future.result(timeout=max(0.0, deadline - time.monotonic()))
+            sent += 1
+        except futures.TimeoutError:
+            reject_message(message, "Delivery timed out", positions, rejected)
+        except Exception as e:
+            reject_message(message, f"Delivery failed: {e}", positions, rejected)
+
+    if sent == 0 and accepted:
+        return jsonify({"error": "Failed to send notifications", "rejected": rejected}), 503
+
+    logger.info("Notification batch", received=len(items), accepted=len(accepted), duplicates=duplicates, sent=sent)
+    return jsonify({
+        "message": "Notifications sent",
+        "accepted": len(accepted),
+        "duplicates": duplicates,
+        "queued": len(pending),
+        "sent": sent,
+        "rejected": rejected
+    }), 202
+
+# Reject the items of a message that was not sent, forgetting them so a
+# retry of the same items is not dropped as a repeat
+def reject_message(message, error, positions, rejected):
+    for item in message.items:
+        recent.discard(recipient(item), dedup_key(item))
+        rejected.append({"index": positions[id(item)], "error": error})
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8001)
@@ -167,58 +167,41 @@
 #     app.run(host='0.0.0.0', port=4000)
 
 
-import logging
 from flask import Flask, request, jsonify
-import psycopg2
-from psycopg2.extras import RealDictCursor
-import os
+from common.log import configure_logging, get_logger
+from common.db import get_db_connection
+from common.metrics import init_metrics
+from common.tracing import init_tracing
+from common.profiling import init_profiling
+from common.codec import init_codec
+from common.slow_queries import init_slow_query_log
+from common.idempotency import (init_idempotency, create_idempotency_table, claim_idempotency_key,
+                                remember_response, start_idempotency_cleanup)
+from common.change_feed import create_change_feed, init_change_feed, start_change_feed_pruning
 
 # Configure the logger
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+configure_logging('patient_service')
+logger = get_logger(__name__)
 
 app = Flask(__name__)
-
-# Function to get database configuration from environment variables
-def get_db_config():
-    return {
-        'user': os.getenv('DB_USER'),
-        'password': os.getenv('DB_PASSWORD'),
-        'host': os.getenv('DB_HOST'),
-        'database': os.getenv('DB_NAME')
-    }
-
-class DatabaseConnection:
-    _connection = None
-
-    @staticmethod
-    def get_connection():
-        if DatabaseConnection._connection is None:
-            config = get_db_config()
-            try:
-                DatabaseConnection._connection = psycopg2.connect(
-                    host=config['host'],
-                    database=config['database'],
-                    user=config['user'],
-                    password=config['password'],
-                    cursor_factory=RealDictCursor
-                )
-                logger.info("Database connection established.")
-            except Exception as e:
-                logger.error(f"Error connecting to the database: {e}")
-                return None
-        return DatabaseConnection._connection
+init_metrics(app, 'patient_service')
+init_tracing(app, 'patient_service')
+init_profiling(app, 'patient_service')
+init_codec(app)
+init_slow_query_log(app)
+init_idempotency(app)
+init_change_feed(app, 'patients', get_db_connection)
 
 # Function to initialize the database and create the table if it doesn't exist
 def initialize_database():
-    conn = DatabaseConnection.get_connection()
+    conn = get_db_connection()
     if not conn:
-        app.logger.error("Failed to connect to the database for initialization.")
+        logger.error("Failed to connect to the database for initialization.")
         return
 
     try:
         cursor = conn.cursor()
-        app.logger.info("Creating 'patients' table if it doesn't exist...")
+        logger.info("Creating 'patients' table if it doesn't exist...")
         cursor.execute(""" 
             CREATE TABLE IF NOT EXISTS patients (
                 id SERIAL PRIMARY KEY,
@@ -227,33 +210,50 @@ def initialize_database():
                 contract_info VARCHAR(255)
             );
         """)
+        # Other services follow this table's ids through GET /changes
+        create_change_feed(cursor, 'patients')
+        # Responses of create requests sent with an Idempotency-Key
+        create_idempotency_table(cursor)
         conn.commit()
-        app.logger.info("Database initialized successfully.")
+        logger.info("Database initialized successfully.")
     except Exception as e:
-        app.logger.error(f"Error initializing database: {e}")
+        logger.error("Error initializing database", error=e)
     finally:
         cursor.close()
+        conn.close()
 
 # Initialize the database when the service starts
 initialize_database()
+start_idempotency_cleanup(get_db_connection)
+start_change_feed_pruning(get_db_connection, 'patients')
 
-# Route to get all patients
+# Route to get all patients, or only those listed in 'ids' (comma-separated)
 @app.route('/patients', methods=['GET'])
 def get_patients():
-    conn = DatabaseConnection.get_connection()
+    ids = request.args.get('ids')
+    try:
+        ids = [int(patient_id) for patient_id in ids.split(',') if patient_id] if ids is not None else None
+    except ValueError:
+        return jsonify({"error": "ids must be comma-separated numbers"}), 400
+
+    conn = get_db_connection()
     if not conn:
         return jsonify({"error": "Database connection failed"}), 500
 
     try:
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM patients;")
+        if ids is None:
+            cursor.execute("SELECT * FROM patients;")
+        else:
+            cursor.execute("SELECT * FROM patients WHERE id = ANY(%s);", (ids,))
         patients = cursor.fetchall()
         return jsonify(patients), 200
     except Exception as e:
-        logger.error(f"Error fetching patients: {e}")
+        logger.error("Error fetching patients", error=e)
         return jsonify({"error": "Failed to fetch patients"}), 500
     finally:
         cursor.close()
+        conn.close()
 
 # Route to add a new patient
 @app.route('/patients', methods=['POST'])
@@ -266,25 +266,32 @@ def add_patient():
     if not name or not age:
         return jsonify({"error": "Name and age are required"}), 400
 
-    conn = DatabaseConnection.get_connection()
+    conn = get_db_connection()
     if not conn:
         return jsonify({"error": "Database connection failed"}), 500
 
     try:
         cursor = conn.cursor()
+        # A retry with the same Idempotency-Key gets the first response back
+        replay = claim_idempotency_key(cursor)
+        if replay is not None:
+            return replay
         cursor.execute(
             "INSERT INTO patients (name, age, contract_info) VALUES (%s, %s, %s) RETURNING id;",
             (name, age, contract_info)
         )
         patient_id = cursor.fetchone()['id']
+        response = {"id": patient_id, "message": "Patient added successfully"}
+        remember_response(cursor, response, 201)
         conn.commit()
-        logger.info(f"Patient {patient_id} added: name = {name}, age = {age}, contract_info = {contract_info}")
-        return jsonify({"id": patient_id, "message": "Patient added successfully"}), 201
+        logger.info("Patient added", patient_id=patient_id, name=name, age=age, contract_info=contract_info)
+        return jsonify(response), 201
     except Exception as e:
-        logger.error(f"Error adding patient: {e}")
+        logger.error("Error adding patient", error=e)
         return jsonify({"error": "Failed to add patient"}), 500
     finally:
         cursor.close()
+        conn.close()
 
 # Route to update a patient's information
 @app.route('/patients/<int:patient_id>', methods=['PUT'])
@@ -294,7 +301,7 @@ def update_patient(patient_id):
     age = data.get('age')
     contract_info = data.get('contract_info')
 
-    conn = DatabaseConnection.get_connection()
+    conn = get_db_connection()
     if not conn:
         return jsonify({"error": "Database connection failed"}), 500
 
@@ -305,18 +312,19 @@ def update_patient(patient_id):
             (name, age, contract_info, patient_id)
         )
         conn.commit()
-        logger.info(f"Patient {patient_id} updated: name = {name}, age = {age}, contract_info = {contract_info}")
+        logger.info("Patient updated", patient_id=patient_id, name=name, age=age, contract_info=contract_info)
         return jsonify({"message": "Patient updated successfully"}), 200
     except Exception as e:
-        logger.error(f"Error updating patient: {e}")
+        logger.error("Error updating patient", error=e)
         return jsonify({"error": "Failed to update patient"}), 500
     finally:
         cursor.close()
+        conn.close()
 
 # Route to delete a patient
 @app.route('/patients/<int:patient_id>', methods=['DELETE'])
 def delete_patient(patient_id):
-    conn = DatabaseConnection.get_connection()
+    conn = get_db_connection()
     if not conn:
         return jsonify({"error": "Database connection failed"}), 500
 
@@ -324,13 +332,14 @@ def delete_patient(patient_id):
         cursor = conn.cursor()
         cursor.execute("DELETE FROM patients WHERE id = %s;", (patient_id,))
         conn.commit()
-        logger.info(f"Patient {patient_id} deleted")
+        logger.info("Patient deleted", patient_id=patient_id)
         return jsonify({"message": "Patient deleted successfully"}), 200
     except Exception as e:
-        logger.error(f"Error deleting patient: {e}")
+        logger.error("Error deleting patient", error=e)
         return jsonify({"error": "Failed to delete patient"}), 500
     finally:
         cursor.close()
+        conn.close()
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=4000)
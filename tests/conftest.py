@@ -0,0 +1,61 @@
+import os
+import sys
+import uuid
+import importlib
+import psycopg2
+import pytest
+
+# The tests run the services' code against throwaway databases on the
+# Postgres server given by DB_HOST, DB_USER and DB_PASSWORD (as for the
+# services and benchmarks/harness.py), and are skipped when it can't be
+# reached:
+#
+#     DB_PASSWORD=postgres python -m pytest tests
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+os.environ.setdefault('DB_HOST', '127.0.0.1')
+os.environ.setdefault('DB_USER', 'postgres')
+os.environ.setdefault('DB_PASSWORD', '')
+# No other services run next to the tests
+os.environ['REFERENCE_VALIDATION'] = 'false'
+
+
+# Import a service module the way the service runs it, with its own
+# directory on the path
+def import_service(directory, module):
+    path = os.path.join(REPO_ROOT, directory)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+    return importlib.import_module(module)
+
+
+def database_config(name):
+    return {
+        'host': os.environ['DB_HOST'],
+        'user': os.environ['DB_USER'],
+        'password': os.environ['DB_PASSWORD'],
+        'database': name,
+    }
+
+
+# Creates empty databases on request; all of them are dropped at the end
+@pytest.fixture(scope='session')
+def create_database():
+    try:
+        admin = psycopg2.connect(**database_config('postgres'))
+    except psycopg2.OperationalError as e:
+        pytest.skip(f"Postgres is not reachable: {e}")
+    admin.autocommit = True
+    created = []
+
+    def create(prefix):
+        name = f"{prefix}_{uuid.uuid4().hex[:8]}"
+        admin.cursor().execute(f"CREATE DATABASE {name};")
+        created.append(name)
+        return name
+
+    yield create
+    for name in created:
+        admin.cursor().execute(f"DROP DATABASE IF EXISTS {name} WITH (FORCE);")
+    admin.close()
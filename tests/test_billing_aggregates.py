@@ -0,0 +1,100 @@
+import os
+import psycopg2
+import pytest
+from conftest import import_service, database_config
+
+# patient_balances and daily_billing_summary are kept up to date by the
+# bill routes (see billing_service/aggregates.py); after any mix of them
+# they must equal the totals computed from 'bills' directly.
+BALANCES = """
+    SELECT patient_id, bill_count, billed_amount, paid_amount, outstanding_amount
+    FROM patient_balances WHERE bill_count <> 0 ORDER BY patient_id;
+"""
+EXPECTED_BALANCES = """
+    SELECT patient_id, COUNT(*), SUM(amount),
+           COALESCE(SUM(amount) FILTER (WHERE LOWER(status) = 'paid'), 0),
+           COALESCE(SUM(amount) FILTER (WHERE LOWER(status) <> 'paid'), 0)
+    FROM bills GROUP BY patient_id ORDER BY patient_id;
+"""
+DAILY_SUMMARY = """
+    SELECT day, issued_count, issued_amount, paid_count, paid_amount
+    FROM daily_billing_summary WHERE issued_count <> 0 OR paid_count <> 0 ORDER BY day;
+"""
+EXPECTED_DAILY_SUMMARY = """
+    SELECT day, SUM(issued_count), SUM(issued_amount), SUM(paid_count), SUM(paid_amount)
+    FROM (
+        SELECT issued_date::date AS day, 1 AS issued_count, amount AS issued_amount, 0 AS paid_count, 0 AS paid_amount
+        FROM bills
+        UNION ALL
+        SELECT COALESCE(paid_date, issued_date)::date, 0, 0, 1, amount
+        FROM bills WHERE LOWER(status) = 'paid'
+    ) contributions
+    GROUP BY day ORDER BY day;
+"""
+
+
+@pytest.fixture(scope='module')
+def billing(create_database):
+    os.environ['DB_NAME'] = create_database('billing_test')
+    return import_service('billing_service', 'billing_service')
+
+
+def query(cursor, statement):
+    cursor.execute(statement)
+    return cursor.fetchall()
+
+
+def assert_aggregates_match():
+    conn = psycopg2.connect(**database_config(os.environ['DB_NAME']))
+    try:
+        cursor = conn.cursor()
+        assert query(cursor, BALANCES) == query(cursor, EXPECTED_BALANCES)
+        assert query(cursor, DAILY_SUMMARY) == query(cursor, EXPECTED_DAILY_SUMMARY)
+    finally:
+        conn.close()
+
+
+def test_aggregates_match_bills_after_create_pay_settle_and_delete(billing):
+    client = billing.app.test_client()
+    ids = []
+    for number in range(12):
+        response = client.post('/bills', json={
+            "patient_id": 1 + number % 3,
+            "appointment_id": 100 + number,
+            "amount": f"{10 + number}.25",
+            "email": "patient@example.com",
+        })
+        assert response.status_code == 201
+        ids.append(response.get_json()['id'])
+    assert_aggregates_match()
+
+    # Single status changes: paid on a given day, paid without a date, overdue
+    assert client.put(f'/bills/{ids[0]}/status', json={"status": "Paid", "paid_date": "2024-05-01T10:00:00"}).status_code == 200
+    assert client.put(f'/bills/{ids[1]}/status', json={"status": "paid"}).status_code == 200
+    assert client.put(f'/bills/{ids[2]}/status', json={"status": "Overdue"}).status_code == 200
+    assert_aggregates_match()
+
+    # A settlement paying bills on two days, reopening a paid one and
+    # naming a bill that doesn't exist
+    response = client.put('/bills/status', json={
+        "status": "Paid",
+        "paid_date": "2024-05-02T09:00:00",
+        "ids": ids[3:8],
+        "bills": [
+            {"id": ids[8], "paid_date": "2024-05-03T09:00:00"},
+            {"id": ids[0], "status": "Pending"},
+            {"id": ids[1], "status": "PAID"},
+            {"id": 999999999},
+        ],
+    })
+    assert response.status_code == 200
+    assert response.get_json()['missing'] == [999999999]
+    assert_aggregates_match()
+
+    # Deleting a paid, an unpaid and an already deleted bill
+    for bill_id in (ids[4], ids[9], ids[9]):
+        assert client.delete(f'/bills/{bill_id}').status_code == 200
+    assert_aggregates_match()
+
+    balance = client.get('/patients/2/balance').get_json()
+    assert balance['bill_count'] == 3
@@ -0,0 +1,144 @@
+import pytest
+from psycopg2.extras import Json
+from conftest import import_service, database_config
+from common import db
+
+rebalance_shards = import_service('medical_record_service', 'rebalance_shards')
+sharding = import_service('medical_record_service', 'sharding')
+
+# initialize_shards gives odd buckets to the second of two shards
+BUCKET = 5
+PATIENTS = (BUCKET, BUCKET + sharding.BUCKETS, BUCKET + 2 * sharding.BUCKETS)
+
+
+@pytest.fixture
+def shards(create_database):
+    shards = [sharding.Shard(index, db.ConnectionPool(database_config(create_database(f"records_shard{index}"))))
+              for index in range(2)]
+    sharding.initialize_shards(shards)
+    yield shards
+    for shard in shards:
+        shard.pool.close_all()
+
+
+def execute(shard, statement, params=()):
+    conn = shard.get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(statement, params)
+        rows = cursor.fetchall() if cursor.description else None
+        conn.commit()
+        return rows
+    finally:
+        conn.close()
+
+
+# Every row of the bucket on a shard, per table in BUCKET_TABLES
+def bucket_rows(shard, bucket=BUCKET):
+    rows = {}
+    for table, (columns, key) in sharding.BUCKET_TABLES.items():
+        rows[table] = [dict(row) for row in execute(shard, f"""
+            SELECT {', '.join(columns)} FROM {table}
+            WHERE patient_id %% {sharding.BUCKETS} = %s ORDER BY {', '.join(key)};
+        """, (bucket,))]
+    return rows
+
+
+def owned_buckets(shard):
+    return {row['bucket'] for row in execute(shard, "SELECT bucket FROM record_buckets;")}
+
+
+def add_record(shard, patient_id, diagnosis):
+    record_id = execute(shard, """
+        INSERT INTO medical_records (patient_id, doctor_id, diagnosis) VALUES (%s, 1, %s) RETURNING id;
+    """, (patient_id, diagnosis))[0]['id']
+    execute(shard, """
+        INSERT INTO record_attachments (record_id, sha256, patient_id, filename, content_type, size)
+        VALUES (%s, %s, %s, 'scan.pdf', 'application/pdf', 100);
+    """, (record_id, f"{record_id:064x}", patient_id))
+    execute(shard, """
+        INSERT INTO idempotency_keys (scope, key, patient_id, request_hash, status_code, response)
+        VALUES ('medical_records', %s, %s, %s, 201, %s);
+    """, (f"key-{record_id}", patient_id, '0' * 64, Json({"id": record_id})))
+    return record_id
+
+
+def fill_bucket(source):
+    record_ids = [add_record(source, patient_id, f"diagnosis {number}")
+                  for number, patient_id in enumerate(PATIENTS * 3)]
+    # A neighbouring bucket on the same shard, which must stay put
+    add_record(source, BUCKET + 2, "other bucket")
+    return record_ids
+
+
+def test_move_catches_up_with_writes_made_during_the_copy(shards):
+    target, source = shards
+    record_ids = fill_bucket(source)
+    other_bucket = bucket_rows(source, BUCKET + 2)
+
+    source_conn, target_conn = rebalance_shards.connect(source), rebalance_shards.connect(target)
+    try:
+        rebalance_shards.start_tracking(source_conn, BUCKET, lock_timeout=5.0)
+        rebalance_shards.copy_bucket(source_conn, target_conn, BUCKET, batch_size=2)
+
+        # Writes the copy has missed: a new record, a changed one, a deleted
+        # one (with its attachment) and a changed idempotency key
+        add_record(source, PATIENTS[1], "added during the copy")
+        execute(source, "UPDATE medical_records SET diagnosis = 'changed' WHERE id = %s;", (record_ids[0],))
+        execute(source, "DELETE FROM medical_records WHERE id = %s;", (record_ids[1],))
+        execute(source, "UPDATE idempotency_keys SET status_code = 200 WHERE key = %s;", (f"key-{record_ids[2]}",))
+        expected = bucket_rows(source)
+
+        rebalance_shards.hand_over(source_conn, target_conn, BUCKET, lock_timeout=5.0)
+        rebalance_shards.purge_bucket(source_conn, BUCKET, batch_size=2)
+    finally:
+        source_conn.close()
+        target_conn.close()
+
+    assert bucket_rows(target) == expected
+    assert all(not rows for rows in bucket_rows(source).values())
+    assert BUCKET in owned_buckets(target) and BUCKET not in owned_buckets(source)
+    assert bucket_rows(source, BUCKET + 2) == other_bucket
+    assert execute(source, "SELECT * FROM moving_buckets;") == []
+    assert execute(source, "SELECT * FROM bucket_move_changes;") == []
+
+
+def test_move_bucket_there_and_back(shards):
+    target, source = shards
+    fill_bucket(source)
+    expected = bucket_rows(source)
+
+    rebalance_shards.move_bucket(shards, BUCKET, target, batch_size=4)
+    assert bucket_rows(target) == expected
+    assert BUCKET in owned_buckets(target) and BUCKET not in owned_buckets(source)
+
+    rebalance_shards.move_bucket(shards, BUCKET, source, batch_size=4)
+    assert bucket_rows(source) == expected
+    assert all(not rows for rows in bucket_rows(target).values())
+    assert owned_buckets(source) | owned_buckets(target) == set(range(sharding.BUCKETS))
+
+
+def test_failed_move_leaves_the_bucket_on_its_shard(shards):
+    target, source = shards
+    fill_bucket(source)
+    expected = bucket_rows(source)
+    # A bucket claimed by both shards is refused before anything is copied
+    execute(target, "INSERT INTO record_buckets (bucket) VALUES (%s);", (BUCKET,))
+
+    with pytest.raises(RuntimeError):
+        rebalance_shards.move_bucket(shards, BUCKET, target)
+    assert bucket_rows(source) == expected
+    assert BUCKET in owned_buckets(source)
+    assert execute(source, "SELECT * FROM moving_buckets;") == []
+
+
+def test_plan_rebalance_spreads_buckets_evenly(shards):
+    owners = rebalance_shards.bucket_owners(shards)
+    new_shard = sharding.Shard(2, shards[0].pool)
+    moves = rebalance_shards.plan_rebalance(shards + [new_shard], owners)
+
+    for bucket, shard in moves:
+        owners[bucket] = shard
+    counts = sorted(sum(owner is shard for owner in owners.values()) for shard in shards + [new_shard])
+    assert counts == [21, 21, 22]
+    assert all(shard is new_shard for _, shard in moves)